@@ -60,6 +60,102 @@ dat_format = "%s_%.5i"
 pv_deadtime_dble = 5
 pv_deadtime_enum = 1
 
+# the archiving process checks deadtimes and deadbands for each batch
+# of changes with NumPy arrays, if NumPy is installed.  Set this to
+# False to check changes one at a time.
+archive_use_numpy = True
+
+# archived values are written to the database by a separate thread of
+# the archiving process, taking values from a queue of up to
+# archive_writer_queue values, archive_writer_batch at a time.
+# When the queue is full, archive_writer_policy says what to do:
+#    'block'     the archiving process waits for the writer.
+#    'coalesce'  only the latest value of each PV is kept until the
+#                queue has room again.
+#    'spool'     values are appended to the spool (see archive_spool).
+# Set archive_writer = False to write values from the archiving process.
+archive_writer        = True
+archive_writer_queue  = 20000
+archive_writer_batch  = 2000
+archive_writer_policy = 'coalesce'
+
+# values that cannot be inserted into the archive database are kept in
+# spool files in archive_spool_dir, synced to disk, and replayed once
+# inserts work again.  Replaying uses LOAD DATA LOCAL INFILE, which needs
+# local_infile enabled on the MySQL server, and otherwise plain inserts.
+archive_spool     = True
+archive_spool_dir = join(logdir, 'spool')
+
+# the archiving process marks itself as alive in the info table, and
+# checks whether it has been asked to stop, every archive_heartbeat seconds
+archive_heartbeat = 2.0
+
+# local socket used by the caching process to send changed values
+# directly to the archiving process.  If the archiver cannot use
+# this, it will read recent changes from the cache table instead.
+feed_socket = join(logdir, 'cache_feed.sock')
+
+# local socket on which the caching process takes add, drop and suspend
+# requests, acting on them right away.  The web server user needs group
+# write access to it;  if it cannot connect, requests are put in the
+# requests table, which the caching process reads every 15 seconds.
+cache_control_socket = join(logdir, 'cache_control.sock')
+
+# the caching process collects changed values and writes them to
+# the cache table every cache_flush_interval seconds, or as soon as
+# cache_flush_size changed values are waiting.
+cache_flush_interval = 0.5
+cache_flush_size     = 500
+
+# time (in seconds) for the caching process to wait for PVs to connect
+# at startup.  PVs that connect later are cached as soon as they connect.
+cache_connect_timeout = 30.0
+
+# Channel Access monitor mask used by the caching process for PVs without
+# their own mask (set on the PV settings page): names joined by '+' from
+#   value:  changes larger than the record's monitor deadband (MDEL)
+#   log:    changes larger than the record's archive deadband (ADEL)
+#   alarm:  alarm state changes
+# 'log+alarm' lets the IOCs do most of the filtering for the archiver.
+cache_monitor_mask = 'log+alarm'
+
+# Channel Access objects used by the caching process:
+#   'pv'  epics.PV objects (the default)
+#   'ca'  lighter channel objects built directly on epics.ca, using less
+#         memory and CPU per PV.  scripts/cache_engine_bench.py compares them.
+cache_engine = 'pv'
+
+# periods (in seconds) of the periodic tasks of the caching process:
+#   requests:  add/drop/suspend requests from the web pages
+#   alerts:    check alerts
+#   heartbeat: mark the cache as alive, and check that it still owns the
+#              cache row of the info table
+#   settings:  re-read alert settings and cache policies
+#   status:    print a status report to the cache log
+#   stats:     write per-PV statistics to cache_stats_file
+#   snapshot:  save PV metadata to cache_snapshot_file
+#   deferred:  connect some PVs that were dead when the cache started
+#   values:    write current values to cache_values_file
+# tasks not listed here keep their default period.
+cache_task_periods = {'requests': 15, 'alerts': 15, 'heartbeat': 5,
+                      'settings': 300, 'status': 300, 'stats': 60,
+                      'snapshot': 300, 'deferred': 60, 'values': 5}
+
+# per-PV statistics of the caching process, shown by 'pvarch cache top'
+cache_stats_file = join(logdir, 'cache_stats.json')
+
+# PV metadata (types, enum strings, last values, connection state) saved
+# by the caching process, for a faster restart.  PVs that have not been
+# connected for cache_dead_time seconds are connected only after startup.
+cache_snapshot_file = join(logdir, 'cache_meta.pkl')
+cache_dead_time     = 3*86400
+
+# current values of all cached PVs, written by the caching process as a
+# memory-mapped file, so that web pages can show values without reading
+# the cache table.  Web pages read the cache table if the file has not
+# been written for 60 seconds.
+cache_values_file = join(logdir, 'cache_values.dat')
+
 ######################################################
 ##
 ## Email setup for email alerts
@@ -36,8 +36,11 @@ class ArchiveMaster(MasterDB):
                graph_hi    tinyblob,              graph_lo    tinyblob,
                graph_type  enum('normal','log','discrete'),
                type        enum('int','double','string','enum') not null,
-               active   enum('yes','no') default 'yes')""",
-               "create index name_idx on pv (name);")
+               active   enum('yes','no') default 'yes',
+               modified timestamp not null default current_timestamp
+                        on update current_timestamp)""",
+               "create index name_idx on pv (name);",
+               "create index modified_idx on pv (modified);")
     
     dat_init = ("drop table if exists pvdat%3.3i",
                 """create table pvdat%3.3i( time   double not null,
@@ -116,7 +119,7 @@ class ArchiveMaster(MasterDB):
         olddb.use(self.arch_db)
         old_data = olddb.tables['pv'].select()
 
-        cache_pvnames = self.get_pvnames()
+        self.registry.sync(self.db)
 
        
         dbname = nextname(current=self.arch_db,dbname=dbname)
@@ -127,7 +130,7 @@ class ArchiveMaster(MasterDB):
         sys.stdout.write('adding %i pvs to DB %s\n' % (len(old_data),dbname))
 
         for p in old_data:
-            if p['active'] == 'no' or p['name'] not in cache_pvnames:
+            if p['active'] == 'no' or p['name'] not in self.registry:
                 continue
             pvtable.insert(name=p['name'],
                            type=p['type'],
@@ -0,0 +1,241 @@
+#!/usr/bin/env python
+"""
+Local spool of archived values that could not be written to the database.
+
+When an insert fails, or the archive writer's queue is full, values are
+appended to a spool file instead of being lost.  Spool files are plain
+text, one value per line, in the format read by LOAD DATA INFILE:
+
+   data_table <tab> pv_id <tab> time <tab> value
+
+with tab, newline and backslash escaped with a backslash.  Files are
+fsync'ed after every sync_size values or sync_interval seconds, and are
+named for the archive database they belong to.
+
+replay() loads each spool file into a temporary table (with LOAD DATA
+LOCAL INFILE, or with inserts if the server does not allow that), and
+copies the values to the data tables, skipping any (pv_id, time) already
+there, so that replaying a file twice does not duplicate values.  A file
+is removed once its values are committed.  A file that cannot be loaded
+while the database is reachable is renamed to end in '.bad' and left for
+inspection, so that it does not hold back the files after it.
+"""
+import os
+import re
+import sys
+import glob
+import time
+import threading
+
+import config
+
+spool_dir = getattr(config, 'archive_spool_dir',
+                    os.path.join(config.logdir, 'spool'))
+
+table_name = re.compile(r'^pvdat\d+$')
+
+def format_time(ts):
+    """time as written to the spool:  as MySQLdb formats a float for an
+    insert, so that a replayed time matches the time of a value that was
+    inserted before the insert was taken as failed"""
+    return '%.15g' % ts
+
+def _escape(val):
+    return val.replace('\\', '\\\\').replace('\t', '\\t').replace('\n', '\\n').replace('\0', '\\0')
+
+_unescapes = {'\\': '\\', 't': '\t', 'n': '\n', '0': '\0'}
+def _unescape(val):
+    if '\\' not in val:
+        return val
+    out, i = [], 0
+    while i < len(val):
+        c = val[i]
+        if c == '\\' and i+1 < len(val):
+            i = i + 1
+            c = _unescapes.get(val[i], val[i])
+        out.append(c)
+        i = i + 1
+    return ''.join(out)
+
+def _connected(db):
+    "whether the SimpleDB db can still run a query"
+    try:
+        db.get_cursor().execute("select 1")
+        return True
+    except:
+        return False
+
+class ArchiveSpool:
+    """ spool files of (data_table, pv_id, ts, value) records for one
+    archive database:
+
+    >>> spool = ArchiveSpool(dbname)
+    >>> spool.append([('pvdat001', 12, time.time(), '1.0')])
+    >>> spool.replay(db)     # once the database is back
+    """
+    sql_temp = """create temporary table if not exists archive_spool
+    (data_table varchar(16) not null, pv_id int unsigned not null,
+     time double not null, value tinyblob)"""
+    sql_load = """load data local infile '%s' into table archive_spool
+    (data_table, pv_id, time, value)"""
+    sql_copy = """insert into %s.%s (pv_id,time,value)
+    select s.pv_id, s.time, s.value from archive_spool s
+    where s.data_table='%s' and not exists
+    (select 1 from %s.%s d where d.pv_id=s.pv_id and d.time=s.time)"""
+
+    def __init__(self, dbname, dirname=None, sync_size=500,
+                 sync_interval=1.0, max_size=64*1024*1024):
+        if dirname is None:
+            dirname = spool_dir
+        if not os.path.exists(dirname):
+            os.makedirs(dirname)
+        self.dbname = dbname
+        self.dirname = dirname
+        self.sync_size = sync_size
+        self.sync_interval = sync_interval
+        self.max_size = max_size
+        self.lock = threading.Lock()
+        self.fh = None
+        self.fname = None
+        self.nunsynced = 0
+        self.last_sync = 0
+        self.nspooled = 0
+        self.nreplayed = 0
+
+    def _open(self):
+        self.fname = os.path.join(self.dirname, '%s.%.6f.%i.spool' %
+                                  (self.dbname, time.time(), os.getpid()))
+        self.fh = open(self.fname, 'a')
+        self.last_sync = time.time()
+
+    def _sync(self):
+        self.fh.flush()
+        os.fsync(self.fh.fileno())
+        self.nunsynced = 0
+        self.last_sync = time.time()
+
+    def append(self, records):
+        "append (data_table, pv_id, ts, value) records to the spool"
+        lines = ['%s\t%i\t%s\t%s\n' % (table, pv_id, format_time(ts),
+                                        _escape(str(val)))
+                 for table, pv_id, ts, val in records]
+        self.lock.acquire()
+        try:
+            if self.fh is None:
+                self._open()
+            self.fh.write(''.join(lines))
+            self.nunsynced = self.nunsynced + len(lines)
+            self.nspooled = self.nspooled + len(lines)
+            if (self.nunsynced >= self.sync_size or
+                time.time() - self.last_sync >= self.sync_interval):
+                self._sync()
+            if self.fh.tell() > self.max_size:
+                self._close()
+        finally:
+            self.lock.release()
+
+    def sync(self):
+        "sync values appended more than sync_interval seconds ago"
+        if self.nunsynced == 0 or time.time() - self.last_sync < self.sync_interval:
+            return
+        self.lock.acquire()
+        try:
+            if self.fh is not None and self.nunsynced > 0:
+                self._sync()
+        finally:
+            self.lock.release()
+
+    def _close(self):
+        if self.fh is not None:
+            self._sync()
+            self.fh.close()
+        self.fh = None
+        self.fname = None
+
+    def close(self):
+        "sync and close the current spool file"
+        self.lock.acquire()
+        try:
+            self._close()
+        finally:
+            self.lock.release()
+
+    def files(self):
+        "list of spool files waiting to be replayed, oldest first"
+        out = glob.glob(os.path.join(self.dirname, '*.spool'))
+        out.sort(key=os.path.getmtime)
+        return out
+
+    def pending(self):
+        "whether there are spooled values to replay"
+        return self.fh is not None or len(self.files()) > 0
+
+    def replay(self, db):
+        """load spooled values into their data tables, using the SimpleDB db.
+        returns the number of values replayed.  A file that cannot be loaded
+        is renamed to end in '.bad' and skipped, unless the database cannot
+        be reached:  then the files are kept, and an exception is raised."""
+        self.lock.acquire()
+        try:
+            self._close()
+            fnames = self.files()
+        finally:
+            self.lock.release()
+        n = 0
+        for fname in fnames:
+            dbname = os.path.basename(fname).split('.')[0]
+            try:
+                n = n + self._load(db, fname, dbname)
+            except:
+                if not _connected(db):
+                    raise
+                sys.stdout.write('spool file %s could not be replayed: %s\n' %
+                                 (fname, repr(sys.exc_info()[1])))
+                os.rename(fname, '%s.bad' % fname)
+                continue
+            os.unlink(fname)
+        self.nreplayed = self.nreplayed + n
+        return n
+
+    def _load(self, db, fname, dbname):
+        "load one spool file, in one transaction"
+        cursor = db.get_cursor()
+        cursor.execute(self.sql_temp)
+        cursor.execute("truncate table archive_spool")
+        db.begin_transaction()
+        try:
+            try:
+                cursor.execute(self.sql_load % fname.replace('\\', '\\\\').replace("'", "\\'"))
+            except:
+                # LOAD DATA LOCAL not allowed: insert the rows
+                rows = []
+                for line in open(fname, 'r'):
+                    words = line.rstrip('\n').split('\t', 3)
+                    if len(words) == 4:
+                        rows.append((words[0], int(words[1]), float(words[2]),
+                                     _unescape(words[3])))
+                q = "insert into archive_spool (data_table,pv_id,time,value) values (%s,%s,%s,%s)"
+                for i in range(0, len(rows), 1000):
+                    cursor.executemany(q, rows[i:i+1000])
+            cursor.execute("select count(*) as n from archive_spool")
+            nrows = cursor.fetchone()['n']
+            cursor.execute("select distinct data_table from archive_spool")
+            for r in cursor.fetchall():
+                table = r['data_table']
+                if table_name.match(table) is None:
+                    continue
+                cursor.execute(self.sql_copy % (dbname, table, table, dbname, table))
+            db.commit_transaction()
+        except:
+            cursor.execute("rollback")
+            raise
+        cursor.execute("truncate table archive_spool")
+        return nrows
+
+    def report(self, clear=True):
+        "return a line reporting values spooled and replayed"
+        out = '   spool: %i values spooled, %i replayed, %i files waiting' % (
+            self.nspooled, self.nreplayed, len(self.files()))
+        if clear:
+            self.nspooled = self.nreplayed = 0
+        return out
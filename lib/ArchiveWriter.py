@@ -0,0 +1,262 @@
+#!/usr/bin/env python
+"""
+Writer thread for the Archiver:  archived values are put on a bounded
+queue, and written to the data tables by a separate thread with its own
+database connection, so that a slow insert does not hold up the
+Archiver's collection of changes.
+
+The writer takes up to batch_size records at a time from the queue, and
+writes them with one multi-row insert per data table, in one transaction.
+
+When the queue is full, put() follows the policy of the writer:
+   'block'      wait until the writer has taken records from the queue.
+   'coalesce'   keep only the latest value for each PV until the queue
+                has room again: older values for the PV are not archived.
+   'spool'      append the value to the spool (see ArchiveSpool).
+
+With a spool, values that cannot be inserted are put in the spool, and
+spooled values are replayed once inserts have worked for replay_delay
+seconds.
+"""
+import sys
+import time
+import threading
+from collections import deque
+
+from SimpleDB import SimpleDB, Connection
+
+policies = ('block', 'coalesce', 'spool')
+
+# seconds without failed inserts before replaying spooled values
+replay_delay = 60.0
+
+# after a failed insert, a lost connection is reopened, at most
+# every reconnect_delay seconds
+reconnect_delay = 5.0
+
+class ArchiveWriter(threading.Thread):
+    """ write (table, pv_id, ts, value) records to an archive database:
+
+    >>> writer = ArchiveWriter(dbname)
+    >>> writer.start()
+    >>> writer.put('pvdat001', 12, time.time(), '1.0')
+    >>> writer.stop()     # writes what is still queued
+    """
+    sql_insert = "insert into %s (pv_id,time,value) values (%%s,%%s,%%s)"
+
+    def __init__(self, dbname, maxsize=20000, batch_size=2000,
+                 policy='coalesce', spool=None, messenger=None):
+        threading.Thread.__init__(self)
+        self.setDaemon(True)
+        if policy not in policies:
+            raise ValueError("ArchiveWriter policy must be one of %s" % repr(policies))
+        if policy == 'spool' and spool is None:
+            raise ValueError("ArchiveWriter policy 'spool' needs a spool")
+        self.dbname = dbname
+        self.maxsize = maxsize
+        self.batch_size = batch_size
+        self.policy = policy
+        self.spool = spool
+        # with a spool, give up on a failed insert quickly
+        self.retries = 50
+        if spool is not None:
+            self.retries = 3
+        self.t_failed = 0
+        self.t_replay = 0
+        self.t_reconnect = 0
+        self.messenger = messenger or sys.stdout
+        # LOAD DATA LOCAL INFILE is used to replay the spool
+        self.db = SimpleDB(dbconn=Connection(dbname=dbname, local_infile=1))
+        self.db.use(dbname)
+        self.cond = threading.Condition()
+        self.records = deque()
+        # (table, pv_id) -> (ts, value): latest values while the queue is full
+        self.overflow = {}
+        self.running = True
+        self.clear_stats()
+
+    def clear_stats(self):
+        self.nput = 0
+        self.nwritten = 0
+        self.nbatches = 0
+        self.max_batch = 0
+        self.max_depth = 0
+        self.ncoalesced = 0
+        self.nblocked = 0
+        self.t_blocked = 0.0
+        self.t_insert = 0.0
+        self.max_insert = 0.0
+        self.nfailed = 0
+        self.nspooled = 0
+
+    def depth(self):
+        "number of records waiting to be written"
+        return len(self.records) + len(self.overflow)
+
+    def put(self, table, pv_id, ts, value):
+        "queue a value to be written, following the policy if the queue is full"
+        self.cond.acquire()
+        try:
+            self.nput = self.nput + 1
+            if len(self.records) >= self.maxsize:
+                if self.policy == 'spool':
+                    self.spool.append([(table, pv_id, ts, value)])
+                    self.nspooled = self.nspooled + 1
+                    return
+                if self.policy == 'coalesce':
+                    key = (table, pv_id)
+                    if key in self.overflow:
+                        self.ncoalesced = self.ncoalesced + 1
+                    self.overflow[key] = (ts, value)
+                    return
+                t0 = time.time()
+                self.nblocked = self.nblocked + 1
+                while len(self.records) >= self.maxsize and self.running:
+                    self.cond.wait(0.5)
+                self.t_blocked = self.t_blocked + time.time() - t0
+            self.records.append((table, pv_id, ts, value))
+            self.max_depth = max(self.max_depth, self.depth())
+            self.cond.notifyAll()
+        finally:
+            self.cond.release()
+
+    def _take(self):
+        """take a batch of records, waiting up to 0.5 s for some if there
+        are none.  returns an empty list if there are still none"""
+        self.cond.acquire()
+        try:
+            if self.running and self.depth() == 0:
+                self.cond.wait(0.5)
+            batch = []
+            while len(self.records) > 0 and len(batch) < self.batch_size:
+                batch.append(self.records.popleft())
+            if len(batch) < self.batch_size and len(self.overflow) > 0:
+                for (table, pv_id), (ts, value) in self.overflow.items():
+                    batch.append((table, pv_id, ts, value))
+                self.overflow = {}
+            self.cond.notifyAll()
+            return batch
+        finally:
+            self.cond.release()
+
+    def write_batch(self, batch):
+        "write a batch of records, one multi-row insert per table"
+        t0 = time.time()
+        tables = {}
+        for table, pv_id, ts, value in batch:
+            if table not in tables:
+                tables[table] = []
+            tables[table].append((pv_id, ts, value))
+        failed = []
+        try:
+            self.db.begin_transaction()
+            for table, rows in tables.items():
+                if self.db.executemany(self.sql_insert % table, rows,
+                                       retries=self.retries) is None:
+                    failed.extend([(table, pv_id, ts, value)
+                                   for pv_id, ts, value in rows])
+            self.db.commit_transaction()
+        except:
+            # not known to be committed: replaying skips values
+            # that were written
+            failed = batch
+        if len(failed) > 0:
+            self.write_failed(failed)
+        dt = time.time() - t0
+        self.nwritten = self.nwritten + len(batch)
+        self.nbatches = self.nbatches + 1
+        self.max_batch = max(self.max_batch, len(batch))
+        self.t_insert = self.t_insert + dt
+        self.max_insert = max(self.max_insert, dt)
+
+    def write_failed(self, records):
+        """put records that could not be inserted in the spool, if there is
+        one, and reopen a lost connection"""
+        self.t_failed = time.time()
+        if self.spool is None:
+            self.nfailed = self.nfailed + len(records)
+            self.messenger.write("ArchiveWriter: could not write %i values\n" % len(records))
+        else:
+            try:
+                self.spool.append(records)
+                self.nspooled = self.nspooled + len(records)
+            except (IOError, OSError):
+                self.nfailed = self.nfailed + len(records)
+                self.messenger.write("ArchiveWriter: could not spool %i values: %s\n" %
+                                     (len(records), repr(sys.exc_info()[1])))
+        self.check_connection()
+
+    def check_connection(self):
+        "reopen a lost connection, at most every reconnect_delay seconds"
+        now = time.time()
+        if now - self.t_reconnect >= reconnect_delay:
+            self.t_reconnect = now
+            self.db.reconnect()
+
+    def replay(self):
+        """replay spooled values, if inserts have worked for replay_delay
+        seconds, checking at most every replay_delay seconds"""
+        now = time.time()
+        if (self.spool is None or now - self.t_failed < replay_delay or
+            now - self.t_replay < replay_delay):
+            return
+        self.t_replay = now
+        if not self.spool.pending():
+            return
+        try:
+            n = self.spool.replay(self.db)
+            self.messenger.write("ArchiveWriter: replayed %i spooled values\n" % n)
+        except:
+            self.t_failed = time.time()
+            self.messenger.write("ArchiveWriter: could not replay spool: %s\n" %
+                                 repr(sys.exc_info()[1]))
+            self.check_connection()
+
+    def run(self):
+        while True:
+            batch = self._take()
+            if len(batch) == 0:
+                if not self.running:
+                    break
+            else:
+                self.write_batch(batch)
+            if self.spool is not None:
+                self.spool.sync()
+                self.replay()
+
+    def stop(self, timeout=30.0):
+        "stop the writer, once the values still queued are written"
+        self.cond.acquire()
+        self.running = False
+        self.cond.notifyAll()
+        self.cond.release()
+        self.join(timeout)
+        if self.spool is not None:
+            self.spool.close()
+        if self.isAlive():
+            self.messenger.write("ArchiveWriter: still writing after %.0f s\n" % timeout)
+            return
+        # the connection was opened for the writer (with local_infile):
+        # close it rather than returning it to the pool
+        self.db.conn.close()
+
+    def report(self, clear=True):
+        "return lines reporting queue depth, batch sizes, and insert times"
+        nb = max(1, self.nbatches)
+        out = ['   writer: %i queued (max %i of %i), %i values written in %i batches (mean %.0f, max %i)' %
+               (self.depth(), self.max_depth, self.maxsize, self.nwritten,
+                self.nbatches, self.nwritten/float(nb), self.max_batch),
+               '   writer: insert time %.1f ms/batch, max %.1f ms;  %i failed' %
+               (1000*self.t_insert/nb, 1000*self.max_insert, self.nfailed)]
+        if self.policy == 'block':
+            out.append('   writer: queue full %i times, blocked %.2f s' %
+                       (self.nblocked, self.t_blocked))
+        elif self.policy == 'coalesce':
+            out.append('   writer: %i values dropped by coalescing (%i waiting)' %
+                       (self.ncoalesced, len(self.overflow)))
+        if self.spool is not None:
+            out.append('   writer: %i values spooled' % self.nspooled)
+            out.append(self.spool.report(clear=clear))
+        if clear:
+            self.clear_stats()
+        return out
@@ -4,18 +4,61 @@ import time
 import sys
 import os
 import getopt
+import heapq
 
 import epics
 from SimpleDB import SimpleDB
 from MasterDB import MasterDB
+from ChangeFeed import ChangeFeedReader
+from CacheSnapshot import CacheSnapshot
+from ChangeFilter import ChangeFilter
+from ArchiveWriter import ArchiveWriter, replay_delay, reconnect_delay
+from ArchiveSpool import ArchiveSpool
+from PVRegistry import registry
 
 import config
 from util import normalize_pvname, get_force_update_time, tformat, \
-     escape_string, clean_string, SEC_DAY, MAX_EPOCH, valid_pvname, motor_fields
+     escape_string, clean_string, clean_input, SEC_DAY, MAX_EPOCH, valid_pvname, motor_fields
+
+feed_socket = getattr(config, 'feed_socket',
+                      os.path.join(config.logdir, 'cache_feed.sock'))
+
+# longest time the main loop waits for changes from the change feed
+# before a pass, so that changes held in limbo are still archived.
+# Without the feed, the cache table is read at most every feed_wait
+# seconds.
+feed_wait = 0.5
+
+# archived values are written by an ArchiveWriter thread, with a queue
+# of writer_queue values, using writer_policy when the queue is full.
+use_writer    = getattr(config, 'archive_writer', True)
+writer_queue  = getattr(config, 'archive_writer_queue', 20000)
+writer_batch  = getattr(config, 'archive_writer_batch', 2000)
+writer_policy = getattr(config, 'archive_writer_policy', 'coalesce')
+
+# values that cannot be inserted are kept in a local spool, and
+# replayed once the database is back
+use_spool = getattr(config, 'archive_spool', True)
+
+# the archiver writes its time to the info table, and checks whether it
+# has been asked to stop, every heartbeat seconds
+heartbeat = getattr(config, 'archive_heartbeat', 2.0)
+
+# settings of PVs are checked for changes every settings_check seconds
+# if the pv table has a 'modified' column, or else every 300 seconds.
+settings_check = 5.0
+
+# stale values are forced into the archive force_time seconds (18 to 21
+# hours, set per PV) after the last insert, at most force_batch per pass.
+# PVs with no value in the cache are checked again after dead_backoff
+# seconds, doubling with each failed check up to dead_backoff_max.
+force_batch      = 500
+dead_backoff     = 7200
+dead_backoff_max = SEC_DAY
 
 class Archiver:
     MIN_TIME = 100
-    sql_insert  = "insert into %s (pv_id,time,value) values (%i,%f,%s)"
+    sql_insert  = "insert into %s (pv_id,time,value) values (%%s,%%s,%%s)"
     def __init__(self,dbconn=None,**args):
 
         self.master_db = config.master_db
@@ -24,7 +67,7 @@ class Archiver:
         self.dbconn = self.db.conn
         # print 'Archiver db = ', self.db, self.db.conn
         
-        ret = self.read_master("select db from info where process='archive'")
+        ret = self.read_master("select db from %s.info where process='archive'" % self.master_db)
         self.dbname = ret[0]['db']
         # print 'Archiver:: current dbname = ', self.dbname
         # self.use_currentDB()
@@ -36,11 +79,29 @@ class Archiver:
         self.pv_table = self.db.tables['pv']
         
         self.debug  = 0
-        self.force_checktime = 0
+        self.settings_checktime = 0
+        # time of last change to the pv table, if it has a 'modified' column
+        self.track_modified = self.pv_table.check_columns(['modified'])
+        self.pv_modified = None
+        # (number, largest id) of cache rows, to see new rows
+        self.cache_state = None
         self.messenger = sys.stdout
-        self.dtime_limbo = {}
 
         self.last_collect = 0
+        # inserts of archived values: passes, rows, total and longest time
+        self.insert_stats = [0, 0, 0.0, 0.0]
+        self.feed   = None
+        self.writer = None
+        self.spool  = None
+        # last failed insert, and last attempt to reopen the connection
+        self.t_failed = 0
+        self.t_reconnect = 0
+        self.values = CacheSnapshot()
+        # heap of (time due, pvname) for forcing stale values, the PVs
+        # in it, and pvname -> number of failed checks for dead PVs
+        self.force_heap = []
+        self.force_known = set()
+        self.dead_pvs = {}
         self.pvinfo = {}
         self.pvs    = {}
         for k,v in args.items():
@@ -52,6 +113,10 @@ class Archiver:
             d.update({'last_ts': 0,'last_value':None,
                       'force_time': get_force_update_time() })
             self.pvinfo[d['name']] = d
+            if self.track_modified:
+                self.pv_modified = max(self.pv_modified, d['modified'])
+        self.filter = ChangeFilter(self.pvinfo,
+                                   use_numpy=getattr(config, 'archive_use_numpy', True))
 
 
     def exec_fetch(self,sql):
@@ -64,32 +129,63 @@ class Archiver:
         return ret
 
     def read_master(self,query):
-        self.db.use(self.master_db)
-        ret = self.exec_fetch(query)
-        if self.dbname is not None: self.db.use(self.dbname)
-        return ret
+        """query the master database.  Table names in the query must be
+        qualified with the database name, as '%s.cache' % self.master_db,
+        so that the connection can stay on the archive database."""
+        return self.exec_fetch(query)
 
     def use_currentDB(self,dbname=None):
-        ret = self.read_master("select db from info where process='archive'")
+        ret = self.read_master("select db from %s.info where process='archive'" % self.master_db)
         try:
-            self.dbname = ret[0]['db']
-            self.db.use(self.dbname)
+            dbname = ret[0]['db']
         except:
             raise IOError, 'cannot determine archive database name'
+        if dbname != self.dbname:
+            self.dbname = dbname
+            self.db.use(self.dbname)
         return self.dbname
         
     def get_cache_changes(self,dt=30):
         """ get list of name,type,value,cvalue,ts from cache """
-        return self.read_master("select * from cache where ts>%f" % (time.time()-dt))
+        return self.read_master("select * from %s.cache where ts>%f" % (self.master_db, time.time()-dt))
+
+    def read_changes(self):
+        """get changed cache values: from the Cache's change feed if it
+        is being used, or by reading recent changes from the cache table"""
+        tnow = time.time()
+        if self.feed is None:
+            dt  =  max(1.0, 2.*(tnow - self.last_collect))
+            self.last_collect = tnow
+            return self.get_cache_changes(dt=dt)
+
+        t_lastgood = self.feed.t_lastgood
+        changes, gap = self.feed.read()
+        self.last_collect = tnow
+        if gap:
+            # some feed records were missed: re-read recent table changes
+            dt = max(1.0, 2.*(tnow - t_lastgood))
+            current = {}
+            for dat in self.get_cache_changes(dt=dt):
+                current[dat['pvname']] = dat
+            for dat in changes:
+                name = dat['pvname']
+                if name not in current or dat['ts'] >= current[name]['ts']:
+                    current[name] = dat
+            changes = current.values()
+        return changes
 
     def get_cache_names(self):
-        ret = self.read_master("select pvname from cache")
+        ret = self.read_master("select pvname from %s.cache" % self.master_db)
         self.cache_names = [i['pvname'] for i in ret]
         return self.cache_names
 
     def get_cache_full(self, pv):
-        " return full information for a cached pv"
-        s = self.read_master("select * from cache where pvname='%s'" % pv)
+        """ return full information for a cached pv, from the values file
+        written by the cache if it is current, or else from the cache table"""
+        r = self.values.get(pv)
+        if r is not None:
+            return r
+        s = self.read_master("select * from %s.cache where pvname='%s'" % (self.master_db, pv))
         try:
             return s[0]
         except:
@@ -100,20 +196,46 @@ class Archiver:
     def refresh_pv_table(self):
         """refresh the pvinfo dictionary  by re-reading the database settings for pvs in the pv table
         This will cause changes in database settings (deadtime, etc) to be updated.
+        If the pv table has a 'modified' column, only rows modified since the
+        last refresh are read.  returns the list of names of changed PVs.
         """
-        for pvdata in self.pv_table.select():
+        where = '1=1'
+        if self.pv_modified is not None:
+            # rows changed in the same second as the last one seen are
+            # read again:  that does no harm
+            where = "modified >= '%s'" % self.pv_modified
+        changed = []
+        for pvdata in self.pv_table.select(where=where):
+            if 'name' not in pvdata: continue
             name = pvdata['name']
+            if self.track_modified:
+                self.pv_modified = max(self.pv_modified, pvdata['modified'])
             # already know about this pv: update pvinfo.
             if name in self.pvinfo:
                 self.pvinfo[name].update(pvdata)
+                self.filter.set_info(name)
             # look up any new pvs
             else:
                 self.get_info(name)
+            changed.append(name)
+        return changed
 
     def check_for_new_pvs(self):
-        " read pvs in cache, make sure we have them all in pvinfo dictionary" 
-        for p in self.get_cache_names():
-            self.get_info(p)
+        """ make sure all pvs in cache are in pvinfo dictionary.  The cache
+        names are read from the PV registry, and are only looked at when
+        rows have been added to or removed from the cache table.
+        returns the list of names of new PVs."""
+        registry.sync(self.db)
+        state = (len(registry), registry.max_id)
+        if state == self.cache_state:
+            return []
+        self.cache_state = state
+        new = []
+        for p in registry.names():
+            if p not in self.pvinfo:
+                self.get_info(p)
+                new.append(p)
+        return new
    
 
     def get_info(self,pvname):
@@ -145,14 +267,13 @@ class Archiver:
 n       """
         newpvs = []
         cache_values = []
-        self.get_cache_names()
+        cache_names = set(self.get_cache_names())
         pvtable_data = self.pv_table.select()
         print ' This is sync with cache ', update_vals, len(self.cache_names), len(pvtable_data)
-        self.db.use(self.master_db)
         now = time.time()
         print 'masterdb %s / data=%s' % ( self.master_db, len(pvtable_data))
         if update_vals:
-            x = self.db.exec_fetch("select pvname,value,ts from cache")
+            x = self.read_master("select pvname,value,ts from %s.cache" % self.master_db)
             current_cache = {}
             for i in x:
                 current_cache[i['pvname']] = i
@@ -160,7 +281,7 @@ n       """
         for pvdata in pvtable_data:
             name = normalize_pvname(pvdata['name'])
             
-            if name not in self.cache_names:
+            if name not in cache_names:
                 newpvs.append((name, epics.PV(name)))
             elif update_vals:  
                 r = current_cache.get(name,None)
@@ -176,11 +297,12 @@ n       """
                 if pv.connected:
                     m.add_pv(pvname)
             m.close()
-        # now switch to archiving database, and (perhaps) insert values from cache
+        # now (perhaps) insert values from cache
         if self.dbname is not None:
-            self.db.use(self.dbname)
+            newvals = {}
             for name,ts,value in cache_values:
-                self.update_value(name,ts,value)
+                newvals[name] = (ts,value)
+            self.insert_values(newvals)
         print 'Sync with Cache Done'
 
     def get_pv(self,pvname):
@@ -197,7 +319,7 @@ n       """
     def dbs_for_time(self, t0=SEC_DAY, t1=MAX_EPOCH):
         """ return list of databases with data in the given time range"""
         timerange = ( min(t0,t1) - SEC_DAY, max(t0,t1) + SEC_DAY)
-        query = "select * from runs where stop_time>=%i and start_time<=%i order by start_time"
+        query = "select * from %s.runs where stop_time>=%%i and start_time<=%%i order by start_time" % self.master_db
         r = []
         for i in self.read_master(query % timerange):
             if i['db'] not in r: r.append(i['db'])
@@ -211,11 +333,10 @@ n       """
         if info is None: return None
 
         db = self.dbs_for_time(t,t)[0]
-        self.db.use(db)
-        qpv  = "select data_table,id from pv where name ='%s'" % pvname
-        qdat = 'select time,value from %s where pv_id=%i and time<=%f order by time desc limit 1'
+        qpv  = "select data_table,id from %s.pv where name ='%s'" % (db,pvname)
+        qdat = 'select time,value from %s.%s where pv_id=%i and time<=%f order by time desc limit 1'
         i = self.db.exec_fetchone(qpv)
-        r = self.db.exec_fetchone(qdat % (i['data_table'],i['id'],t))
+        r = self.db.exec_fetchone(qdat % (db,i['data_table'],i['id'],t))
         return r['time'],r['value']
 
     def get_data(self, pvname, tmin=None, tmax=None, with_current=None):
@@ -231,10 +352,10 @@ n       """
         #
         stat   = [info]
         dat    = []
-        pvquery= "select data_table,id from pv where name ='%s'" % pvname
-        fquery = 'select time,value from %s where pv_id=%i and time<=%f order by time desc limit 1'
-        gquery = 'select time,value from %s where pv_id=%i and time>=%f order by time limit 1'       
-        squery = 'select time,value from %s where pv_id=%i and time>=%f and time<=%f order by time'
+        pvquery= "select data_table,id from %s.pv where name ='%s'"
+        fquery = 'select time,value from %s.%s where pv_id=%i and time<=%f order by time desc limit 1'
+        gquery = 'select time,value from %s.%s where pv_id=%i and time>=%f order by time limit 1'       
+        squery = 'select time,value from %s.%s where pv_id=%i and time>=%f and time<=%f order by time'
 
         needs_firstpoint = True
         tnow = time.time()
@@ -262,9 +383,9 @@ n       """
                 dbs.append(db)
         try:
             for db in dbs:
-                self.db.use(db)
-                stat.append(pvquery)
-                r = self.db.exec_fetchone(pvquery)
+                q = pvquery % (db, pvname)
+                stat.append(q)
+                r = self.db.exec_fetchone(q)
                 try:
                     table = r['data_table']
                     pvid  = r['id']
@@ -273,7 +394,7 @@ n       """
 
                 stat.append((db, table, pvid))
                 if needs_firstpoint:
-                    q = fquery % (table, pvid, tmin)
+                    q = fquery % (db, table, pvid, tmin)
                     stat.append(q)
                     r = self.db.exec_fetchone(q)
                     try:
@@ -281,12 +402,12 @@ n       """
                         needs_firstpoint = False
                     except:
                         stat.append('no data before tmin!')
-                q = squery % (table, pvid, tmin, tmax)
+                q = squery % (db, table, pvid, tmin, tmax)
                 stat.append(q)
                 for i in self.exec_fetch(q):
                     dat.append((i['time'],i['value']))
             # add value at time just after selected time range
-            r = self.db.exec_fetchone(gquery % (table,pvid,t1))
+            r = self.db.exec_fetchone(gquery % (db,table,pvid,tmax))
             try:
                 dat.append((r['time'],r['value']))
             except KeyError:
@@ -301,7 +422,6 @@ n       """
         except:
             stat.append('Exception!')
         dat.sort()
-        self.use_currentDB()
         return dat,stat
 
     def write(self,s):
@@ -326,6 +446,7 @@ n       """
             else:
                 self.write("PV %s is in database, reactivating!\n" % pvname)                
                 self.pvinfo[pvname]['active'] = 'yes'
+                self.filter.set_info(pvname)
             return None
         # create an Epics PV, check that it's valid
 
@@ -429,137 +550,195 @@ n       """
         
     def update_value(self,name,ts,val):
         "insert value into appropriate table " 
-        if val is None: return
-        if ts is None or ts < self.MIN_TIME: ts = time.time()
-       
-        self.pvinfo[name]['last_ts'] =  ts
-        self.pvinfo[name]['last_value'] =  val
+        self.insert_values({name: (ts,val)})
 
-        info = self.pvinfo[name]
+    def insert_values(self,newvals):
+        """insert values, given as pvname -> (ts, value), into their data
+        tables:  one multi-row insert per data table, all in a single
+        transaction, or queued for the writer thread if it is running.
+        returns the number of values inserted here."""
+        t0 = time.time()
+        tables = {}
+        for name,(ts,val) in newvals.items():
+            if val is None: continue
+            if ts is None or ts < self.MIN_TIME: ts = t0
+            info = self.pvinfo[name]
+            info['last_ts'] =  ts
+            info['last_value'] =  val
+            self.filter.set_last(name, ts, val)
+            if self.writer is not None:
+                self.writer.put(info['data_table'],info['id'],ts,clean_input(val))
+                continue
+            if info['data_table'] not in tables:
+                tables[info['data_table']] = []
+            tables[info['data_table']].append((info['id'],ts,clean_input(val)))
+
+        if len(tables) == 0:
+            return 0
+        retries = 50
+        if self.spool is not None:
+            retries = 3
+        records = []
+        for table,rows in tables.items():
+            records.extend([(table,pv_id,ts,val) for pv_id,ts,val in rows])
+        failed = []
         try:
-            self.db.execute(self.sql_insert % (info['data_table'],info['id'], ts,clean_string(val)))
-        except TypeError:
-            self.write("cannot update %s\n" % name)
+            self.db.begin_transaction()
+            for table,rows in tables.items():
+                if self.db.executemany(self.sql_insert % table, rows, retries=retries) is None:
+                    failed.extend([(table,pv_id,ts,val) for pv_id,ts,val in rows])
+            self.db.commit_transaction()
+        except:
+            # not known to be committed: replaying skips values
+            # that were written
+            failed = records
+        if len(failed) > 0:
+            self.insert_failed(failed)
+        nrows = len(records) - len(failed)
+
+        dt = time.time() - t0
+        stats = self.insert_stats
+        stats[0], stats[1] = stats[0] + 1, stats[1] + nrows
+        stats[2], stats[3] = stats[2] + dt, max(stats[3], dt)
+        return nrows
+
+    def insert_failed(self, records):
+        """put (table, pv_id, ts, value) records that could not be inserted
+        in the spool, if there is one, and reopen a lost connection"""
+        now = time.time()
+        self.t_failed = now
+        if self.spool is not None:
+            try:
+                self.spool.append(records)
+                records = []
+            except (IOError, OSError):
+                self.write("could not spool values: %s\n" % repr(sys.exc_info()[1]))
+        if len(records) > 0:
+            self.write("could not insert %i values\n" % len(records))
+        if now - self.t_reconnect >= reconnect_delay:
+            self.t_reconnect = now
+            self.db.reconnect()
 
     def collect(self):
         """ one pass of collecting new values, deciding what to archive"""
-        newvals, forced = {},{}
+        new_Changes = []
+        for dat in self.read_changes():
+            if dat['pvname'] not in self.pvinfo:
+                self.add_pv(dat['pvname'])
+            if dat['pvname'] in self.pvinfo:
+                new_Changes.append(dat)
+
+        # decide which changes to archive, by deadtime and deadband,
+        # and which changes held in limbo are now due
         tnow = time.time()
-        dt  =  max(1.0, 2.*(tnow - self.last_collect))
-        self.last_collect = tnow
-        new_Changes = self.get_cache_changes(dt=dt)
-        
-        for dat in new_Changes:
-            name  = dat['pvname']
-            val   = dat['value']
-            ts    = dat['ts'] or time.time()
-            if name not in self.pvinfo:
-                self.add_pv(name)
-
-            info = self.pvinfo[name]
-            if info['active'] == 'no' or name in newvals:
-                continue
-            
-            last_ts   = info['last_ts']
-            last_val  = info['last_value']
-            if last_ts is None:
-                last_ts = 0
-           
-            do_save = ((ts-last_ts) > info['deadtime'])
-            if do_save and dat['type'] in ('double','float'):
-                try:
-                    v, o = float(val), float(last_val)
-                    # do_save = abs((v-o)/max(abs(v),abs(o),1.e-12)) > abs(info['deadband'])
-                    do_save = abs(v-o) > abs(info['deadband'])
-                except:
-                    pass
-            if do_save:
-                # self.update_value(name,ts,val)
-                newvals[name] = (ts,val)
-                if name in self.dtime_limbo:
-                    self.dtime_limbo.pop(name)
-            elif (ts-last_ts) > 1.e-3:   # pv changed, but inside 'deadtime': put it in limbo!
-                self.dtime_limbo[name] = (ts,val)
-                
-        # now look through the "limbo list" and insert the most recent change
-        # iff the last insert was longer ago than the deadtime:
-        tnow = time.time()
-        # print '====== Collect: ', len(new_Changes) , len(newvals), len(self.dtime_limbo), time.ctime()
-        for name in self.dtime_limbo.keys():
-            info = self.pvinfo[name]
-            if info['active'] == 'no': continue
-            last_ts   = info['last_ts']
-            last_val  = info['last_value']
-            if (tnow - last_ts) > info['deadtime']:
-                newvals[name] = self.dtime_limbo.pop(name)
+        newvals = self.filter.select(new_Changes, tnow)
 
         n_new     = len(newvals)
-        n_forced  = 0
-        # check for stale values and re-read db settings every 5 minutes or so
-
-        if (tnow - self.force_checktime) >= 300.0:
-            # sys.stdout.write('looking for stale values, checking for new settings...%s\n'  %time.ctime() )
-            self.force_checktime = tnow
-            self.check_for_new_pvs()
-            self.refresh_pv_table()
-
-            for name, info in self.pvinfo.items():
-                last_ts  = info['last_ts']
-                last_val = info['last_value']
-                if info['active'] == 'no': continue
-                ftime = info['force_time']
-                try:
-                    force = tnow-last_ts > ftime
-                except:
-                    print 'Cannot Figure out whether to force recording??'
-                    print tnow, last_ts, ftime
-                    print 'They should all be floats???'
-                    force = False
-                    
-                if force:
-                    r = self.get_cache_full(name)
-                    if r['type'] is None and r['value'] is None: # an empty / non-cached PV?
-                        try:
-                            test_pv = epics.PV(name)
-                            test_pv.connect()
-                            # if PV is still not connected, set time
-                            # to wait 2 hours before checking again.
-                            if (test_pv is None or not test_pv.connected):
-                                self.pvinfo[name]['last_ts'] = 7200+tnow-ftime
-                                self.write(" PV not connected: %s\n" % name)
-                            else:
-                                r['value'] = test_pv.value
-                            test_pv.disconnect()
-                        except:
-                            pass
-                    else:
-                        if name not in newvals:
-                            newvals[name] = (tnow,str(r['value']))
-                            n_forced = n_forced + 1
-
-        for name,data in newvals.items():
-            self.update_value(name,data[0],data[1])
+        # look for new PVs and changed db settings, and schedule
+        # checks for stale values of new PVs
+        dt = settings_check
+        if not self.track_modified: dt = 300.0
+        if (tnow - self.settings_checktime) >= dt:
+            # sys.stdout.write('checking for new settings...%s\n'  %time.ctime() )
+            self.settings_checktime = tnow
+            changed = self.check_for_new_pvs() + self.refresh_pv_table()
+            if len(self.force_known) == 0:
+                changed = None
+            self.schedule_force_checks(changed)
+
+        # force stale values into the archive, as they become due
+        n_forced = self.force_stale(tnow, newvals)
+
+        self.insert_values(newvals)
 
         # self.db.commit_transaction()
         return n_new,n_forced
 
+    def schedule_force_checks(self, names=None):
+        """add PVs not yet scheduled to the heap of checks for stale values,
+        looking at the PVs in names, or at all PVs"""
+        if names is None:
+            names = self.pvinfo.keys()
+        for name in names:
+            info = self.pvinfo.get(name, None)
+            if (info is None or name in self.force_known or
+                info['active'] == 'no'):
+                continue
+            self.force_known.add(name)
+            due = (info['last_ts'] or 0) + info['force_time']
+            heapq.heappush(self.force_heap, (due, name))
+
+    def read_cache_rows(self, names):
+        """return dict of pvname -> cache row for a list of PVs: from
+        the values file of the cache, or else with one query per 500 PVs"""
+        rows, missing = {}, []
+        for name in names:
+            r = self.values.get(name)
+            if r is not None:
+                rows[name] = r
+            else:
+                missing.append(name)
+        q = "select pvname,type,value,ts from %s.cache where pvname in (%%s)" % self.master_db
+        for i in range(0, len(missing), 500):
+            names = ','.join([clean_string(n) for n in missing[i:i+500]])
+            for r in self.read_master(q % names):
+                if 'pvname' in r:
+                    rows[r['pvname']] = r
+        return rows
+
+    def force_stale(self, tnow, newvals):
+        """add current cache values of PVs with no insert for longer than
+        their force_time to newvals, taking PVs from the heap of checks
+        as they become due.  PVs with no cached value are checked again
+        later, backing off.  returns the number of values added."""
+        due = []
+        heap = self.force_heap
+        while len(heap) > 0 and heap[0][0] <= tnow and len(due) < force_batch:
+            t, name = heapq.heappop(heap)
+            info = self.pvinfo.get(name, None)
+            if info is None or info['active'] == 'no':
+                self.force_known.discard(name)
+                continue
+            tforce = (info['last_ts'] or 0) + info['force_time']
+            if name in newvals or tforce > tnow:
+                # archived since this check was scheduled
+                heapq.heappush(heap, (max(tforce, tnow+1), name))
+            else:
+                due.append(name)
+        if len(due) == 0:
+            return 0
+
+        n_forced = 0
+        rows = self.read_cache_rows(due)
+        for name in due:
+            r = rows.get(name, None)
+            if r is None or (r['type'] is None and r['value'] is None):
+                # an empty / non-cached PV: check again later
+                nfail = self.dead_pvs.get(name, 0)
+                self.dead_pvs[name] = nfail + 1
+                wait = min(dead_backoff * 2**nfail, dead_backoff_max)
+                heapq.heappush(heap, (tnow + wait, name))
+                if nfail == 0:
+                    self.write(" PV not connected: %s\n" % name)
+                continue
+            self.dead_pvs.pop(name, None)
+            newvals[name] = (tnow, str(r['value']))
+            n_forced = n_forced + 1
+            heapq.heappush(heap, (tnow + self.pvinfo[name]['force_time'], name))
+        return n_forced
+
     def set_pidstatus(self, pid=None, status='unknown'):
-        self.db.use(self.master_db)
         if status in ('running','offline','stopping','unknown'):
-            self.db.execute("update info set status='%s' where process='archive'" % status)
+            self.db.execute("update %s.info set status='%s' where process='archive'" % (self.master_db, status))
         if pid is not None:
-            self.db.execute("update info set pid=%i where process='archive'" % int(pid))
-        self.db.use(self.dbname)
+            self.db.execute("update %s.info set pid=%i where process='archive'" % (self.master_db, int(pid)))
 
     def set_infotime(self,ts):
-        self.db.use(self.master_db)
-        self.db.execute("update info set ts=%f,datetime='%s' where process='archive'" % (ts,time.ctime(ts)))
-        self.db.use(self.dbname)
+        self.db.execute("update %s.info set ts=%f,datetime='%s' where process='archive'" %
+                        (self.master_db, ts, time.ctime(ts)))
 
     def get_pidstatus(self):
-        self.db.use(self.master_db)
-        ret = self.db.exec_fetchone("select * from info where process='archive'")
-        self.db.use(self.dbname)
+        ret = self.db.exec_fetchone("select pid,status from %s.info where process='archive'" % self.master_db)
         return ret['pid'], ret['status']
 
     def get_nchanged(self,minutes=10,limit=None):
@@ -585,8 +764,22 @@ n       """
         self.use_currentDB()
 
         self.last_collect = t0
+        try:
+            self.feed = ChangeFeedReader(feed_socket)
+        except:
+            self.write("cannot listen for cache changes on %s, will poll cache table\n" % feed_socket)
+            self.feed = None
         self.write( 'connecting to database %s ... \n' % self.dbname)
         self.sync_with_cache(update_vals=True)
+        if use_spool:
+            self.spool = ArchiveSpool(self.dbname)
+        if use_writer:
+            self.writer = ArchiveWriter(self.dbname, maxsize=writer_queue,
+                                        batch_size=writer_batch,
+                                        policy=writer_policy,
+                                        spool=self.spool,
+                                        messenger=self.messenger)
+            self.writer.start()
 
         self.write("done. DB connection took %6.3f sec\n" % (time.time()-t0))
         self.write("connecting to %i Epics PVs ... \n" % ( len(self.pvinfo) ))
@@ -600,12 +793,20 @@ n       """
         n_changed = 0
         n_forced  = 0
         t_lastlog = 0
+        t_heartbeat = 0
+        t_replay = 0
         mlast = -1
         msg = "%s: %i new, %i forced entries. (%i)\n"
 
         while is_collecting:
             try:
                 n_loop = n_loop + 1
+                if self.feed is not None:
+                    self.feed.wait(feed_wait)
+                else:
+                    dt = feed_wait - (time.time() - self.last_collect)
+                    if dt > 0:
+                        time.sleep(dt)
                 n1,n2 = self.collect()
                 n_changed = n_changed + n1
                 n_forced  = n_forced  + n2
@@ -616,22 +817,56 @@ n       """
 
                 if tsec < 2 and tmin != mlast and tmin % 5 == 0:
                     self.write(msg % (time.ctime(), n_changed, n_forced, n_loop))
+                    npass, nrows, tins, tmax = self.insert_stats
+                    if npass > 0:
+                        self.write("   %i values inserted in %i passes: %.1f ms/pass, max %.1f ms, %.0f values/s\n" %
+                                   (nrows, npass, 1000*tins/npass, 1000*tmax, nrows/max(tins,1.e-6)))
+                    self.insert_stats = [0, 0, 0.0, 0.0]
+                    if self.writer is not None:
+                        self.write('%s\n' % '\n'.join(self.writer.report()))
+                    elif self.spool is not None:
+                        self.write('%s\n' % self.spool.report())
                     sys.stdout.flush()
                     n_changed = 0
                     n_forced  = 0
                     n_loop  =  0
                     t_lastlog = tnow
                     mlast = tmin
-                self.set_infotime(tnow)
 
             except KeyboardInterrupt:
                 sys.stderr.write('Interrupted by user.\n')
-                return None
-            
-            masterpid, status = self.get_pidstatus()
-
-            if (status in ('stopping','offline')) or (masterpid != mypid):
-                self.set_pidstatus(status='offline')
-                is_collecting = False
+                break
 
+            if tnow - t_heartbeat >= heartbeat:
+                t_heartbeat = tnow
+                self.set_infotime(tnow)
+                masterpid, status = self.get_pidstatus()
+                if (status in ('stopping','offline')) or (masterpid != mypid):
+                    self.set_pidstatus(status='offline')
+                    is_collecting = False
+
+            # without a writer thread, sync and replay spooled values here
+            if self.writer is None and self.spool is not None:
+                self.spool.sync()
+            if (self.writer is None and self.spool is not None and
+                tnow - t_replay >= replay_delay and
+                tnow - self.t_failed >= replay_delay):
+                t_replay = tnow
+                if self.spool.pending():
+                    try:
+                        n = self.spool.replay(self.db)
+                        self.write("replayed %i spooled values\n" % n)
+                    except:
+                        self.t_failed = time.time()
+                        self.write("could not replay spool: %s\n" % repr(sys.exc_info()[1]))
+
+        if self.feed is not None:
+            self.feed.close()
+            self.feed = None
+        if self.writer is not None:
+            self.writer.stop()
+            self.writer = None
+        if self.spool is not None:
+            self.spool.close()
+            self.spool = None
         return None
@@ -0,0 +1,154 @@
+#!/usr/bin/env python
+"""
+Lightweight Channel Access channels for the Cache, built directly on
+epics.ca instead of epics.PV.
+
+A Channel keeps only what the Cache needs, in __slots__:  name, chid,
+connection state, native type and count, latest value and timestamp,
+enum strings, and the monitor subscription.  It provides the part of the
+epics.PV interface that the Cache uses, so the Cache can use either.
+
+Monitor callbacks are called with char_value only for enum and string
+channels.  For other types the Cache writes str(value), and the
+char_value property formats the latest value when asked.
+
+Select it with cache_engine = 'ca' in config.py.
+"""
+import time
+from epics import ca, dbr
+
+_enum_types   = (dbr.ENUM, dbr.TIME_ENUM, dbr.CTRL_ENUM)
+_string_types = (dbr.STRING, dbr.TIME_STRING, dbr.CTRL_STRING)
+
+class Channel(object):
+    """ a monitored Channel Access channel, with the subset of the
+    epics.PV interface used by the Cache:
+
+      pvname, chid, connected, type, count, value, char_value,
+      timestamp, enum_strs, callbacks, auto_monitor,
+      add_callback(), clear_callbacks(), get(), get_ctrlvars(),
+      disconnect()
+
+    auto_monitor is False for no monitor, or a monitor mask (True for
+    the default mask).
+    """
+    __slots__ = ('pvname', 'chid', 'connected', 'ftype', 'ntype', 'count',
+                 'value', 'timestamp', 'enum_strs', 'callbacks', 'auto_monitor',
+                 'connection_callback', '_monref')
+
+    def __init__(self, pvname, callback=None, auto_monitor=True,
+                 connection_callback=None, **kw):
+        self.pvname = pvname.strip()
+        self.connected = False
+        self.ftype = None
+        self.ntype = None
+        self.count = None
+        self.value = None
+        self.timestamp = None
+        self.enum_strs = None
+        self.callbacks = []
+        if callback is not None:
+            self.callbacks.append(callback)
+        if auto_monitor is True:
+            auto_monitor = dbr.DBE_VALUE|dbr.DBE_ALARM
+        self.auto_monitor = auto_monitor
+        self.connection_callback = connection_callback
+        self._monref = None
+        self.chid = None
+        self.chid = ca.create_channel(self.pvname, connect=False, auto_cb=False,
+                                      callback=self._onConnect)
+
+    def __repr__(self):
+        return "<Channel '%s', type=%s, connected=%s>" % (self.pvname, self.type,
+                                                          self.connected)
+
+    @property
+    def type(self):
+        "native type name, as for epics.PV: 'double', 'string', ..."
+        if self.ntype is None:
+            return None
+        return dbr.Name(self.ntype).lower()
+
+    @property
+    def char_value(self):
+        "string value, formatted when asked for"
+        return self._format(self.value)
+
+    def _format(self, value):
+        if value is None:
+            return None
+        if self.ftype in _enum_types and self.enum_strs:
+            try:
+                return self.enum_strs[int(value)]
+            except (IndexError, ValueError, TypeError):
+                pass
+        if self.count is not None and self.count > 1 and \
+               self.ftype not in _string_types:
+            return '<array size=%i, type=%s>' % (self.count, self.type)
+        return str(value)
+
+    def _onConnect(self, pvname=None, chid=None, conn=True, **kw):
+        self.connected = conn
+        if self.chid is None:
+            # connection callback called from within create_channel()
+            self.chid = chid
+        if conn:
+            self.ntype = ca.field_type(self.chid)
+            self.ftype = ca.promote_type(self.chid, use_time=True)
+            self.count = ca.element_count(self.chid)
+            if self.auto_monitor and self._monref is None:
+                self._monref = ca.create_subscription(self.chid, use_time=True,
+                                                      mask=self.auto_monitor,
+                                                      callback=self._onChanges)
+        if self.connection_callback is not None:
+            self.connection_callback(pvname=self.pvname, conn=conn)
+
+    def _onChanges(self, value=None, timestamp=None, **kw):
+        self.value = value
+        self.timestamp = timestamp
+        if len(self.callbacks) == 0:
+            return
+        cval = None
+        if self.ftype in _enum_types or self.ftype in _string_types:
+            cval = self._format(value)
+        for cb in self.callbacks:
+            cb(pvname=self.pvname, value=value, char_value=cval,
+               timestamp=timestamp)
+
+    def add_callback(self, callback):
+        self.callbacks.append(callback)
+
+    def clear_callbacks(self):
+        self.callbacks = []
+
+    def get(self, as_string=False, timeout=1.0):
+        "read the value (not waiting for a monitor)"
+        if not self.connected:
+            return None
+        val = ca.get(self.chid, timeout=timeout)
+        if val is not None:
+            self.value = val
+            self.timestamp = time.time()
+        if as_string:
+            return self._format(val)
+        return val
+
+    def get_ctrlvars(self):
+        "read enum strings for an enum channel"
+        if self.connected and self.ftype in _enum_types:
+            self.enum_strs = ca.get_enum_strings(self.chid)
+        return {'enum_strs': self.enum_strs}
+
+    def disconnect(self):
+        self.connected = False
+        self.callbacks = []
+        if self._monref is not None:
+            ca.clear_subscription(self._monref[2])
+            self._monref = None
+        # like epics.PV, drop the channel from the ca cache, so that a new
+        # channel for this name will get a new chid
+        try:
+            ca._cache[ca.current_context()].pop(self.pvname, None)
+        except (AttributeError, KeyError):
+            pass
+        ca.clear_channel(self.chid)
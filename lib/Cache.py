@@ -3,13 +3,200 @@
 import os
 import time
 import sys
+import select
+import glob
+import threading
+import signal
+import cPickle
+
+try:
+    import json
+except ImportError:
+    import simplejson as json
 
 import epics
+import config
 from debugtime import debugtime
 from MasterDB import MasterDB
+from ChangeFeed import ChangeFeedPublisher
+from ControlSocket import ControlServer
+from CacheSnapshot import values_file, write_values
+from Scheduler import Scheduler
+
+from util import clean_input, clean_string, safe_string, motor_fields, \
+     normalize_pvname, tformat, valid_pvname, pv_shard, SEC_DAY
+
+feed_socket = getattr(config, 'feed_socket',
+                      os.path.join(config.logdir, 'cache_feed.sock'))
+
+# write-behind buffer: changed values are written to the cache table
+# every flush_interval seconds, or sooner if flush_size are waiting.
+flush_interval = getattr(config, 'cache_flush_interval', 0.5)
+flush_size     = getattr(config, 'cache_flush_size', 500)
+
+# per-PV acquisition policies: PVs without a policy use a plain
+# monitor. min_interval is the shortest rate-limit or scan interval.
+default_policy = ('monitor', 0)
+min_interval   = 0.1
+
+# Channel Access monitor masks, given as names joined by '+'.  PVs without
+# their own mask in the cache table use default_mask.  'log' (also called
+# 'archive') uses the archive deadband (ADEL) of the record, 'value' uses
+# the monitor deadband (MDEL), 'alarm' sends alarm state changes.
+mask_bits = {'value': epics.dbr.DBE_VALUE, 'log': epics.dbr.DBE_LOG,
+             'archive': epics.dbr.DBE_LOG, 'alarm': epics.dbr.DBE_ALARM,
+             'property': epics.dbr.DBE_PROPERTY}
+default_mask = getattr(config, 'cache_monitor_mask', 'log+alarm')
+
+def monitor_mask(mask=None):
+    """monitor mask (an int) for a string like 'log+alarm'.
+    Unknown or empty masks give the default mask"""
+    if not mask:
+        mask = default_mask
+    out = 0
+    for word in mask.lower().split('+'):
+        out = out | mask_bits.get(word.strip(), 0)
+    if out == 0 and mask != default_mask:
+        return monitor_mask(default_mask)
+    return out
+
+def char_value(pv, value):
+    "string representation of a value read for a PV"
+    if pv.type in ('enum', 'time_enum', 'ctrl_enum') and pv.enum_strs:
+        try:
+            return pv.enum_strs[int(value)]
+        except (IndexError, ValueError, TypeError):
+            pass
+    return str(value)
+
+def received_value(pv):
+    """(value, char_value) last received for a PV, or (None, None).
+    This does not read the PV: the value of an epics.PV with no value
+    yet makes a get(), waiting for the reply"""
+    args = getattr(pv, '_args', None)
+    if args is None:
+        return pv.value, pv.char_value
+    value = args.get('value', None)
+    if value is None:
+        return None, None
+    cval = args.get('char_value', None)
+    if cval is None:
+        cval = char_value(pv, value)
+    return value, cval
+
+# periods (in seconds) of the periodic tasks of the Cache main loop
+task_periods = {'requests': 15, 'alerts': 15, 'heartbeat': 5,
+                'settings': 300, 'status': 300, 'stats': 60,
+                'snapshot': 300, 'deferred': 60, 'values': 5}
+task_periods.update(getattr(config, 'cache_task_periods', {}))
+
+# longest time the main loop waits for changes when idle
+max_idle = 1.0
+
+# per-PV statistics are written to this file (with the worker index
+# before '.json' for workers of a sharded cache) by the 'stats' task
+stats_file = getattr(config, 'cache_stats_file',
+                     os.path.join(config.logdir, 'cache_stats.json'))
+
+# PV metadata saved for a warm restart of the cache, again with the worker
+# index before the extension for workers.  PVs not connected for dead_time
+# seconds are connected only after startup, deferred_batch at a time.
+snapshot_file  = getattr(config, 'cache_snapshot_file',
+                         os.path.join(config.logdir, 'cache_meta.pkl'))
+dead_time      = getattr(config, 'cache_dead_time', 3*SEC_DAY)
+deferred_batch = 200
+
+def _shard_file(fname, shard):
+    "file name for a cache worker: the shard index goes before the extension"
+    if shard is None:
+        return fname
+    base, ext = os.path.splitext(fname)
+    return '%s.%i%s' % (base, shard[0], ext)
+
+class PVStats(object):
+    """ activity counters for one cached PV: monitor callbacks,
+    values flushed to the cache table and their size, time of the last
+    change, number of disconnects, and time connected"""
+    __slots__ = ('callbacks', 'flushed', 'nbytes', 'last_change',
+                 'disconnects', 'uptime', 't_connect')
+    def __init__(self):
+        self.callbacks = self.flushed = self.nbytes = 0
+        self.disconnects = 0
+        self.last_change = 0
+        self.uptime = 0
+        self.t_connect = None
+
+    def as_dict(self, now):
+        uptime = self.uptime
+        if self.t_connect is not None:
+            uptime = uptime + now - self.t_connect
+        return {'callbacks': self.callbacks, 'flushed': self.flushed,
+                'bytes': self.nbytes, 'last_change': self.last_change,
+                'disconnects': self.disconnects, 'uptime': uptime,
+                'connected': self.t_connect is not None}
+
+def read_stats(fname=None):
+    """read and merge the per-PV statistics files written by cache
+    processes, ignoring files much older than the newest one (left by
+    a cache run with a different number of workers).
+    returns (time written, start time, {pvname: stats})"""
+    if fname is None:
+        fname = stats_file
+    pattern = '%s*%s' % os.path.splitext(fname)
+    files = []
+    for fn in glob.glob(pattern):
+        try:
+            files.append(json.load(open(fn, 'r')))
+        except (IOError, ValueError):
+            pass
+    t_write, t_start, pvs = 0, None, {}
+    if len(files) == 0:
+        return t_write, t_start, pvs
+    t_write = max([dat['time'] for dat in files])
+    for dat in files:
+        if dat['time'] < t_write - 5*task_periods['stats']:
+            continue
+        if t_start is None or dat['start_time'] < t_start:
+            t_start = dat['start_time']
+        for pvname, st in dat['pvs'].items():
+            pvs[str(pvname)] = st
+    return t_write, t_start, pvs
 
-from util import clean_input, clean_string, motor_fields, \
-     normalize_pvname, tformat, valid_pvname
+def stats_report(n=20, sortby='bytes', fname=None):
+    """return a report (list of text lines) of the n PVs with the
+    highest statistic sortby (one of 'bytes', 'flushed', 'callbacks',
+    'disconnects')"""
+    t_write, t_start, pvs = read_stats(fname=fname)
+    if len(pvs) == 0:
+        return ['no cache statistics found']
+    dt = max(1.0, t_write - t_start)
+    tmp = [(st.get(sortby, 0), name) for name, st in pvs.items()]
+    tmp.sort()
+    tmp.reverse()
+    out = ['%i PVs, statistics written %s, cache started %s' %
+           (len(pvs), time.ctime(t_write), time.ctime(t_start)),
+           ' PV                               callbacks/s flushed/s  bytes/s  disconn  uptime(%)  last change']
+    fmt = ' %-34.34s %9.3f %9.3f %8.1f %8i %9.1f   %s'
+    for val, name in tmp[:n]:
+        st = pvs[name]
+        last = 'never'
+        if st['last_change'] > 0:
+            last = tformat(t=st['last_change'], format="%Y-%m-%d %H:%M:%S")
+        out.append(fmt % (name, st['callbacks']/dt, st['flushed']/dt,
+                          st['bytes']/dt, st['disconnects'],
+                          100.0*st['uptime']/dt, last))
+    return out
+
+# PV objects used by the Cache: epics.PV, or with cache_engine = 'ca',
+# the lighter Channel objects built directly on epics.ca
+cache_engine = getattr(config, 'cache_engine', 'pv')
+if cache_engine == 'ca':
+    from CAEngine import Channel as PV
+else:
+    PV = epics.PV
+
+# time to wait for PVs to connect when the cache starts
+connect_timeout = getattr(config, 'cache_connect_timeout', 30.0)
 
 # def add_pv_to_cache(pvname=None,cache=None,**kw):
 #     """ add a PV to the Cache and Archiver
@@ -27,7 +214,44 @@ from util import clean_input, clean_string, motor_fields, \
 #     cache.add_pv(pvname)
 #     cache.close()
 
-def add_pvfile(fname):
+def _connect_all(pvnames, timeout=5.0, label='PVs'):
+    """create PVs for a list of names, all at once, and wait for them to
+    connect, printing progress.  returns a dictionary of connected PVs"""
+    t0 = time.time()
+    pvs = dict([(nam, epics.PV(nam, auto_monitor=False)) for nam in pvnames])
+    nconn, tlast = 0, t0
+    while len(pvs) > 0 and time.time() - t0 < timeout:
+        epics.poll(evt=1.e-3, iot=0.1)
+        nconn = len([p for p in pvs.values() if p.connected])
+        if nconn == len(pvs):
+            break
+        if time.time() - tlast > 5.0:
+            tlast = time.time()
+            print '   %s: %i of %i connected' % (label, nconn, len(pvs))
+    dt = max(time.time() - t0, 1.e-3)
+    print '   %s: %i of %i connected in %.1f s (%.0f PVs/s)' % (label, nconn,
+                                                            len(pvs), dt, nconn/dt)
+    out = {}
+    for nam, pv in pvs.items():
+        if pv.connected:
+            out[nam] = pv
+        else:
+            pv.disconnect()
+    return out
+
+def _get_all(pvs, timeout=1.0):
+    """get values for a dictionary of connected PVs: all requests are sent
+    before waiting for any reply.  returns a dictionary of values"""
+    ca = epics.ca
+    for pv in pvs.values():
+        ca.get(pv.chid, wait=False)
+    ca.poll(evt=1.e-3, iot=timeout)
+    out = {}
+    for nam, pv in pvs.items():
+        out[nam] = ca.get_complete(pv.chid, timeout=timeout)
+    return out
+
+def add_pvfile(fname, timeout=None):
     """
     Read a file that lists PVs and add them (if needed) to the PV cache
     -- they will be automatically added to the running archives asap.
@@ -43,63 +267,131 @@ def add_pvfile(fname):
        2. Putting multiple PVs on a single line (space or comma delimited)
           will add all PVs on that line and also give all pairs of PVs
           on the line a 'pair score' of 10.
-          
+
+    All PVs are connected at once (waiting at most timeout seconds, default
+    cache_connect_timeout), and motor records are found by reading the .RTYP
+    of all candidate PVs at once.  PVs that connect are inserted into the
+    cache table and requested for the running cache in batches, and all
+    pair scores are set at the end.
     """
     print 'Adding PVs listed in file ', fname
+    if timeout is None:
+        timeout = connect_timeout
+    t0 = time.time()
     f = open(fname,'r')
     lines = f.readlines()
     f.close()
 
-    cache  = Cache()
-    pairs = []
+    groups, names, seen = [], [], set()
     for line in lines:
-        line[:-1].strip()
+        line = line.strip()
         if len(line)<2 or line.startswith('#'): continue
-        words = line.replace(',',' ').split()
-        t0 = time.time()
-
-        # note that we suppress the setting of pair scores here
-        # until we have enough PVs installed.
+        words = [normalize_pvname(w) for w in line.replace(',',' ').split()]
+        words = [w for w in words if valid_pvname(w)]
+        if len(words) > 1:
+            groups.append(words)
         for pvname in words:
-            fields = cache.add_pv(pvname, set_motor_pairs=False)
-            if len(fields) > 1:
-                pairs.append(fields)
-        cache.process_requests()
-        epics.poll()
+            if pvname not in seen:
+                seen.add(pvname)
+                names.append(pvname)
 
-        t1 = time.time()-t0
-        if len(words) > 1:
-            pairs.append(tuple(words[:]))
+    cache  = Cache()
+    cache.registry.sync(cache.db)
+    newnames = [n for n in names if n not in cache.registry]
+    print ' %i PVs listed, %i not yet in cache' % (len(names), len(newnames))
+    pvs = _connect_all(newnames, timeout=timeout, label='PVs')
 
-        t2 = time.time()-t0
-        print ' Add PVs: [ %s ] ' % (' '.join(words))
+    # find motor records, and add all their motor fields
+    rtyp_names = {}
+    for pvname, pv in pvs.items():
+        prefix = pvname
+        if pvname.endswith('.VAL'):
+            prefix = pvname[:-4]
+        if '.' not in prefix and pv.type == 'double':
+            rtyp_names['%s.RTYP' % prefix] = prefix
+    rtyp_pvs = _connect_all(rtyp_names.keys(), timeout=min(timeout, 5.0),
+                            label='record types')
+    fields = []
+    for rtyp, val in _get_all(rtyp_pvs).items():
+        if val == 'motor':
+            group = ["%s%s" % (rtyp_names[rtyp], i) for i in motor_fields]
+            groups.append(group)
+            for pvname in group:
+                if pvname not in seen and pvname not in cache.registry:
+                    seen.add(pvname)
+                    fields.append(pvname)
+    if len(fields) > 0:
+        pvs.update(_connect_all(fields, timeout=min(timeout, 5.0),
+                                label='motor fields'))
+    for pv in rtyp_pvs.values():
+        pv.disconnect()
 
-        if len(pairs) > 100:
-            print 'set a few pair scores...'
-            for i in range(20):
-                words = pairs.pop(0)
-                cache.set_allpairs(words, score=10)
-        
-    print 'Waiting for all pvs requested to be put in cache....'
-    # now wait for all requests to be fulfilled, and then set the remaining pair scores
+    # insert cache rows, and requests for the running cache to monitor them
+    now = time.time()
+    cache_rows, req_rows = [], []
+    for pvname, pv in pvs.items():
+        cache_rows.append("(%s,%s)" % (safe_string(pvname), safe_string(pv.type)))
+        req_rows.append("(%s,'add',%f)" % (safe_string(pvname), now))
+        pv.disconnect()
+    q_cache = "insert into cache (pvname,type) values %s"
+    q_req   = "insert into requests (pvname,action,ts) values %s"
+    cache.db.set_autocommit(1)
+    for i in range(0, len(cache_rows), flush_size):
+        cache.db.execute(q_cache % ','.join(cache_rows[i:i+flush_size]))
+        cache.db.execute(q_req % ','.join(req_rows[i:i+flush_size]))
+    print ' inserted %i PVs into cache' % len(cache_rows)
 
-    req_table= cache.db.tables['requests']
-    requests_pending = True
-    
-    while requests_pending:
-        pending_requests  = req_table.select()
-        requests_pending = len(pending_requests) > 2
-        time.sleep(1)
-        
-    # print 'Finally, set remaining of pair scores:'
-    while pairs:
-        words = pairs.pop(0)
-        cache.set_allpairs(words,score=10)
+    npairs = cache.set_bulk_pairs(groups, score=10)
+    print ' set %i pair scores' % npairs
     cache.close()
 
-    time.sleep(0.01)
-    epics.poll(evt=0.01,iot=5.0)
-    
+    dt = max(time.time() - t0, 1.e-3)
+    print ' added %i PVs in %.1f s (%.0f PVs/s)' % (len(cache_rows), dt,
+                                                   len(cache_rows)/dt)
+    epics.poll(evt=0.01,iot=1.0)
+
+class ConnectionTracker:
+    """ keep track of which cached PVs are not connected, using
+    connection callbacks rather than scanning all PVs.
+
+    onConnect is used as the connection callback for PVs.  It only notes
+    the change: update() applies the noted changes outside of the Channel
+    Access callback, and returns the PVs that connected or disconnected.
+    """
+    def __init__(self, event=None):
+        self.events = []
+        self.disconnected = set()
+        self.event = event
+
+    def onConnect(self, pvname=None, conn=None, **kw):
+        self.events.append((pvname, conn))
+        if self.event is not None:
+            self.event.set()
+
+    def expect(self, pvname):
+        "note a PV that has been created but is not yet connected"
+        self.disconnected.add(pvname)
+
+    def forget(self, pvname):
+        self.disconnected.discard(pvname)
+
+    def update(self):
+        """apply connection changes, returns lists of
+        (newly connected, newly disconnected) PV names"""
+        connected, disconnected = [], []
+        while len(self.events) > 0:
+            pvname, conn = self.events.pop(0)
+            if conn and pvname in self.disconnected:
+                self.disconnected.discard(pvname)
+                connected.append(pvname)
+            elif not conn and pvname not in self.disconnected:
+                self.disconnected.add(pvname)
+                disconnected.append(pvname)
+        return connected, disconnected
+
+    def count(self):
+        "number of PVs not connected"
+        return len(self.disconnected)
 
 class Cache(MasterDB):
     """ class for access to Master database as the Meta table of Archive databases
@@ -107,22 +399,70 @@ class Cache(MasterDB):
 
     null_pv_value = {'value':None,'ts':0,'cvalue':None,'type':None}
     q_getfull     = "select value,cvalue,type,ts from cache where pvname='%s'"
+    sql_upsert    = """insert into cache (id,pvname,value,cvalue,ts) values %s
+    on duplicate key update value=values(value),cvalue=values(cvalue),ts=values(ts)"""
 
-    def __init__(self,dbconn=None,pidfile='/tmp/cache.pid', **kw):
+    def __init__(self,dbconn=None,pidfile='/tmp/cache.pid', shard=None, **kw):
         # use of Master assumes that there are not a lot of new PVs being
         # added to the cache so that this lookup of PVs can be done once.
         MasterDB.__init__(self,dbconn=dbconn,**kw)
 
+        # a worker of a CacheCoordinator caches only the PVs in its shard,
+        # given as (index, nshards), and gets requests over worker_pipe.
+        self.shard = shard
+        self.worker_pipe = None
+        self._cmdbuff = ''
+
         self.db.set_autocommit(1)
         self.pid   = self.get_cache_pid()
         self.pidfile = pidfile
         self._table_alerts = self.db.tables['alerts']
         self.pvs   = {}
         self.data  = {}
+        self._backbuff  = {}
         self.alert_data = {}
+        # set by callbacks to wake up the main loop
+        self.wakeup = threading.Event()
+        self.conn_tracker = ConnectionTracker(event=self.wakeup)
+        self.suspended = set()
+        self.policies = {}
+        self.masks = {}
+        self.stats = {}
+        self.t_start = time.time()
+        # metadata from the last snapshot: pvname -> (type, count,
+        # enum_strs, value, ts, connected, last time connected)
+        self.meta = {}
+        self.deferred = []
+        self._seed_values = {}
+        self._held = {}
+        self._last_accept = {}
+        self._scan_next = {}
+        # pvname -> {'deadline': time, 'rids': [request ids]} for PVs
+        # requested for the cache and waiting to connect
+        self.pending_adds = {}
+        # current values, pvname -> (value, cvalue, ts), for the values
+        # file read by web processes
+        self.current = {}
+        self._current_loaded = False
         self.db.set_autocommit(0)
         self.last_update = 0
-        
+        self.last_flush  = 0
+        self.feed = None
+        self.control = None
+        self.scheduler = None
+        # set by the SIGTERM handler:  the main loop then exits
+        self.terminated = False
+
+    def get_pvnames(self):
+        """ generate self.pvnames, holding only the PVs in this shard
+        for a Cache run as a worker process"""
+        MasterDB.get_pvnames(self)
+        if self.shard is not None:
+            index, nshards = self.shard
+            self.pvnames = [p for p in self.pvnames
+                            if pv_shard(p, nshards) == index]
+        return self.pvnames
+
     def status_report(self,brief=False,dt=60):
         return self.cache_report(brief=brief,dt=dt)
     
@@ -130,7 +470,7 @@ class Cache(MasterDB):
         if self.pvs.has_key(pvname):
             return self.pvs[pvname]
         
-        p = epics.PV(pvname)
+        p = PV(pvname, connection_callback=self.conn_tracker.onConnect)
         epics.poll()
         if p.connected:
             self.pvs[pvname] = p
@@ -141,107 +481,503 @@ class Cache(MasterDB):
         if value is not None and pvname is not None:
             if timestamp is None:
                 timestamp = time.time()
-            self.data[pvname] = (value, char_value, timestamp)
+            st = self.stats.get(pvname, None)
+            if st is None:
+                st = self.stats[pvname] = PVStats()
+            st.callbacks += 1
+            st.last_change = timestamp
             if  pvname in self.alert_data:
                 self.alert_data[pvname]['last_value'] = value
+            policy, interval = self.policies.get(pvname, default_policy)
+            if policy == 'ratelimit':
+                # latest value wins: hold it until interval has passed
+                now = time.time()
+                if now - self._last_accept.get(pvname, 0) < interval:
+                    # wake the main loop to wait for the release time
+                    if len(self._held) == 0:
+                        self.wakeup.set()
+                    self._held[pvname] = (value, char_value, timestamp)
+                    return
+                self._last_accept[pvname] = now
+                self._held.pop(pvname, None)
+            # wake the main loop only to start the flush_interval wait,
+            # or to flush a full buffer
+            ndata = len(self.data)
+            self.mark_dirty(pvname, value, char_value, timestamp)
+            if ((ndata == 0 and len(self.data) > 0) or
+                len(self.data) >= flush_size):
+                self.wakeup.set()
 
-    def update_cache(self):
-        t0 = time.time()
-        fmt = "update cache set value=%s,cvalue=%s,ts=%s where pvname=%s"
-        self.db.cursor.execute("start transaction")
-        updates = []
-        # take keys as of right now, and pop off the latest values
-        # for these pvs.   Be careful to NOT set self.data = {} as
-        # this can blow away any changes that occur during this i/io
-        for nam in self.data.keys():
-            val, cval, ts = self.data.pop(nam)
+    def release_held(self):
+        "put held values of rate-limited PVs in the write-behind buffer when due"
+        now = time.time()
+        for pvname in self._held.keys():
+            interval = self.policies.get(pvname, default_policy)[1]
+            if now - self._last_accept.get(pvname, 0) >= interval:
+                val = self._held.pop(pvname, None)
+                if val is not None:
+                    self._last_accept[pvname] = now
+                    self.mark_dirty(pvname, val[0], val[1], val[2])
+
+    def scan_pvs(self):
+        "read values for PVs with a 'scan' policy when due, in one batch"
+        now = time.time()
+        due = []
+        for pvname, (policy, interval) in self.policies.items():
+            if policy != 'scan' or pvname in self.suspended:
+                continue
+            if self._scan_next.get(pvname, 0) <= now:
+                self._scan_next[pvname] = now + interval
+                pv = self.pvs.get(pvname, None)
+                if pv is not None and pv.connected:
+                    due.append(pv)
+        if len(due) > 0:
+            self.batch_get(due)
+
+    def batch_get(self, pvs, timeout=1.0, mark=True):
+        """get values for a list of connected PVs: all requests are sent
+        before waiting for any reply, and all replies are waited for at
+        most timeout seconds in total.  Values go to the write-behind
+        buffer if mark is True.  returns dict of pvname -> (value,
+        char_value) for the values received"""
+        ca = epics.ca
+        for pv in pvs:
+            ca.get(pv.chid, wait=False)
+        deadline = time.time() + timeout
+        ca.poll(evt=1.e-3, iot=timeout)
+        out = {}
+        for pv in pvs:
+            tleft = max(1.e-3, deadline - time.time())
+            val = ca.get_complete(pv.chid, timeout=tleft)
+            if val is not None:
+                out[pv.pvname] = (val, char_value(pv, val))
+                if mark:
+                    self.mark_dirty(pv.pvname, val, out[pv.pvname][1], time.time())
+        return out
+
+    def read_policies(self):
+        """read per-PV acquisition policies and monitor masks from the
+        cache table.  PVs not listed in self.policies use a plain monitor,
+        and PVs not listed in self.masks use the default monitor mask.
+        returns list of PV names whose policy or mask changed"""
+        changed = set()
+        if 'acq_policy' in self.cache.fieldtypes:
+            policies = {}
+            for r in self.cache.select(vals='pvname,acq_policy,acq_interval',
+                                       where="acq_policy<>'monitor'"):
+                interval = max(min_interval, r['acq_interval'] or 0)
+                policies[r['pvname']] = (r['acq_policy'], interval)
+            for pvname in set(policies.keys()) | set(self.policies.keys()):
+                if policies.get(pvname, None) != self.policies.get(pvname, None):
+                    changed.add(pvname)
+            self.policies = policies
+        if 'monitor_mask' in self.cache.fieldtypes:
+            masks = {}
+            for r in self.cache.select(vals='pvname,monitor_mask',
+                                       where="monitor_mask<>''"):
+                masks[r['pvname']] = monitor_mask(r['monitor_mask'])
+            for pvname in set(masks.keys()) | set(self.masks.keys()):
+                if masks.get(pvname, None) != self.masks.get(pvname, None):
+                    changed.add(pvname)
+            self.masks = masks
+        return list(changed)
+
+    def get_mask(self, pvname):
+        "monitor mask to use for a PV"
+        mask = self.masks.get(pvname, None)
+        if mask is None:
+            mask = monitor_mask()
+        return mask
+
+    def create_pv(self, pvname):
+        "create a PV for a cached pvname, as needed for its acquisition policy"
+        if self.policies.get(pvname, default_policy)[0] == 'scan':
+            pv = PV(pvname, auto_monitor=False,
+                    connection_callback=self.conn_tracker.onConnect)
+        else:
+            pv = PV(pvname, callback=self.onChanges,
+                    auto_monitor=self.get_mask(pvname),
+                    connection_callback=self.conn_tracker.onConnect)
+        self.pvs[pvname] = pv
+        self.conn_tracker.expect(pvname)
+        self.seed_pv(pvname, pv)
+        return pv
+
+    def seed_pv(self, pvname, pv):
+        """give a new PV the enum strings saved in the snapshot, so that
+        they need not be read when it connects"""
+        meta = self.meta.get(pvname, None)
+        if meta is None or not meta[2]:
+            return
+        if hasattr(pv, '_args'):
+            # epics.PV keeps its ctrl values in _args
+            pv._args['enum_strs'] = tuple(meta[2])
+        else:
+            pv.enum_strs = tuple(meta[2])
+
+    def read_snapshot(self):
+        "read PV metadata saved by write_snapshot()"
+        fname = _shard_file(snapshot_file, self.shard)
+        dat = {}
+        try:
+            dat = cPickle.load(open(fname, 'rb'))
+            self.meta = dat['pvs']
+        except (IOError, EOFError, KeyError, TypeError, cPickle.UnpicklingError):
+            self.meta = {}
+        # values are only known to match the cache table if the
+        # snapshot was written when the cache exited
+        self._seed_values = {}
+        if dat.get('clean', False):
+            for pvname, meta in self.meta.items():
+                if meta[3] is not None:
+                    self._seed_values[pvname] = meta[3]
+        return self.meta
+
+    def write_snapshot(self, clean=False):
+        """save PV metadata (type, count, enum strings, last value and
+        timestamp, connected, last time connected) for a warm restart,
+        replacing the previous snapshot only once the new one is complete.
+        clean=True marks a snapshot written on exit, after the last flush."""
+        now = time.time()
+        meta = {}
+        for pvname, pv in self.pvs.items():
+            if pvname in self.pending_adds:
+                continue
+            old = self.meta.get(pvname, None)
+            connected = bool(pv.connected)
+            last_seen = now
+            if not connected and old is not None:
+                last_seen = old[6]
+            ptype, count, enum_strs, value, ts = None, None, None, None, None
+            if connected:
+                ptype, count = pv.type, pv.count
+                if ptype in ('enum', 'time_enum', 'ctrl_enum'):
+                    enum_strs = pv.enum_strs
+                    if enum_strs is not None:
+                        enum_strs = tuple(enum_strs)
+                # a held (rate-limited) value may not be in the cache table
+                val = received_value(pv)[0]
+                if count == 1 and val is not None and pvname not in self._held:
+                    value, ts = str(val), pv.timestamp
+            elif old is not None:
+                ptype, count, enum_strs, value, ts = old[:5]
+            meta[pvname] = (ptype, count, enum_strs, value, ts, connected, last_seen)
+        # deferred PVs have no PV yet: keep what is known about them
+        for pvname in self.deferred:
+            if pvname in self.meta:
+                meta[pvname] = self.meta[pvname]
+        self.meta = meta
+        fname = _shard_file(snapshot_file, self.shard)
+        tmpname = '%s.tmp' % fname
+        try:
+            fout = open(tmpname, 'wb')
+            cPickle.dump({'time': now, 'clean': clean, 'pvs': meta}, fout, 2)
+            fout.close()
+            os.rename(tmpname, fname)
+        except (IOError, OSError), e:
+            sys.stdout.write('could not write cache snapshot: %s\n' % repr(e))
+
+    def connect_deferred(self):
+        """create PVs for some of the PVs that were not connected for a
+        long time when the cache started"""
+        batch, self.deferred = self.deferred[:deferred_batch], self.deferred[deferred_batch:]
+        for pvname in batch:
+            if pvname in self.pvs or pvname not in self.registry:
+                continue
+            try:
+                self.create_pv(pvname)
+            except epics.ca.ChannelAccessException:
+                sys.stderr.write(' Could not create PV %s \n' % pvname)
+        if len(batch) > 0:
+            sys.stdout.write('created %i long-disconnected PVs, %i left\n' %
+                             (len(batch), len(self.deferred)))
+
+    def apply_policies(self, changed):
+        """apply changed acquisition policies to PVs, re-creating the PV
+        when switching to or from a 'scan' policy, or when its monitor
+        mask changed"""
+        for pvname in changed:
+            pv = self.pvs.get(pvname, None)
+            self._held.pop(pvname, None)
+            self._scan_next.pop(pvname, None)
+            if pv is None or pvname in self.suspended:
+                continue
+            is_scan = self.policies.get(pvname, default_policy)[0] == 'scan'
+            if is_scan or pv.auto_monitor != self.get_mask(pvname):
+                pv.clear_callbacks()
+                pv.disconnect()
+                self.create_pv(pvname)
+
+    def mark_dirty(self, pvname, value, char_value, ts):
+        """put a changed value in the write-behind buffer, keyed by
+        cache row id so that only the latest value is written"""
+        if self._seed_values:
+            # the first value after a restart is already in the cache
+            # table if it has not changed since the last snapshot
+            seed = self._seed_values.pop(pvname, None)
+            if seed is not None and seed == str(value):
+                return
+        key = self.pv_ids.get(pvname, pvname)
+        self.data[key] = (pvname, value, char_value, ts)
+
+    def update_cache(self, force=False):
+        """flush the write-behind buffer to the cache table.
+
+        Changes are written only once flush_interval seconds have passed
+        since the last flush or flush_size changes are waiting, unless
+        force=True.  Returns the number of values written."""
+        ndirty = len(self.data)
+        if ndirty == 0:
+            return 0
+        now = time.time()
+        if (not force and ndirty < flush_size and
+            (now - self.last_flush) < flush_interval):
+            return 0
+
+        # swap buffers: new changes go to the (empty) back buffer while
+        # this one is written.  Values popped here are never lost, and
+        # late writes to this buffer are flushed on the next swap.
+        buff, self.data = self.data, self._backbuff
+        self._backbuff = buff
+        rows, unknown, updates = [], [], []
+        while buff:
+            key, (nam, val, cval, ts) = buff.popitem()
             val = str(val)
             if ';' in val:  #
                 val = val[:val.find(';')]
+            if cval is None:
+                cval = val
+            st = self.stats.get(nam, None)
+            if st is not None:
+                st.flushed += 1
+                st.nbytes  += len(val) + len(cval)
+            if isinstance(key, (int, long)):
+                rows.append("(%i,%s,%s,%s,%f)" % (key, safe_string(nam),
+                                                   safe_string(val),
+                                                   safe_string(cval), ts))
+            else:
+                unknown.append((val, cval, ts, nam))
             updates.append((val, cval, ts, nam))
+            self.current[nam] = (val, cval, ts)
 
-        self.db.cursor.executemany(fmt, updates)
-        self.db.cursor.execute("commit")
-        self.set_date()
+        self.db.begin_transaction()
+        for i in range(0, len(rows), flush_size):
+            self.db.execute(self.sql_upsert % ','.join(rows[i:i+flush_size]))
+        if len(unknown) > 0:
+            fmt = "update cache set value=%s,cvalue=%s,ts=%s where pvname=%s"
+            self.db.cursor.executemany(fmt, unknown)
+        self.db.commit_transaction()
+        self.last_flush = now
+        if self.feed is not None:
+            self.publish_changes(updates)
         return len(updates)
 
+    def publish_changes(self, updates):
+        """send (value, cvalue, ts, pvname) updates to the Archiver's
+        change feed as (pvname, value, cvalue, ts, type) records"""
+        records = []
+        for val, cval, ts, nam in updates:
+            typ = None
+            if nam in self.pvs:
+                typ = self.pvs[nam].type
+            records.append((nam, val, cval, ts, typ))
+        self.feed.publish(records)
+
     def look_for_unconnected_pvs(self):
-        """ look for PVs that have no callbacks defined --
-        must have been unconnected -- but are now connected"""
-        nout = 0
-        for pvname in self.pvnames:
-            pv = self.pvs[pvname]
-            if pv is None:
-                nout = nout + 1
-                continue
-            if not pv.connected:
-                time.sleep(0.0025)
-                if not pv.connected:
-                    nout = nout + 1
+        """ return the number of cached PVs that are not connected"""
+        return self.conn_tracker.count()
 
-            if pv.connected and len(pv.callbacks) < 1:
+    def handle_connections(self):
+        """handle connection changes noted by the connection tracker.
+        When a PV (re)connects, its monitor is re-armed if it has no
+        callback, and enum strings are fetched for enum PVs.
+        returns the list of newly connected PV names"""
+        connected, disconnected = self.conn_tracker.update()
+        now = time.time()
+        for pvname in disconnected:
+            st = self.stats.get(pvname, None)
+            if st is not None and st.t_connect is not None:
+                st.disconnects += 1
+                st.uptime += now - st.t_connect
+                st.t_connect = None
+        for pvname in connected:
+            st = self.stats.get(pvname, None)
+            if st is None:
+                st = self.stats[pvname] = PVStats()
+            st.t_connect = now
+            pv = self.pvs.get(pvname, None)
+            if (pv is None or pvname in self.suspended or
+                pvname in self.pending_adds):
+                continue
+            is_scan = self.policies.get(pvname, default_policy)[0] == 'scan'
+            if len(pv.callbacks) < 1 and not is_scan:
                 pv.add_callback(self.onChanges)
-                self.data[pvname] = (pv.value, pv.char_value, time.time())
-        return nout
-        
+            meta = self.meta.get(pvname, None)
+            if (pv.type in ('enum', 'time_enum', 'ctrl_enum') and
+                (meta is None or not meta[2])):
+                # fetch the enum strings so that char values are strings
+                pv.get_ctrlvars()
+            value, cval = received_value(pv)
+            if value is not None:
+                self.mark_dirty(pvname, value, cval, time.time())
+        return connected
+
     def connect_pvs(self, npvs=None):
+        """create PVs for all cached pvnames.  Each PV becomes live as soon
+        as it connects: its monitor is set up when the channel connects,
+        and the first monitor callback puts its initial value in the
+        write-behind buffer.  Returns once all PVs are connected, or
+        connect_timeout seconds have passed."""
         d = debugtime()
         self.get_pvnames()
         if npvs is None:
             npvs = len(self.pvnames)
         elif npvs < len(self.pvnames):
             self.pvnames = self.pvnames[:npvs]
-        n_notify = npvs / 10
-        d.add("connecting to %i PVs" %  npvs)
+
+        # warm restart: connect PVs that were connected at the last
+        # snapshot first, and defer PVs that have been dead for a long time
+        self.read_snapshot()
+        live, other, self.deferred = [], [], []
+        tdead = time.time() - dead_time
         for pvname in self.pvnames:
+            meta = self.meta.get(pvname, None)
+            if meta is None:
+                other.append(pvname)
+            elif meta[5]:
+                live.append(pvname)
+            elif meta[6] < tdead:
+                self.deferred.append(pvname)
+            else:
+                other.append(pvname)
+        d.add("connecting to %i PVs (%i were connected, %i deferred)" %
+              (npvs, len(live), len(self.deferred)))
+        for pvname in live + other:
             try:
-                self.pvs[pvname] = epics.PV(pvname,
-                                            connection_timeout=1.0)
+                self.create_pv(pvname)
             except epics.ca.ChannelAccessException:                
                 sys.stderr.write(' Could not create PV %s \n' % pvname)
         d.add('Created %i PV Objects' % len(self.pvs), verbose=False)
 
-        time.sleep(0.0001*npvs)
-        epics.ca.poll()
-        unconn = 0
-        for pv in self.pvs.values():
-            if not pv.connected:
-                time.sleep(0.002)
-                if not pv.connected:
-                    unconn =  unconn + 1
-
-        epics.ca.poll()
-        d.add("Connected to PVs (%i not connected)" %  unconn, verbose=False)
-        self.data = {}
-        for pv in self.pvs.values():
-            if pv is not None and pv.connected:
-                cval = pv.get(as_string=True)
-                self.data[pv.pvname] = (pv.value, cval, time.time())
-
-        d.add("got initial values for PVs", verbose=False)
-        #for pvname, vals in self.data.items():
-        #    print pvname, vals
+        npvs = len(self.pvs)
+        nconn = 0
+        milestones = [(0.5, '50%'), (0.9, '90%'), (1.0, 'all')]
+        deadline = time.time() + connect_timeout
         self.last_update = 0
-        self.update_cache()
-        d.add("Entered values for %i PVs to Db" %  npvs)
-        for i, pv in enumerate(self.pvs.values()):        
-            if pv is not None and pv.connected:
-                pv.add_callback(self.onChanges)
-        d.add("added callbacks for PVs")
-        #
-        unconn =self.look_for_unconnected_pvs()
-        d.add("looked for unconnected pvs: %i not connected" % unconn)
+        while nconn < npvs and time.time() < deadline:
+            epics.poll(evt=1.e-3, iot=0.1)
+            self.handle_connections()
+            nconn = npvs - self.conn_tracker.count()
+            self.update_cache()
+            while len(milestones) > 0 and nconn >= milestones[0][0]*npvs:
+                frac, label = milestones.pop(0)
+                d.add("%s of PVs connected (%i)" % (label, nconn), verbose=False)
+
+        # connected PVs with no value yet (PVs read by a 'scan' policy, or
+        # whose first monitor callback has not arrived): get them in one pass
+        noval = [pv for pvname, pv in self.pvs.items()
+                 if pv.connected and received_value(pv)[0] is None and
+                 pvname not in self.suspended]
+        if len(noval) > 0:
+            nget = len(self.batch_get(noval))
+            d.add("got initial values for %i of %i PVs" % (nget, len(noval)),
+                  verbose=False)
+        self.update_cache(force=True)
+        d.add("Connected to %i PVs, entered values to Db (%i not connected)" %
+              (nconn, npvs-nconn))
         d.show()
         
-        
     def set_date(self):
         self.last_update = t = time.time()
+        if self.shard is not None:
+            # workers leave the info table to the coordinator
+            return
         s = time.ctime()
         self.info.update("process='cache'", datetime=s,ts=t)
 
     def get_pid(self):
         return self.get_cache_pid()
 
+    def renew_lease(self):
+        """write the time to the cache row of the info table, only if the
+        row still holds this process id.  returns False if it does not, that
+        is if another cache process has taken over."""
+        self.last_update = t = time.time()
+        q = "update info set datetime='%s',ts=%f where process='cache' and pid=%i"
+        self.db.set_autocommit(1)
+        n = self.db.execute(q % (time.ctime(t), t, self.pid))
+        self.db.set_autocommit(0)
+        # n is None if the query failed: keep running
+        return n != 0
+
+    def is_master(self):
+        """return whether this process should keep running: for a worker,
+        whether its coordinator is alive, otherwise whether the info table
+        still holds this process id"""
+        if self.worker_pipe is not None:
+            return os.getppid() == self.worker_pipe[2]
+        return self.get_pid() == self.pid
+
+    def status_line(self):
+        "one-line status of the cache process"
+        return 'running pid=%i pvs=%i unconnected=%i pending=%i suspended=%i' % (
+            self.pid, len(self.pvs), self.conn_tracker.count(),
+            len(self.pending_adds), len(self.suspended))
+
+    def read_control(self):
+        """ act on add, drop, suspend, and status commands from the
+        control socket, replying 'ok' or 'fail' (or the status line).
+        An add is 'ok' once the PV is created: it is added to the
+        cache when it connects, or if it does not connect in time, put
+        in the requests table to be tried again from there."""
+        for action, pvname, reply in self.control.get_commands():
+            if action == 'status':
+                reply(self.status_line())
+                continue
+            pvname = normalize_pvname(pvname or '')
+            done = False
+            if valid_pvname(pvname):
+                self.db.set_autocommit(1)
+                done = self.handle_request(pvname, action)
+                self.db.set_autocommit(0)
+                if done is None:
+                    self.pending_adds[pvname].setdefault('control', time.time())
+            reply({True: 'ok', False: 'fail', None: 'ok'}[done])
+
+    def read_commands(self):
+        """ handle requests sent by the coordinator to a worker, one
+        'action pvname request_id' per line, and reply with
+        'request_id done' or 'request_id fail' for each."""
+        cmd_fd, reply_fd, ppid = self.worker_pipe
+        while len(select.select([cmd_fd], [], [], 0)[0]) > 0:
+            dat = os.read(cmd_fd, 4096)
+            if len(dat) == 0:
+                break
+            self._cmdbuff = self._cmdbuff + dat
+        if '\n' not in self._cmdbuff:
+            return
+        self.db.set_autocommit(1)
+        while '\n' in self._cmdbuff:
+            line, self._cmdbuff = self._cmdbuff.split('\n', 1)
+            try:
+                action, nam, rid = line.split()
+            except ValueError:
+                continue
+            done = self.handle_request(nam, action, rid=rid)
+            if done is not None:
+                self.reply_requests([rid], done)
+        self.db.set_autocommit(0)
+
+    def reply_requests(self, rids, done):
+        """report requests as done or failed:  a worker replies to its
+        coordinator, otherwise done requests are deleted"""
+        if self.worker_pipe is not None:
+            status = {True: 'done', False: 'fail'}[done]
+            for rid in rids:
+                os.write(self.worker_pipe[1], '%s %s\n' % (rid, status))
+        elif done:
+            self.delete_requests(rids)
+
     def mainloop(self, npvs=None):
         " "
         sys.stdout.write('Starting Epics PV Archive Caching: \n')
@@ -249,66 +985,171 @@ class Cache(MasterDB):
 
         t0 = time.time()
         self.pid = os.getpid()
-        self.db.set_autocommit(1)                        
-        self.set_cache_status('running')
-        self.set_cache_pid(self.pid)
+        if self.shard is None:
+            self.db.set_autocommit(1)                        
+            self.set_cache_status('running')
+            self.set_cache_pid(self.pid)
 
-        fout = open(self.pidfile, 'w')
-        fout.write('%i\n' % self.pid)
-        fout.close()
+            fout = open(self.pidfile, 'w')
+            fout.write('%i\n' % self.pid)
+            fout.close()
         self.db.set_autocommit(0)
         self.read_alert_settings()
+        self.read_policies()
         self.db.get_cursor()        
+        self.feed = ChangeFeedPublisher(feed_socket)
+        if self.worker_pipe is None:
+            self.control = ControlServer(event=self.wakeup)
         self.connect_pvs(npvs=npvs)
         fmt = 'pvs connected, ready to run. Cache Process ID= %i\n'
         sys.stdout.write(fmt % self.pid)
         
-        status_str = '%s: %i values cached since last notice %i loops\n'
-        ncached = 0
-        nloop_count = 0
-        mlast   = -1
+        self.ncached = 0
+        self.nloop_count = 0
         self.db.set_autocommit(0)
-        alert_timer_on = True
+        self.scheduler = Scheduler()
+        if self.worker_pipe is None:
+            self.scheduler.add('requests', self.process_requests, task_periods['requests'])
+            self.scheduler.add('alerts',   self.process_alerts,   task_periods['alerts'])
+        self.scheduler.add('heartbeat', self.heartbeat,           task_periods['heartbeat'])
+        self.scheduler.add('settings', self.read_settings,        task_periods['settings'])
+        self.scheduler.add('status',   self.write_status,         task_periods['status'])
+        self.scheduler.add('stats',    self.write_stats,          task_periods['stats'])
+        self.scheduler.add('snapshot', self.write_snapshot,       task_periods['snapshot'])
+        self.scheduler.add('deferred', self.connect_deferred,     task_periods['deferred'])
+        self.scheduler.add('values',   self.write_values,         task_periods['values'])
+        signal.signal(signal.SIGTERM, self.onTerminate)
         while True:
             try:
-                # self.db.begin_transaction()
+                # sleep until a callback reports a change, or there is work due
+                self.wakeup.wait(self.idle_time())
+                self.wakeup.clear()
+                if self.terminated:
+                    self.exit()
                 epics.poll(evt=1.e-4, iot=1.0)
-                n = self.update_cache()
-                ncached +=  n
-                nloop_count   +=  1
-                # self.db.commit_transaction()
-                tmin, tsec = time.localtime()[4:6]
-
-                # make sure updates and alerts get processed often,
-                # but not on every cycle.  Here they get processed
-                # once every 15 seconds.
-                if (tsec % 15) > 10:
-                    alert_timer_on = True
-                elif (tsec % 15) < 3 and alert_timer_on:
-                    self.process_requests()
-                    self.process_alerts()
-                    alert_timer_on = False
-
+                self.handle_connections()
+                if len(self.pending_adds) > 0:
+                    self.add_pending_pvs()
+                self.release_held()
+                self.scan_pvs()
+                self.ncached += self.update_cache()
+                self.nloop_count += 1
+                if self.worker_pipe is not None:
+                    self.read_commands()
+                else:
+                    self.read_control()
+                self.scheduler.run_pending()
                 sys.stdout.flush()
-                if self.get_pid() != self.pid:
-                    sys.stdout.write('  No longer master! Exiting %i / %i !!\n' % (self.pid, self.get_pid()))
-                    self.exit()
-                if (tsec == 0) and (tmin != mlast) and (tmin % 5 == 0): # report once per 5 minutes
-                    mlast = tmin
-                    sys.stdout.write(status_str % (time.ctime(),ncached,nloop_count))
-                    sys.stdout.flush()
-                    self.read_alert_settings()
-                    self.look_for_unconnected_pvs()
-                    ncached = 0
-                    nloop_count = 0
 
             except KeyboardInterrupt:
                 return
 
         self.db.free_cursor()            
 
+    def onTerminate(self, signum=None, frame=None):
+        """SIGTERM handler, as used by CacheCoordinator to stop its
+        workers.  The main loop exits at its next pass through exit(),
+        flushing buffered values and writing the snapshot."""
+        self.terminated = True
+
+    def idle_time(self):
+        """time the main loop can wait for changes: until the next task is
+        due, buffered values should be flushed, a held value of a rate-limited
+        PV can be released, or a scanned PV is due, and at most min_interval
+        while requested PVs are waiting to connect."""
+        now = time.time()
+        wait = min(max_idle, self.scheduler.next_due())
+        if len(self.data) > 0:
+            wait = min(wait, self.last_flush + flush_interval - now)
+        if len(self._scan_next) > 0:
+            wait = min(wait, min(self._scan_next.values()) - now)
+        for pvname in self._held:
+            interval = self.policies.get(pvname, default_policy)[1]
+            wait = min(wait, self._last_accept.get(pvname, 0) + interval - now)
+        if len(self.pending_adds) > 0:
+            wait = min(wait, min_interval)
+        return max(0, wait)
+
+    def heartbeat(self):
+        """renew the lease of this process in the info table, or for a
+        worker check that its coordinator is alive.  Exits if this process
+        should no longer run."""
+        if self.worker_pipe is not None:
+            alive = self.is_master()
+        else:
+            alive = self.renew_lease()
+        if not alive:
+            sys.stdout.write('  No longer master! Exiting %i !!\n' % (self.pid))
+            self.exit()
+
+    def read_settings(self):
+        "re-read alert settings and acquisition policies"
+        self.read_alert_settings()
+        self.apply_policies(self.read_policies())
+
+    def write_status(self):
+        "write a status report to stdout"
+        status_str = '%s: %i values cached since last notice %i loops\n'
+        sys.stdout.write(status_str % (time.ctime(), self.ncached, self.nloop_count))
+        sys.stdout.write('   %i PVs not connected\n' % self.look_for_unconnected_pvs())
+        if self.feed is not None:
+            sys.stdout.write('   change feed: %i values sent, %i dropped\n' %
+                             (self.feed.nsent, self.feed.ndropped))
+            self.feed.nsent = self.feed.ndropped = 0
+        sys.stdout.write('%s\n' % '\n'.join(self.scheduler.report()))
+        sys.stdout.flush()
+        self.ncached = 0
+        self.nloop_count = 0
+
+    def write_stats(self):
+        """write per-PV statistics as JSON to the stats file, replacing
+        the previous file only once the new one is complete"""
+        fname = _shard_file(stats_file, self.shard)
+        now = time.time()
+        pvs = {}
+        for pvname, st in self.stats.items():
+            pvs[pvname] = st.as_dict(now)
+        out = {'time': now, 'start_time': self.t_start, 'pid': self.pid,
+               'shard': self.shard, 'pvs': pvs}
+        tmpname = '%s.tmp' % fname
+        try:
+            fout = open(tmpname, 'w')
+            json.dump(out, fout)
+            fout.close()
+            os.rename(tmpname, fname)
+        except (IOError, OSError), e:
+            sys.stdout.write('could not write cache stats: %s\n' % repr(e))
+
+    def write_values(self):
+        """write current values of the cached PVs to the memory-mapped
+        values file read by web processes (see CacheSnapshot)"""
+        if not self._current_loaded:
+            # values not changed since the cache started are only in
+            # the cache table:  read them once
+            for r in self.db.exec_fetch("select pvname,value,cvalue,ts from cache"):
+                if r['pvname'] in self.pvs and r['pvname'] not in self.current:
+                    self.current[r['pvname']] = (r['value'], r['cvalue'], r['ts'])
+            self._current_loaded = True
+        rows = []
+        for pvname in self.pvs:
+            cur = self.current.get(pvname, None)
+            if cur is not None:
+                rows.append((pvname, self.registry.get_type(pvname),
+                             cur[0], cur[1], cur[2]))
+        try:
+            write_values(_shard_file(values_file, self.shard), rows)
+        except (IOError, OSError), e:
+            sys.stdout.write('could not write cache values: %s\n' % repr(e))
+
     def exit(self):
+        if self.control is not None:
+            self.control.close()
+        if self.scheduler is not None and len(self.pvs) > 0:
+            self.update_cache(force=True)
+            self.write_snapshot(clean=True)
         self.close()
+        if self.feed is not None:
+            self.feed.close()
         for i in self.pvs.values():
             i.disconnect()
 
@@ -331,8 +1172,7 @@ class Cache(MasterDB):
     def get_full(self,pv,add=False):
         " return full information for a cached pv"
         npv = normalize_pvname(pv)
-        if len(self.pvnames)== 0: self.get_pvnames()
-        if add and (npv not in self.pvnames):
+        if add and not self.in_cache(npv):
             self.add_pv(npv)
             sys.stdout.write('adding PV.....\n')
             return self.get_full(pv,add=False)
@@ -355,87 +1195,209 @@ class Cache(MasterDB):
         self.db.execute(qval)
     
     def process_requests(self):
-        " process requests for new PV's to be cached"
+        """ process requests for PVs to be added to, dropped from,
+        or suspended in the cache.  Drop and suspend requests are
+        handled right away.  PVs to add are created without waiting
+        for them to connect:  add_pending_pvs() adds them to the cache
+        as they connect."""
         req   = self.sql_exec_fetch("select * from requests")
         if len(req) == 0:
             return
 
-        del_cache= "delete from cache where %s"
-        
         # note: if a requested PV does not connect,
         #       wait a few minutes before dropping from
         #       the request table.
 
-        if len(req)>0:
-            sys.stdout.write("processing %i requests at %s\n" % (len(req), time.ctime()))
-            sys.stdout.flush()
-        es = clean_string
-        sys.stdout.write( 'Process Req: %i\n' % len(self.pvnames))
-        if len(self.pvnames)== 0:
-            self.get_pvnames()
-        sys.stdout.write( 'Process Req: %i\n' % len(self.pvnames))            
+        sys.stdout.write("processing %i requests at %s\n" % (len(req), time.ctime()))
+        sys.stdout.flush()
+        if len(self.registry)== 0:
+            self.registry.sync(self.db)
         
         now = time.time()
         self.db.set_autocommit(1)
         drop_ids = []
         for r in req:
             nam, rid, action, ts = r['pvname'], r['id'], r['action'], r['ts']
-            where = "pvname='%s'" % nam
-            print 'Request: ', nam, rid, action
             if valid_pvname(nam) and (now-ts < 3000.0):
-                if 'suspend' == action:
-                    if self.pvs.has_key(nam):
-                        self.pvs[nam].clear_callbacks()
-                        self.cache.update(active='no',where=where)
-                        drop_ids.append(rid)
-                elif 'drop' == action:
-                    if nam in self.pvnames:
-                        self.sql_exec(del_cache % where)
-                        drop_ids.append(rid)                        
-
-                elif 'add' == action:
-                    if nam not in self.pvnames:
-                        pv = self.epics_connect(nam)
-                        xval = pv.get(as_string=True)
-                        conn = pv.wait_for_connection(timeout=1.0)
-                        if conn:
-                            self.add_epics_pv(pv)
-                            self.set_value(pv=pv)
-                            pv.add_callback(self.onChanges)
-                            self.pvs[nam] = pv
-                            drop_ids.append(rid)
-                            sys.stdout.write('added PV = %s\n' % nam)                            
-                        else:
-                            sys.stdout.write('could not connect to PV %s\n' % nam)
-                    else:
-                        print '? already in self.pvnames ', nam
-                        drop_ids.append(rid)                                                    
+                if self.handle_request(nam, action, rid=rid):
+                    drop_ids.append(rid)
             else:
                 drop_ids.append(rid)
-                
-        time.sleep(0.01)
-        self.get_pvnames()
-        for rid in drop_ids:
-            self.sql_exec( "delete from requests where id=%i" % rid )
-
-        time.sleep(0.01)
+        self.delete_requests(drop_ids)
         self.db.set_autocommit(0)        
-        
+
+    def handle_request(self, nam, action, rid=None):
+        """act on one 'add', 'drop', or 'suspend' request for a PV.
+        returns True when the request is done and can be removed,
+        False when it failed, and None for an add request that is
+        waiting for its PV to connect."""
+        where = "pvname='%s'" % nam
+        del_cache= "delete from cache where %s"
+        if 'suspend' == action:
+            if self.pvs.has_key(nam):
+                self.pvs[nam].clear_callbacks()
+                self.suspended.add(nam)
+                self.cache.update(active='no',where=where)
+                return True
+        elif 'drop' == action:
+            if nam in self.pending_adds:
+                # the add request is superseded by this drop
+                self.reply_requests(self.pending_adds[nam]['rids'], True)
+                self.cancel_add(nam)
+                return True
+            if nam in self.registry:
+                # stop writing this PV, or its row would be re-inserted,
+                # and forget it, so that it can be added again
+                pv = self.pvs.pop(nam, None)
+                if pv is not None:
+                    pv.clear_callbacks()
+                    pv.disconnect()
+                self.suspended.discard(nam)
+                self.conn_tracker.forget(nam)
+                self.data.pop(self.registry.remove(nam), None)
+                self.stats.pop(nam, None)
+                self.current.pop(nam, None)
+                self.data.pop(nam, None)
+                self.sql_exec(del_cache % where)
+                return True
+        elif 'add' == action:
+            if nam in self.pending_adds:
+                pending = self.pending_adds[nam]
+                if rid is not None and rid not in pending['rids']:
+                    pending['rids'].append(rid)
+                return None
+            # a PV may be in the cache table but not yet monitored,
+            # if it was inserted by add_pvfile()
+            if nam in self.pvs:
+                return True
+            try:
+                pv = PV(nam, auto_monitor=self.get_mask(nam),
+                        connection_callback=self.conn_tracker.onConnect)
+            except epics.ca.ChannelAccessException:
+                sys.stdout.write('could not create PV %s\n' % nam)
+                return False
+            self.pvs[nam] = pv
+            self.conn_tracker.expect(nam)
+            rids = []
+            if rid is not None:
+                rids.append(rid)
+            self.pending_adds[nam] = {'deadline': time.time() + connect_timeout,
+                                      'rids': rids}
+            return None
+        return False
+
+    def cancel_add(self, nam):
+        "give up on a PV that was requested but has not connected"
+        self.pending_adds.pop(nam, None)
+        self.conn_tracker.forget(nam)
+        pv = self.pvs.pop(nam, None)
+        if pv is not None:
+            pv.clear_callbacks()
+            pv.disconnect()
+
+    def add_pending_pvs(self):
+        """add requested PVs that have connected to the cache, with one
+        insert for all new rows, and give up on those that did not
+        connect in time.  returns the number of PVs added"""
+        now = time.time()
+        connected, failed = [], []
+        for nam, pending in self.pending_adds.items():
+            if self.pvs[nam].connected:
+                connected.append(nam)
+            elif now > pending['deadline']:
+                failed.append(nam)
+
+        for nam in failed:
+            sys.stdout.write('could not connect to PV %s\n' % nam)
+            pending = self.pending_adds[nam]
+            self.reply_requests(pending['rids'], False)
+            if 'control' in pending and len(pending['rids']) == 0:
+                # added from the control socket, and already replied 'ok'
+                self.insert_request(nam, 'add', pending['control'])
+            self.cancel_add(nam)
+        if len(connected) == 0:
+            return 0
+
+        # values of the new PVs, with one batch get for those that
+        # have none yet
+        values, noval = {}, []
+        for nam in connected:
+            value, cval = received_value(self.pvs[nam])
+            if value is None:
+                noval.append(self.pvs[nam])
+            else:
+                values[nam] = (value, cval)
+        if len(noval) > 0:
+            values.update(self.batch_get(noval, mark=False))
+
+        # rows may have been added to the cache table by another process
+        names = ','.join([safe_string(nam) for nam in connected])
+        q_ids = "select id,pvname,type from cache where pvname in (%s)" % names
+        known = set([r['pvname'] for r in self.sql_exec_fetch(q_ids)
+                     if 'pvname' in r])
+        rows = []
+        for nam in connected:
+            if nam not in known:
+                pv = self.pvs[nam]
+                value, cval = values.get(nam, (None, None))
+                val = str(value)
+                if cval is None:
+                    cval = val
+                rows.append("(%s,%s,%s,%s,%f)" % (safe_string(nam),
+                                                  safe_string(pv.type),
+                                                  safe_string(val),
+                                                  safe_string(cval), now))
+        self.db.set_autocommit(1)
+        if len(rows) > 0:
+            q_ins = "insert into cache (pvname,type,value,cvalue,ts) values %s"
+            for i in range(0, len(rows), flush_size):
+                self.db.execute(q_ins % ','.join(rows[i:i+flush_size]))
+        for r in self.sql_exec_fetch(q_ids):
+            if 'pvname' in r and r['pvname'] not in self.registry:
+                self.registry.add(r['pvname'], r['id'], r['type'])
+
+        done = []
+        for nam in connected:
+            pv = self.pvs[nam]
+            done.extend(self.pending_adds.pop(nam)['rids'])
+            if pv.type in ('enum', 'time_enum', 'ctrl_enum'):
+                pv.get_ctrlvars()
+            pv.add_callback(self.onChanges)
+            if nam in values:
+                self.mark_dirty(nam, values[nam][0], values[nam][1], now)
+        self.reply_requests(done, True)
+        self.db.set_autocommit(0)
+        sys.stdout.write('added %i PVs to cache (%i inserted)\n' %
+                         (len(connected), len(rows)))
+        return len(connected)
+
+    def insert_request(self, pvname, action, ts=None):
+        "put a request in the requests table, to be retried from there"
+        if ts is None:
+            ts = time.time()
+        self.sql_exec("insert into requests (pvname,action,ts) values (%s,'%s',%f)" %
+                      (safe_string(pvname), action, ts))
+        self.db.commit_transaction()
+
+    def delete_requests(self, ids):
+        "remove handled requests from the requests table"
+        if len(ids) > 0:
+            ids = ','.join(['%i' % i for i in ids])
+            self.sql_exec("delete from requests where id in (%s)" % ids)
+
     def add_epics_pv(self,pv):
         """ add an epics PV to the cache"""
         if not pv.connected:
             print 'add_epics_pv: NOT CONNECTED ', pv
             return
 
-        self.get_pvnames()
-        if pv.pvname in self.pvnames:
+        if self.in_cache(pv.pvname):
             return
         self.cache.insert(pvname=pv.pvname,type=pv.type)
 
         where = "pvname='%s'" % pv.pvname
         o = self.cache.select_one(where=where)
-        if o['pvname'] not in self.pvnames:
-            self.pvnames.append(o['pvname'])
+        self.registry.add(o['pvname'], o['id'], o['type'])
 
     def read_alert_settings(self):
         for i in self._table_alerts.select():
@@ -0,0 +1,257 @@
+#!/usr/bin/env python
+
+import os
+import sys
+import time
+import select
+import signal
+
+from SimpleDB import Connection
+from Cache import Cache, task_periods
+from Scheduler import Scheduler
+from ControlSocket import ControlServer
+from util import safe_string, valid_pvname, normalize_pvname, pv_shard
+
+class CacheCoordinator(Cache):
+    """ run the Cache as several worker processes.
+
+    The PVs in the cache are split into nworkers shards by a stable hash
+    of the PV name.  Each worker is a Cache process with its own Channel
+    Access context and database connection, caching the PVs of one shard.
+
+    The coordinator makes no Channel Access connections itself.  It owns
+    the pid and status in the info table, reads the requests table and
+    sends each request to the worker for that PV's shard, and processes
+    alerts using the values in the cache table.
+    """
+    numeric_types = ('double', 'float', 'int', 'long', 'short', 'enum',
+                     'char', 'time_double', 'time_float', 'time_long',
+                     'time_short', 'time_enum', 'time_char')
+
+    def __init__(self, nworkers=2, dbconn=None, pidfile='/tmp/cache.pid', **kw):
+        Cache.__init__(self, dbconn=dbconn, pidfile=pidfile, **kw)
+        self.nworkers = nworkers
+        # index -> [pid, command fd, reply fd, reply buffer]
+        self.workers  = {}
+        # request id -> worker index, for requests sent but not answered
+        self.inflight = {}
+        self.alert_ts = 0
+        # ids for commands from the control socket: negative, so they
+        # are never taken for ids in the requests table
+        self.control_id = 0
+        # control id -> (action, pvname, time, worker index) for control
+        # socket commands sent to a worker but not answered
+        self.control_sent = {}
+
+    def start_worker(self, index):
+        "fork a worker process for one shard"
+        cmd_r, cmd_w = os.pipe()
+        rep_r, rep_w = os.pipe()
+        ppid = os.getpid()
+        pid = os.fork()
+        if pid == 0:
+            os.close(cmd_w)
+            os.close(rep_r)
+            for w in self.workers.values():
+                os.close(w[1])
+                os.close(w[2])
+            try:
+                sys.stdout.write('Cache worker %i of %i: pid=%i\n' %
+                                 (index+1, self.nworkers, os.getpid()))
+                worker = Cache(dbconn=Connection(), pidfile=self.pidfile,
+                               shard=(index, self.nworkers))
+                worker.worker_pipe = (cmd_r, rep_w, ppid)
+                worker.mainloop()
+            finally:
+                os._exit(0)
+        os.close(cmd_r)
+        os.close(rep_w)
+        self.workers[index] = [pid, cmd_w, rep_r, '']
+
+    def check_workers(self):
+        "restart any worker process that has exited"
+        for index, w in self.workers.items():
+            try:
+                pid, status = os.waitpid(w[0], os.WNOHANG)
+            except OSError:
+                pid = w[0]
+            if pid == w[0]:
+                sys.stdout.write('Cache worker %i (pid=%i) exited, restarting\n' %
+                                 (index+1, w[0]))
+                os.close(w[1])
+                os.close(w[2])
+                for rid, windex in self.inflight.items():
+                    if windex == index:
+                        self.inflight.pop(rid)
+                for cid, (action, pvname, ts, windex) in self.control_sent.items():
+                    if windex == index:
+                        self.control_sent.pop(cid)
+                        if action == 'add':
+                            self.insert_request(pvname, action, ts)
+                self.workers.pop(index)
+                time.sleep(1.0)
+                self.start_worker(index)
+
+    def send_worker(self, index, line):
+        """send a command line to a worker.  returns False if the worker
+        has exited (check_workers() will restart it)"""
+        try:
+            os.write(self.workers[index][1], line)
+        except (OSError, KeyError):
+            return False
+        return True
+
+    def stop_workers(self):
+        for w in self.workers.values():
+            try:
+                os.kill(w[0], signal.SIGTERM)
+                os.waitpid(w[0], 0)
+            except OSError:
+                pass
+        self.workers = {}
+
+    def dispatch_requests(self):
+        "send new requests to the workers for the shards of their PVs"
+        req = self.sql_exec_fetch("select * from requests")
+        now = time.time()
+        drop_ids = []
+        for r in req:
+            if 'id' not in r or r['id'] in self.inflight:
+                continue
+            nam, rid, action, ts = r['pvname'], r['id'], r['action'], r['ts']
+            if valid_pvname(nam) and (now-ts < 3000.0):
+                index = pv_shard(nam, self.nworkers)
+                # if the worker has exited, the request is sent again
+                # once it is restarted
+                if self.send_worker(index, '%s %s %i\n' % (action, nam, rid)):
+                    self.inflight[rid] = index
+            else:
+                drop_ids.append(rid)
+        self.delete_requests(drop_ids)
+
+    def read_replies(self, timeout=0):
+        """read worker replies, removing finished requests.  Failed requests
+        stay in the requests table and will be sent again.  A failed add
+        from the control socket is put in the requests table."""
+        fds = {}
+        for w in self.workers.values():
+            fds[w[2]] = w
+        done = []
+        ready = select.select(fds.keys(), [], [], timeout)[0]
+        for fd in ready:
+            w = fds[fd]
+            dat = os.read(fd, 4096)
+            w[3] = w[3] + dat
+            while '\n' in w[3]:
+                line, w[3] = w[3].split('\n', 1)
+                try:
+                    rid, status = line.split()
+                    rid = int(rid)
+                except ValueError:
+                    continue
+                self.inflight.pop(rid, None)
+                if rid < 0:
+                    action, pvname, ts, index = self.control_sent.pop(rid, (None,)*4)
+                    if status == 'fail' and action == 'add':
+                        self.insert_request(pvname, action, ts)
+                elif status == 'done':
+                    done.append(rid)
+        self.delete_requests(done)
+
+    def status_line(self):
+        "one-line status of the coordinator"
+        return 'running pid=%i workers=%i worker_pids=%s' % (self.pid,
+                 len(self.workers), ','.join(['%i' % w[0] for w in
+                                              self.workers.values()]))
+
+    def read_control(self):
+        """ send add, drop, and suspend commands from the control socket
+        to the worker for the shard of the PV, and reply 'ok' once sent.
+        An add that the worker fails is put in the requests table."""
+        for action, pvname, reply in self.control.get_commands():
+            if action == 'status':
+                reply(self.status_line())
+                continue
+            pvname = normalize_pvname(pvname or '')
+            if not valid_pvname(pvname):
+                reply('fail')
+                continue
+            self.control_id = self.control_id - 1
+            index = pv_shard(pvname, self.nworkers)
+            if not self.send_worker(index, '%s %s %i\n' %
+                                    (action, pvname, self.control_id)):
+                # the caller falls back to the requests table
+                reply('fail')
+                continue
+            self.control_sent[self.control_id] = (action, pvname, time.time(), index)
+            reply('ok')
+
+    def read_alert_values(self):
+        "get values for PVs with alerts that have changed in the cache table"
+        names = [safe_string(n) for n in self.alert_data.keys()]
+        if len(names) == 0:
+            return
+        q = "select pvname,type,value,ts from cache where ts>%f and pvname in (%s)"
+        for r in self.sql_exec_fetch(q % (self.alert_ts, ','.join(names))):
+            if 'pvname' not in r:
+                continue
+            value = r['value']
+            if r['type'] in self.numeric_types:
+                try:
+                    value = float(value)
+                except (TypeError, ValueError):
+                    pass
+            self.alert_data[r['pvname']]['last_value'] = value
+            self.alert_ts = max(self.alert_ts, r['ts'])
+
+    def check_alerts(self):
+        self.read_alert_values()
+        self.process_alerts()
+
+    def write_status(self):
+        sys.stdout.write('%s: %i workers, pids=%s\n' % (time.ctime(),
+            len(self.workers), ','.join(['%i' % w[0] for w in
+                                         self.workers.values()])))
+        sys.stdout.write('%s\n' % '\n'.join(self.scheduler.report()))
+
+    def exit(self):
+        self.stop_workers()
+        Cache.exit(self)
+
+    def mainloop(self, npvs=None):
+        " "
+        sys.stdout.write('Starting Epics PV Archive Caching with %i workers: \n' %
+                         self.nworkers)
+        self.db.get_cursor()
+        self.pid = os.getpid()
+        self.db.set_autocommit(1)
+        self.set_cache_status('running')
+        self.set_cache_pid(self.pid)
+
+        fout = open(self.pidfile, 'w')
+        fout.write('%i\n' % self.pid)
+        fout.close()
+        self.read_alert_settings()
+        self.alert_ts = time.time()
+
+        for index in range(self.nworkers):
+            self.start_worker(index)
+        sys.stdout.write('Cache Coordinator Process ID= %i\n' % self.pid)
+        self.control = ControlServer()
+
+        self.scheduler = Scheduler()
+        self.scheduler.add('requests', self.dispatch_requests, task_periods['requests'])
+        self.scheduler.add('alerts',   self.check_alerts,      task_periods['alerts'])
+        self.scheduler.add('heartbeat', self.heartbeat,        task_periods['heartbeat'])
+        self.scheduler.add('settings', self.read_alert_settings, task_periods['settings'])
+        self.scheduler.add('status',   self.write_status,      task_periods['status'])
+        while True:
+            try:
+                self.read_replies(timeout=min(0.25, self.scheduler.next_due()))
+                self.check_workers()
+                self.read_control()
+                self.scheduler.run_pending()
+                sys.stdout.flush()
+            except KeyboardInterrupt:
+                self.stop_workers()
+                return
@@ -0,0 +1,180 @@
+#!/usr/bin/env python
+"""
+Memory-mapped file of current values of cached PVs, written by the Cache
+and read by web processes, so that they do not query the cache table.
+
+The file has a header, an index of PV names, and one fixed-size slot per
+PV, in the order of the index:
+
+   header:  magic 'PVCV', version, number of slots, index length (bytes),
+            time written
+   index:   PV names, separated by newlines
+   slots:   timestamp, type, value, cvalue
+
+The slots are as wide as the columns of the cache table (value is a
+tinyblob, 255 bytes), so values are not truncated.  The Cache writes a
+new file and renames it over the old one, so readers never see a
+partial file: a reader keeps the old file mapped until it sees the new
+one.
+
+Workers of a sharded cache each write their own file, with the worker
+index before the extension.  A reader reads all of them.
+"""
+import os
+import glob
+import mmap
+import time
+import struct
+
+import config
+
+values_file = getattr(config, 'cache_values_file',
+                      os.path.join(config.logdir, 'cache_values.dat'))
+
+MAGIC   = 'PVCV'.encode('ascii')
+VERSION = 2
+header_fmt  = '<4sIIId'
+slot_fmt    = '<d64s255s64s'
+header_size = struct.calcsize(header_fmt)
+slot_size   = struct.calcsize(slot_fmt)
+
+def _bytes(s, size=None):
+    if not isinstance(s, bytes):
+        s = s.encode('utf-8', 'replace')
+    return s[:size]
+
+def _str(b):
+    b = b.rstrip('\0'.encode('ascii'))
+    if not isinstance(b, str):
+        b = b.decode('utf-8', 'replace')
+    return b
+
+def write_values(fname, rows, now=None):
+    """write a values file from a list of (pvname, type, value, cvalue, ts),
+    replacing the old file only once the new one is complete."""
+    if now is None:
+        now = time.time()
+    names, slots = [], []
+    pack = struct.Struct(slot_fmt).pack
+    for pvname, ptype, value, cvalue, ts in rows:
+        names.append(pvname)
+        slots.append(pack(ts or 0, _bytes(ptype or '', 64),
+                          _bytes(value or '', 255), _bytes(cvalue or '', 64)))
+    index = _bytes('\n'.join(names))
+    tmpname = '%s.tmp' % fname
+    fout = open(tmpname, 'wb')
+    fout.write(struct.pack(header_fmt, MAGIC, VERSION, len(slots),
+                           len(index), now))
+    fout.write(index)
+    fout.write(''.encode('ascii').join(slots))
+    fout.close()
+    os.rename(tmpname, fname)
+
+class _MappedFile:
+    "one values file, mapped read-only"
+    def __init__(self, fname):
+        fh = open(fname, 'rb')
+        try:
+            st = os.fstat(fh.fileno())
+            self.key = (st.st_ino, st.st_mtime)
+            self.map = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+        finally:
+            fh.close()
+        magic, version, nslots, nindex, self.time = \
+               struct.unpack_from(header_fmt, self.map, 0)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError('not a cache values file: %s' % fname)
+        names = _str(self.map[header_size:header_size+nindex])
+        self.index = {}
+        if nslots > 0:
+            start = header_size + nindex
+            for i, name in enumerate(names.split('\n')):
+                self.index[name] = start + i*slot_size
+
+    def get(self, pvname):
+        offset = self.index.get(pvname, None)
+        if offset is None:
+            return None
+        ts, ptype, value, cvalue = struct.unpack_from(slot_fmt, self.map, offset)
+        return {'pvname': pvname, 'type': _str(ptype), 'value': _str(value),
+                'cvalue': _str(cvalue), 'ts': ts}
+
+    def close(self):
+        self.map.close()
+
+class CacheSnapshot:
+    """ read current values from the values file(s) written by the Cache:
+
+    >>> values = CacheSnapshot()
+    >>> row = values.get(pvname)   # dict like a cache table row, or None
+
+    Files are checked for a newer version at most every check_interval
+    seconds.  Files written more than max_age seconds ago (by a cache
+    that has stopped) are not used:  get() returns None, and callers
+    should read the cache table instead.
+    """
+    def __init__(self, fname=None, max_age=60.0, check_interval=1.0):
+        if fname is None:
+            fname = values_file
+        self.fname = fname
+        self.max_age = max_age
+        self.check_interval = check_interval
+        self.files = {}
+        self.last_check = 0
+
+    def _filenames(self):
+        base, ext = os.path.splitext(self.fname)
+        names = glob.glob('%s.*%s' % (base, ext))
+        if os.path.exists(self.fname):
+            names.append(self.fname)
+        return names
+
+    def refresh(self):
+        "map new versions of the values files"
+        now = time.time()
+        if now - self.last_check < self.check_interval:
+            return
+        self.last_check = now
+        files = {}
+        for fname in self._filenames():
+            mfile = self.files.pop(fname, None)
+            try:
+                st = os.stat(fname)
+                if mfile is None or mfile.key != (st.st_ino, st.st_mtime):
+                    if mfile is not None:
+                        mfile.close()
+                    mfile = _MappedFile(fname)
+            except (IOError, OSError, ValueError, struct.error):
+                if mfile is not None:
+                    mfile.close()
+                continue
+            if now - mfile.time < self.max_age:
+                files[fname] = mfile
+            else:
+                mfile.close()
+        for mfile in self.files.values():
+            mfile.close()
+        self.files = files
+
+    def available(self):
+        "whether any values file is current"
+        self.refresh()
+        return len(self.files) > 0
+
+    def get(self, pvname):
+        """return dict with pvname, type, value, cvalue, ts for a PV,
+        or None if the PV is not in a current values file"""
+        self.refresh()
+        for mfile in self.files.values():
+            row = mfile.get(pvname)
+            if row is not None:
+                return row
+        return None
+
+    def names(self):
+        "return list of PV names in the values files"
+        self.refresh()
+        out = []
+        for mfile in self.files.values():
+            out.extend(mfile.index.keys())
+        return out
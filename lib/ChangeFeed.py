@@ -0,0 +1,139 @@
+#!/usr/bin/env python
+"""
+Local change feed from the Cache process to the Archiver.
+
+The Archiver binds a UNIX datagram socket and the Cache sends each batch
+of changed (pvname, value, cvalue, ts, type) records to it right after
+writing them to the cache table.  This lets the Archiver see changes
+without polling the cache table.
+
+Every datagram carries the sender's process id and a sequence number,
+so that several cache processes can publish to one reader.  If the
+reader sees a gap for a sender (a datagram was dropped, or the Cache
+restarted), it reports this so the Archiver can re-read recent changes
+from the cache table once.
+"""
+import os
+import sys
+import time
+import errno
+import select
+import socket
+
+try:
+    import json
+except ImportError:
+    import simplejson as json
+
+class ChangeFeedPublisher:
+    """ send changed cache values to a listening ChangeFeedReader.
+    Sending never blocks:  if nobody is listening or the reader
+    is full, records are counted as dropped."""
+    max_batch = 100
+    def __init__(self, path):
+        self.path = path
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self.sock.setblocking(0)
+        self.sender = os.getpid()
+        self.seq = 0
+        self.nsent = 0
+        self.ndropped = 0
+
+    def publish(self, records):
+        """publish a list of (pvname, value, cvalue, ts, type) tuples,
+        returns number of records sent"""
+        nsent = 0
+        for i in range(0, len(records), self.max_batch):
+            batch = [[_enc(x) for x in rec] for rec in records[i:i+self.max_batch]]
+            self.seq = self.seq + 1
+            try:
+                self.sock.sendto(json.dumps([self.sender, self.seq, batch]),
+                                 self.path)
+                nsent = nsent + len(batch)
+            except socket.error:
+                self.ndropped = self.ndropped + len(batch)
+        self.nsent = self.nsent + nsent
+        return nsent
+
+    def close(self):
+        self.sock.close()
+
+class ChangeFeedReader:
+    """ receive changed cache values sent by a ChangeFeedPublisher.
+    read() returns (changes, gap), where changes is a list of cache-like
+    row dictionaries with only the most recent change for each PV, and
+    gap is True if some changes may have been missed."""
+    bufsize = 262144
+    def __init__(self, path):
+        self.path = path
+        if os.path.exists(path):
+            os.unlink(path)
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self.sock.bind(path)
+        os.chmod(path, 0600)
+        self.sock.setblocking(0)
+        self.last_seq = {}
+        self.t_lastgood = time.time()
+        self.nreceived = 0
+        self.ngaps = 0
+
+    def wait(self, timeout):
+        """wait up to timeout seconds for changes to arrive.
+        returns whether there are changes to read"""
+        try:
+            ready = select.select([self.sock], [], [], timeout)[0]
+        except select.error, e:
+            if e.args[0] != errno.EINTR:
+                raise
+            return False
+        return len(ready) > 0
+
+    def read(self):
+        changes = {}
+        gap = False
+        while True:
+            try:
+                msg = self.sock.recv(self.bufsize)
+            except socket.error, e:
+                if e.args[0] not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    sys.stdout.write('change feed read error: %s\n' % repr(e))
+                break
+            try:
+                sender, seq, batch = json.loads(msg)
+            except ValueError:
+                gap = True
+                continue
+            last_seq = self.last_seq.get(sender, None)
+            if last_seq is not None and seq != last_seq + 1:
+                gap = True
+            self.last_seq[sender] = seq
+            for rec in batch:
+                pvname, value, cvalue, ts, typ = [_dec(x) for x in rec]
+                old = changes.get(pvname, None)
+                if old is None or ts >= old['ts']:
+                    changes[pvname] = {'pvname': pvname, 'value': value,
+                                       'cvalue': cvalue, 'ts': ts, 'type': typ}
+            self.nreceived = self.nreceived + len(batch)
+        if gap:
+            self.ngaps = self.ngaps + 1
+        else:
+            self.t_lastgood = time.time()
+        return changes.values(), gap
+
+    def close(self):
+        self.sock.close()
+        try:
+            os.unlink(self.path)
+        except OSError:
+            pass
+
+def _enc(x):
+    # byte strings are sent as latin-1 so that any value survives json
+    if isinstance(x, str):
+        return x.decode('latin-1')
+    return x
+
+def _dec(x):
+    if isinstance(x, unicode):
+        return x.encode('latin-1')
+    return x
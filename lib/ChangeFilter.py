@@ -0,0 +1,203 @@
+#!/usr/bin/env python
+"""
+Deadtime and deadband filtering of changed PV values for the Archiver.
+
+A change is archived if more than the deadtime of the PV has passed since
+its last archived value and, for doubles and floats, if it differs from
+the last archived value by more than the deadband.  A change inside the
+deadtime is put in 'limbo', and archived once the deadtime has passed
+unless a newer value has been archived.
+
+With NumPy, the settings (deadtime, deadband, active) and the last
+archived time and value of each PV are kept in arrays, with one slot per
+PV, and each batch of changes is evaluated with array operations.
+Without NumPy, changes are evaluated one at a time from the Archiver's
+pvinfo dictionaries.
+"""
+import time
+
+try:
+    import numpy
+    HAS_NUMPY = True
+except ImportError:
+    HAS_NUMPY = False
+
+numeric_types = ('double', 'float')
+
+def _float(val):
+    "float of a value, or NaN"
+    try:
+        return float(val)
+    except (TypeError, ValueError):
+        return float('nan')
+
+class ChangeFilter:
+    """ select the changes to archive:
+
+    >>> filter = ChangeFilter(pvinfo)
+    >>> newvals = filter.select(changes)   # pvname -> (ts, value)
+
+    pvinfo is the Archiver's dictionary of pv table rows, which must also
+    have 'last_ts' and 'last_value'.  The Archiver calls set_last() when
+    it archives a value, and set_info() when the settings of a PV change.
+    """
+    array_names = ('deadtime', 'deadband', 'last_ts', 'last_val',
+                   'active', 'inlimbo')
+
+    def __init__(self, pvinfo, use_numpy=True):
+        self.pvinfo = pvinfo
+        self.use_numpy = use_numpy and HAS_NUMPY
+        # pvname -> (ts, value) for changes inside the deadtime
+        self.limbo = {}
+        self.slots = {}
+        self.names = []
+        if self.use_numpy:
+            self._alloc(1024)
+
+    def _alloc(self, size):
+        "(re)allocate arrays for size PVs, keeping current contents"
+        n = len(self.names)
+        arrays = {'deadtime': numpy.zeros(size),
+                  'deadband': numpy.zeros(size),
+                  'last_ts':  numpy.zeros(size),
+                  'last_val': numpy.nan * numpy.ones(size),
+                  'active':   numpy.zeros(size, dtype=bool),
+                  'inlimbo':  numpy.zeros(size, dtype=bool)}
+        for attr in self.array_names:
+            if n > 0:
+                arrays[attr][:n] = getattr(self, attr)[:n]
+            setattr(self, attr, arrays[attr])
+
+    def slot(self, name):
+        "array index for a PV, added from pvinfo if needed"
+        i = self.slots.get(name, None)
+        if i is None:
+            i = len(self.names)
+            if i >= len(self.deadtime):
+                self._alloc(2*len(self.deadtime))
+            self.slots[name] = i
+            self.names.append(name)
+            self._set_info(i, self.pvinfo[name])
+        return i
+
+    def _set_info(self, i, info):
+        self.deadtime[i] = info['deadtime'] or 0
+        self.deadband[i] = abs(info['deadband'] or 0)
+        self.active[i]   = info['active'] != 'no'
+        self.last_ts[i]  = info['last_ts'] or 0
+        self.last_val[i] = _float(info['last_value'])
+
+    def set_info(self, name):
+        "re-read settings of a PV from pvinfo"
+        if self.use_numpy:
+            self._set_info(self.slot(name), self.pvinfo[name])
+
+    def set_last(self, name, ts, val=None):
+        "note the time (and value) last archived for a PV"
+        if self.use_numpy:
+            i = self.slot(name)
+            self.last_ts[i] = ts
+            if val is not None:
+                self.last_val[i] = _float(val)
+
+    def select(self, changes, tnow=None):
+        """return dict of pvname -> (ts, value) of changes (rows of pvname,
+        value, ts, type) to archive, including changes leaving limbo"""
+        if tnow is None:
+            tnow = time.time()
+        if self.use_numpy:
+            return self._select_arrays(changes, tnow)
+        return self._select_python(changes, tnow)
+
+    def _select_python(self, changes, tnow):
+        newvals = {}
+        for dat in changes:
+            name  = dat['pvname']
+            val   = dat['value']
+            ts    = dat['ts'] or tnow
+            info = self.pvinfo[name]
+            if info['active'] == 'no' or name in newvals:
+                continue
+            last_ts   = info['last_ts'] or 0
+            last_val  = info['last_value']
+            do_save = ((ts-last_ts) > info['deadtime'])
+            if do_save and dat['type'] in numeric_types:
+                try:
+                    v, o = float(val), float(last_val)
+                    do_save = abs(v-o) > abs(info['deadband'])
+                except:
+                    pass
+            if do_save:
+                newvals[name] = (ts, val)
+                self.limbo.pop(name, None)
+            elif (ts-last_ts) > 1.e-3:   # pv changed, but inside 'deadtime': put it in limbo!
+                self.limbo[name] = (ts, val)
+
+        # archive the most recent change in limbo if the last
+        # archived value is older than the deadtime
+        for name in self.limbo.keys():
+            info = self.pvinfo[name]
+            if info['active'] == 'no': continue
+            if (tnow - info['last_ts']) > info['deadtime']:
+                newvals[name] = self.limbo.pop(name)
+        return newvals
+
+    def _select_arrays(self, changes, tnow):
+        # latest change for each PV
+        latest = {}
+        for dat in changes:
+            name = dat['pvname']
+            if name not in latest or (dat['ts'] or tnow) >= (latest[name]['ts'] or tnow):
+                latest[name] = dat
+        names = latest.keys()
+        slots, times, vals, fvals, numeric = [], [], [], [], []
+        for name in names:
+            dat = latest[name]
+            slots.append(self.slot(name))
+            times.append(dat['ts'] or tnow)
+            vals.append(dat['value'])
+            numeric.append(dat['type'] in numeric_types)
+            fvals.append(dat['value'] if numeric[-1] else 'nan')
+        newvals = {}
+        if len(names) > 0:
+            idx = numpy.array(slots, dtype=int)
+            ts  = numpy.array(times, dtype=float)
+            try:
+                val = numpy.array(fvals, dtype=float)
+            except (TypeError, ValueError):
+                val = numpy.array([_float(v) for v in fvals])
+            numeric = numpy.array(numeric, dtype=bool)
+
+            dt  = ts - self.last_ts[idx]
+            old = self.last_val[idx]
+            active = self.active[idx]
+            save = active & (dt > self.deadtime[idx])
+            err = numpy.seterr(invalid='ignore')
+            try:
+                check  = numeric & numpy.isfinite(val) & numpy.isfinite(old)
+                inband = check & ~(numpy.abs(val - old) > self.deadband[idx])
+            finally:
+                numpy.seterr(**err)
+            save = save & ~inband
+            # changed inside the deadtime: put it in limbo
+            hold = active & ~save & (dt > 1.e-3)
+
+            for j in numpy.nonzero(save)[0]:
+                name = names[j]
+                newvals[name] = (times[j], vals[j])
+                self.limbo.pop(name, None)
+            self.inlimbo[idx[save]] = False
+            for j in numpy.nonzero(hold)[0]:
+                self.limbo[names[j]] = (times[j], vals[j])
+            self.inlimbo[idx[hold]] = True
+
+        # archive the most recent change in limbo if the last
+        # archived value is older than the deadtime
+        n = len(self.names)
+        due = (self.inlimbo[:n] & self.active[:n] &
+               ((tnow - self.last_ts[:n]) > self.deadtime[:n]))
+        for i in numpy.nonzero(due)[0]:
+            name = self.names[i]
+            newvals[name] = self.limbo.pop(name)
+        self.inlimbo[:n][due] = False
+        return newvals
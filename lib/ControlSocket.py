@@ -0,0 +1,140 @@
+#!/usr/bin/env python
+"""
+Local control socket for the Cache process.
+
+The Cache listens on a UNIX stream socket for one-line commands:
+
+   add PVNAME        start caching a PV
+   drop PVNAME       stop caching a PV and remove it from the cache
+   suspend PVNAME    stop updating a PV
+   status            one-line status of the cache process
+
+A listener thread accepts connections and reads commands, putting them on
+a queue.  The Cache main loop takes commands from the queue, so they are
+acted on within one pass of the loop, and writes a one-line reply
+('ok', 'fail', or the status) before closing the connection.
+
+send_command() is the client side:  it returns None if no cache process
+is listening, so that callers can fall back to the requests table.
+"""
+import os
+import socket
+import threading
+import Queue
+
+import config
+
+default_path = getattr(config, 'cache_control_socket',
+                       os.path.join(config.logdir, 'cache_control.sock'))
+
+actions = ('add', 'drop', 'suspend', 'status')
+
+class ControlServer:
+    """ accept commands on a UNIX stream socket.  If event (a
+    threading.Event) is given, it is set when a command arrives."""
+    timeout = 2.0
+    def __init__(self, path=None, event=None):
+        if path is None:
+            path = default_path
+        self.path = path
+        self.event = event
+        self.queue = Queue.Queue()
+        if os.path.exists(path):
+            os.unlink(path)
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.bind(path)
+        os.chmod(path, 0660)
+        self.sock.listen(16)
+        self.sock.settimeout(1.0)
+        self.running = True
+        self.thread = threading.Thread(target=self._listen)
+        self.thread.setDaemon(True)
+        self.thread.start()
+
+    def _listen(self):
+        while self.running:
+            try:
+                conn, addr = self.sock.accept()
+            except socket.timeout:
+                continue
+            except socket.error:
+                break
+            try:
+                conn.settimeout(self.timeout)
+                line = ''
+                while '\n' not in line and len(line) < 1024:
+                    dat = conn.recv(1024)
+                    if len(dat) == 0:
+                        break
+                    line = line + dat
+                words = line.split()
+            except socket.error:
+                conn.close()
+                continue
+            if len(words) == 0 or words[0] not in actions:
+                self._reply(conn, 'fail')
+                continue
+            pvname = None
+            if len(words) > 1:
+                pvname = words[1]
+            self.queue.put((words[0], pvname, conn))
+            if self.event is not None:
+                self.event.set()
+
+    def _reply(self, conn, msg):
+        try:
+            conn.sendall('%s\n' % msg)
+        except socket.error:
+            pass
+        conn.close()
+
+    def get_commands(self):
+        """return list of (action, pvname, reply) for the commands received.
+        reply(msg) must be called for each command."""
+        out = []
+        while True:
+            try:
+                action, pvname, conn = self.queue.get_nowait()
+            except Queue.Empty:
+                break
+            out.append((action, pvname,
+                        lambda msg, conn=conn: self._reply(conn, msg)))
+        return out
+
+    def close(self):
+        self.running = False
+        self.sock.close()
+        try:
+            os.unlink(self.path)
+        except OSError:
+            pass
+
+def send_command(action, pvname=None, path=None, timeout=5.0):
+    """send a command to the cache process, returns the reply, or
+    None if no cache process is listening on the control socket"""
+    if path is None:
+        path = default_path
+    if not os.path.exists(path):
+        return None
+    cmd = action
+    if pvname is not None:
+        cmd = '%s %s' % (action, pvname)
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.settimeout(timeout)
+    try:
+        try:
+            sock.connect(path)
+            sock.sendall('%s\n' % cmd)
+            reply = ''
+            while '\n' not in reply:
+                dat = sock.recv(1024)
+                if len(dat) == 0:
+                    break
+                reply = reply + dat
+        except socket.error:
+            return None
+    finally:
+        sock.close()
+    if len(reply) == 0:
+        return None
+    return reply.strip()
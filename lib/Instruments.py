@@ -102,7 +102,6 @@ class Instruments(MasterDB):
             return None
         inst_id = insts[0]['id']
 
-        self.get_pvnames()
         for pvname in pvlist:
             pvn = normalize_pvname(pvname)
 
@@ -110,7 +109,7 @@ class Instruments(MasterDB):
             x = self.inst_pvs.select_one(where=where)
             if x == {}:
                 x = self.inst_pvs.insert(pvname=pvn,inst=inst_id)
-            if pvn not in self.pvnames:  self.add_pv(pvn)
+            if not self.in_cache(pvn):  self.add_pv(pvn)
 
         # set pair scores
         allpvs = self.get_instrument_pvs(name=name,station=station)
@@ -253,8 +252,7 @@ class Alerts(MasterDB):
         
         pvname = normalize_pvname(pvname)        
         if name is None: name = pvname
-        if len(self.pvnames)== 0: self.get_pvnames()
-        if pvname not in self.pvnames: self.add_pv(pvname)
+        if not self.in_cache(pvname): self.add_pv(pvname)
 
         active = 'yes'
         if mailto  is None:
@@ -7,6 +7,8 @@ import smtplib
 
 import epics
 from SimpleDB import SimpleDB, SimpleTable
+from PVRegistry import registry as shared_registry
+from ControlSocket import send_command
 from config import dbuser, dbpass, dbhost, master_db, \
      mailserver, mailfrom, cgi_url
 
@@ -52,8 +54,16 @@ class MasterDB:
     ops = {'eq':'__eq__', 'ne':'__ne__', 
            'le':'__le__', 'lt':'__lt__', 
            'ge':'__ge__', 'gt':'__gt__'}
+
+    # how the Cache acquires a PV: a plain monitor, a monitor with at most
+    # one value per interval, or a read every interval seconds.
+    acq_policies = ('monitor', 'ratelimit', 'scan')
+
+    # Channel Access monitor masks the Cache can use for a PV:
+    # '' is the default mask (cache_monitor_mask in config.py)
+    monitor_masks = ('', 'value+alarm', 'log+alarm', 'log', 'value')
            
-    def __init__(self,dbconn=None, **kw):
+    def __init__(self,dbconn=None, registry=None, **kw):
 
         self.db = SimpleDB(dbconn=dbconn)
         self.dbconn = self.db.conn
@@ -71,7 +81,11 @@ class MasterDB:
         self.alerts = self.db.tables['alerts']
         
         self.arch_db = self._get_info('db',  process='archive')
+        if registry is None:
+            registry = shared_registry
+        self.registry = registry
         self.pvnames = []
+        self.pv_ids  = self.registry.ids
         
     def use_master(self):
         "point db cursor to use master database"
@@ -90,21 +104,29 @@ class MasterDB:
         self.db.use(master_db)
         
     def get_pvnames(self):
-        """ generate self.pvnames: a list of pvnames in the cache"""
-        self.pvnames = [i['pvname'] for i in self.cache.select()]
-        # 
-        #         for i in self.cache.select():
-        #             if i['pvname'] not in self.pvnames:
-        #                 self.pvnames.append(i['pvname'])
+        """ generate self.pvnames: a list of pvnames in the cache.
+        The PV registry (and so self.pv_ids, a dictionary of cache
+        row ids by pvname) is brought up to date first."""
+        self.registry.sync(self.db)
+        self.pvnames = self.registry.names()
         return self.pvnames
+
+    def in_cache(self,pvname):
+        """return whether a (normalized) pvname is in the cache.
+        An unknown name brings the PV registry up to date, at most
+        once per second."""
+        if pvname not in self.registry:
+            self.registry.sync(self.db, max_age=1.0)
+        return pvname in self.registry
     
     def request_pv_cache(self,pvname):
         """request a PV to be included in caching.
-        will take effect once a 'process_requests' is executed."""
-        self.db.use(master_db)
+        This is sent to the running cache process on its control socket,
+        or if that fails, put in the requests table, which the cache
+        reads every 15 seconds."""
         npv = normalize_pvname(pvname)
-        if len(self.pvnames)== 0: self.get_pvnames()
-        if npv in self.pvnames: return
+        if self.in_cache(npv): return
+        if send_command('add', npv) == 'ok': return
 
         cmd = "insert into requests (pvname,action,ts) values ('%s','add',%f)" % (npv,time.time())
         self.db.execute(cmd)
@@ -161,14 +183,51 @@ class MasterDB:
 
     def drop_pv(self,pvname):
         """drop a PV from the caching process -- really this 'suspends updates'
-        will take effect once a 'process_requests' is executed."""
+        sent to the cache process on its control socket, or if that fails,
+        put in the requests table, read by the cache every 15 seconds."""
         npv = normalize_pvname(pvname)
-        if len(self.pvnames)== 0: self.get_pvnames()
-        if not npv in self.pvnames: return
+        if not self.in_cache(npv): return
+        if send_command('suspend', npv) == 'ok': return
 
         cmd = "insert into requests (pvname,action) values ('%s','suspend')" % npv
         self.db.execute(cmd)
 
+    def get_acq_policy(self,pvname):
+        """return (policy, interval) for how the Cache acquires a PV"""
+        if 'acq_policy' not in self.cache.fieldtypes:
+            return ('monitor', 0)
+        npv = normalize_pvname(pvname)
+        r = self.cache.select_one(vals='acq_policy,acq_interval',
+                                  where="pvname='%s'" % npv)
+        return (r.get('acq_policy', 'monitor'), r.get('acq_interval', 0))
+
+    def set_acq_policy(self,pvname,policy='monitor',interval=0):
+        """set how the Cache acquires a PV: policy is one of 'monitor',
+        'ratelimit', or 'scan', and interval the minimum time between values
+        (ratelimit) or the time between reads (scan), in seconds.
+        takes effect when the Cache next reads policies."""
+        if 'acq_policy' not in self.cache.fieldtypes or policy not in self.acq_policies:
+            return
+        npv = normalize_pvname(pvname)
+        self.cache.update(where="pvname='%s'" % npv,
+                          acq_policy=policy, acq_interval=interval)
+
+    def get_monitor_mask(self,pvname):
+        """return the monitor mask the Cache uses for a PV ('' for default)"""
+        if 'monitor_mask' not in self.cache.fieldtypes:
+            return ''
+        npv = normalize_pvname(pvname)
+        r = self.cache.select_one(vals='monitor_mask', where="pvname='%s'" % npv)
+        return r.get('monitor_mask', '')
+
+    def set_monitor_mask(self,pvname,mask=''):
+        """set the monitor mask the Cache uses for a PV, one of monitor_masks.
+        takes effect when the Cache next reads policies."""
+        if 'monitor_mask' not in self.cache.fieldtypes or mask not in self.monitor_masks:
+            return
+        npv = normalize_pvname(pvname)
+        self.cache.update(where="pvname='%s'" % npv, monitor_mask=mask)
+
     def get_recent(self,dt=60):
         """get recent additions to the cache, those
         inserted in the last  dt  seconds."""
@@ -236,23 +295,19 @@ class MasterDB:
     ## Status/Activity Reports 
     def get_npvs(self):
         """return the number of pvs in archive"""
-        self.db.use(self.arch_db)
-        r = self.db.exec_fetch('select id from pv')
-        self.db.use(master_db)
-        return len(r)
+        r = self.db.exec_fetchone('select count(id) as n from %s.pv' % self.arch_db)
+        return r['n']
 
     def arch_nchanged(self,minutes=10,max = None):
         """return the number of values archived in the past minutes. """
-        self.db.use(self.arch_db)
         n = 0
         t0 = time.time()
         dt = (time.time()-minutes*60.)
-        q = "select pv_id from pvdat%3.3i where time > %f " 
+        q = "select pv_id from %s.pvdat%%3.3i where time > %%f " % self.arch_db
         self.db.get_cursor()
         for i in range(1,129):
             n = n + self.db.cursor.execute(q % (i,dt))
             if max is not None and n > max: break
-        self.db.use(master_db)
         return n
 
     def arch_report(self,minutes=10):
@@ -324,8 +379,7 @@ class MasterDB:
         out = []
         tmp = []
         npv = normalize_pvname(pv)
-        if len(self.pvnames)== 0: self.get_pvnames()
-        if npv not in self.pvnames: return out
+        if not self.in_cache(npv): return out
         for i in ('pv1','pv2'):
             where = "%s='%s' and score>=%i order by score" 
             for j in self.pairs.select(where = where % (i,npv,minscore)):
@@ -348,8 +402,7 @@ class MasterDB:
         "set pair score for 2 pvs"        
         p = self.__get_pvpairs(pv1,pv2)
         score = -1
-        if len(self.pvnames)== 0: self.get_pvnames()
-        if (p[0] in self.pvnames) and (p[1] in self.pvnames):
+        if self.in_cache(p[0]) and self.in_cache(p[1]):
             o  = self.pairs.select_one(where= "pv1='%s' and pv2='%s'" % p)
             score = int(o.get('score',-1))
         return score
@@ -363,7 +416,7 @@ class MasterDB:
             wait_count = 0
             while current_score is None and wait_count < 10:
                 time.sleep(0.1)
-                self.get_pvnames()
+                self.registry.sync(self.db)
 
                 current_score  = self.get_pair_score(p[0],p[1])                
                 wait_count = wait_count + 1
@@ -395,14 +448,13 @@ class MasterDB:
         # in pvnames.  If not, let's give them a chance!
         newnames = False
         wait_count = 0
-        if len(self.pvnames)== 0: self.get_pvnames()
         while newnames and wait_count < 10:
             newnames = False
             for i in _tmp:
-                newnames = newnames or (i not in self.pvnames)
+                newnames = newnames or (i not in self.registry)
 
             time.sleep(0.1)
-            self.get_pvnames()
+            self.registry.sync(self.db)
             wait_count = wait_count + 1
 
         while _tmp:
@@ -413,6 +465,43 @@ class MasterDB:
                     
         self.pairs.select()
 
+    def set_bulk_pairs(self,pvgroups,score=10):
+        """for a list of groups of pvs, set the pair scores of all pairs
+        in each group to be at least the provided score, using one select
+        and bulk inserts and updates.  returns the number of pairs set"""
+        self.registry.sync(self.db)
+        pairs = set()
+        for group in pvgroups:
+            names = [normalize_pvname(p) for p in group]
+            names = [p for p in names if p in self.registry]
+            for i, a in enumerate(names):
+                for b in names[i+1:]:
+                    if a != b:
+                        pairs.add(self.__get_pvpairs(a,b))
+        if len(pairs) == 0:
+            return 0
+
+        nchunk = 500
+        known = {}
+        pv1s = list(set([p[0] for p in pairs]))
+        for i in range(0, len(pv1s), nchunk):
+            names = ','.join(["'%s'" % p for p in pv1s[i:i+nchunk]])
+            q = "select id,pv1,pv2,score from pairs where pv1 in (%s)" % names
+            for r in self.db.exec_fetch(q):
+                key = (r['pv1'], r['pv2'])
+                if key in pairs:
+                    known[key] = (r['id'], r['score'])
+
+        new = ["('%s','%s',%i)" % (p[0],p[1],score) for p in pairs if p not in known]
+        low = ['%i' % id for id, s in known.values() if s < score]
+        for i in range(0, len(new), nchunk):
+            self.db.execute("insert into pairs (pv1,pv2,score) values %s" %
+                            ','.join(new[i:i+nchunk]))
+        for i in range(0, len(low), nchunk):
+            self.db.execute("update pairs set score=%i where id in (%s)" %
+                            (score, ','.join(low[i:i+nchunk])))
+        return len(new) + len(low)
+
     ##
     ## Instruments
     def get_instruments_with_pv(self,pv):
@@ -460,8 +549,7 @@ class MasterDB:
         
         pvname = normalize_pvname(pvname)        
         if name is None: name = pvname
-        if len(self.pvnames)== 0: self.get_pvnames()
-        if pvname not in self.pvnames:
+        if not self.in_cache(pvname):
             self.add_pv(pvname)
 
         active = 'yes'
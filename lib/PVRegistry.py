@@ -0,0 +1,105 @@
+#!/usr/bin/env python
+"""
+Registry of the PVs in the cache table:  pvname -> cache row id and type.
+
+The registry is read from the database once and then brought up to date
+incrementally:  a sync reads only rows with an id above the largest id
+seen so far.  Rows are only deleted by dropping PVs, which is rare, so a
+sync also compares the number of rows in the cache table with the number
+read, and re-reads the whole table when they differ.
+
+One registry is shared by all MasterDB objects of a process (Cache,
+Instruments, ArchiveMaster, WebStatus, ...).  Queries use fully qualified
+table names, so a sync does not depend on the database in use.
+"""
+import time
+import threading
+
+from config import master_db
+
+class PVRegistry:
+    """ pvname -> cache id and type for the PVs in the cache table.
+    Membership tests and lookups are dictionary lookups:
+
+    >>> registry.sync(db)
+    >>> if pvname in registry: id = registry.get_id(pvname)
+    """
+    def __init__(self):
+        self.ids   = {}
+        self.types = {}
+        self.max_id = 0
+        self.nrows = 0
+        self.last_sync = 0
+        self.lock = threading.Lock()
+
+    def __contains__(self, pvname):
+        return pvname in self.ids
+
+    def __len__(self):
+        return len(self.ids)
+
+    def names(self):
+        "return a list of all pvnames"
+        return self.ids.keys()
+
+    def get_id(self, pvname, default=None):
+        return self.ids.get(pvname, default)
+
+    def get_type(self, pvname, default=None):
+        return self.types.get(pvname, default)
+
+    def add(self, pvname, id, type=None):
+        "add a row just inserted in the cache table by this process"
+        if pvname not in self.ids:
+            self.nrows = self.nrows + 1
+        self.ids[pvname] = id
+        self.types[pvname] = type
+        self.max_id = max(self.max_id, id)
+
+    def remove(self, pvname):
+        """remove a row just deleted from the cache table by this process.
+        returns its cache id, or None if the pvname was not known."""
+        self.types.pop(pvname, None)
+        id = self.ids.pop(pvname, None)
+        if id is not None:
+            self.nrows = self.nrows - 1
+        return id
+
+    def clear(self):
+        # cleared in place: MasterDB objects keep a reference to self.ids
+        self.ids.clear()
+        self.types.clear()
+        self.max_id = 0
+        self.nrows = 0
+
+    def _read_rows(self, rows):
+        for r in rows:
+            if 'pvname' not in r:
+                continue
+            self.ids[r['pvname']] = r['id']
+            self.types[r['pvname']] = r['type']
+            self.max_id = max(self.max_id, r['id'])
+            self.nrows = self.nrows + 1
+
+    def sync(self, db, max_age=0):
+        """bring the registry up to date with the cache table, using the
+        SimpleDB db.  Nothing is done if the last sync was less than
+        max_age seconds ago.  returns whether a sync was done."""
+        now = time.time()
+        if now - self.last_sync < max_age:
+            return False
+        q_rows = "select id,pvname,type from %s.cache" % master_db
+        self.lock.acquire()
+        try:
+            self._read_rows(db.exec_fetch("%s where id>%i" % (q_rows, self.max_id)))
+            r = db.exec_fetch("select count(id) as n from %s.cache" % master_db)
+            if len(r) > 0 and r[0].get('n', self.nrows) != self.nrows:
+                self.clear()
+                self._read_rows(db.exec_fetch(q_rows))
+            self.last_sync = now
+        finally:
+            self.lock.release()
+        return True
+
+# the registry shared by MasterDB objects
+registry = PVRegistry()
@@ -12,6 +12,7 @@ from EpicsArchiver.HTMLWriter import HTMLWriter, jscal_get_2dates
 DEBUG=False
 HAS_GNUPLOT = False
 plotpage   = "%s/plot" % config.cgi_url
+pairs_table = "%s.pairs" % config.master_db
 
 os.environ['GNUTERM'] = 'png'
 
@@ -169,10 +170,10 @@ set ytics nomirror
     def get_related_pvs(self,pvname):
         tmp = []  
         npv = normalize_pvname(pvname)
-        r1 = self.arch.read_master("select * from pairs where pv1='%s' and score>1 order by score" %npv)
+        r1 = self.arch.read_master("select * from %s where pv1='%s' and score>1 order by score" % (pairs_table,npv))
         for j in r1: tmp.append((j['score'],j['pv1'],j['pv2']))
         
-        r2 = self.arch.read_master("select * from pairs where pv2='%s' and score>1 order by score" %npv)
+        r2 = self.arch.read_master("select * from %s where pv2='%s' and score>1 order by score" % (pairs_table,npv))
         for j in r2: tmp.append((j['score'],j['pv1'],j['pv2']))
 
         tmp.sort()
@@ -195,19 +196,19 @@ set ytics nomirror
         # get current score:
         pvns = self.__get_pvpairs(pv1,pv2)
         where = "pv1='%s' and pv2='%s'" % pvns
-        o  = self.arch.read_master("select * from pairs where %s" % where)
+        o  = self.arch.read_master("select * from %s where %s" % (pairs_table,where))
         try:
             score = int(o[0]['score'])
         except:
             score = -1
 
         if score < 1:
-            q = "insert into pairs set score=%i, pv1='%s', pv2='%s'"
+            q = "insert into %s set score=%i, pv1='%s', pv2='%s'"
         else:
-            q = "update pairs set score=%i where pv1='%s' and pv2='%s'"
+            q = "update %s set score=%i where pv1='%s' and pv2='%s'"
             
         score = max(1, score+1)
-        self.arch.read_master(q % (score,pvns[0],pvns[1]))
+        self.arch.read_master(q % (pairs_table,score,pvns[0],pvns[1]))
 
         
     def make_related_pvs_page(self,pvname,pvname2,submit='',time_ago='',date1='',date2=''):
@@ -431,7 +432,6 @@ set ytics nomirror
             '%s' u 1:4 axis x1y2 t '' w p ls 2 """ %
                     (f_dat,desc,f_dat,f_dat2,desc2,f_dat2))
 
-        self.arch.use_currentDB()
         wait_count = 0
         png_size = 0
         while wait_for_pngfile:
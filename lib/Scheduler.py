@@ -0,0 +1,90 @@
+#!/usr/bin/env python
+"""
+Timer scheduler for the periodic tasks of a main loop.
+
+Tasks are kept in a heap ordered by the time they are next due, using a
+monotonic clock.  The main loop calls run_pending() between its other
+work: every task that is due is run, however late.  When a task falls
+more than one period behind, its missed runs are skipped but the
+lateness is recorded.
+"""
+import heapq
+from util import monotonic
+
+class Scheduler:
+    def __init__(self):
+        self.tasks = {}
+        self.heap  = []
+
+    def add(self, name, func, period, delay=None):
+        """add a task, to be run every period seconds.
+        The first run is after delay seconds (default: period)."""
+        if delay is None:
+            delay = period
+        self.tasks[name] = {'func': func, 'period': period}
+        self.clear_stats(name)
+        heapq.heappush(self.heap, (monotonic() + delay, name))
+
+    def set_period(self, name, period):
+        "change the period of a task, starting after its next run"
+        if name in self.tasks:
+            self.tasks[name]['period'] = period
+
+    def next_due(self):
+        "return seconds until the next task is due, or None if there are no tasks"
+        if len(self.heap) == 0:
+            return None
+        return max(0, self.heap[0][0] - monotonic())
+
+    def run_pending(self):
+        "run all tasks that are due, returns the number of tasks run"
+        nrun = 0
+        now = monotonic()
+        while len(self.heap) > 0 and self.heap[0][0] <= now:
+            due, name = heapq.heappop(self.heap)
+            task = self.tasks[name]
+            t0 = monotonic()
+            try:
+                task['func']()
+            finally:
+                t1 = monotonic()
+                late = t0 - due
+                task['nrun'] += 1
+                task['runtime'] += t1 - t0
+                task['maxtime']  = max(task['maxtime'], t1 - t0)
+                task['lateness'] += late
+                task['maxlate']  = max(task['maxlate'], late)
+                next_due = due + task['period']
+                if next_due < t1:
+                    task['nskipped'] += int((t1 - next_due) / task['period']) + 1
+                    next_due = t1 + task['period']
+                heapq.heappush(self.heap, (next_due, name))
+            nrun = nrun + 1
+            now = monotonic()
+        return nrun
+
+    def clear_stats(self, name=None):
+        names = [name]
+        if name is None:
+            names = self.tasks.keys()
+        for name in names:
+            self.tasks[name].update({'nrun': 0, 'nskipped': 0,
+                                     'runtime': 0.0, 'maxtime': 0.0,
+                                     'lateness': 0.0, 'maxlate': 0.0})
+
+    def report(self, clear=True):
+        """return a report (list of text lines) of the number of runs,
+        run time and lateness for each task"""
+        out = ['   task          period  runs skipped   run time (avg/max)   lateness (avg/max)']
+        fmt = '   %-12s %7.1f %5i %7i   %8.4f / %8.4f   %8.4f / %8.4f'
+        names = self.tasks.keys()
+        names.sort()
+        for name in names:
+            t = self.tasks[name]
+            n = max(1, t['nrun'])
+            out.append(fmt % (name, t['period'], t['nrun'], t['nskipped'],
+                              t['runtime']/n, t['maxtime'],
+                              t['lateness']/n, t['maxlate']))
+        if clear:
+            self.clear_stats()
+        return out
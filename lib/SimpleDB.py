@@ -18,10 +18,24 @@ from util import string_literal, clean_string, safe_string, clean_input
 from config import master_db, dbuser, dbpass, dbhost, mysqldump
 
 class Connection:
-    def __init__(self,dbname=master_db,user=dbuser,passwd=dbpass,host=dbhost):
-        self.conn = MySQLdb.connect(user=user, db=dbname, passwd=passwd,host=host)
+    def __init__(self,dbname=master_db,user=dbuser,passwd=dbpass,host=dbhost,
+                 local_infile=0):
+        self.args = {'user': user, 'db': dbname, 'passwd': passwd,
+                     'host': host, 'local_infile': local_infile}
+        self.connect()
+
+    def connect(self):
+        self.conn = MySQLdb.connect(**self.args)
         self.cursor = self.conn.cursor(cursorclass=MySQLdb.cursors.DictCursor)
-        
+
+    def reconnect(self):
+        "open a new connection, as after the server has restarted"
+        try:
+            self.conn.close()
+        except:
+            pass
+        self.connect()
+
     def close(self):  self.conn.close()
 
 class ConnectionPool(Queue):
@@ -255,6 +269,7 @@ class SimpleDB:
     
     def set_autocommit(self,commit=1):
         self.get_cursor()
+        self.autocommit = commit
         # sys.stdout.write(" set autocommit %i /cursor = %s \n" % (commit,repr(self.cursor)))
         self.cursor.execute("set AUTOCOMMIT=%i" % commit)        
 
@@ -266,6 +281,25 @@ class SimpleDB:
         self.get_cursor()
         self.cursor.execute("commit")
 
+    def reconnect(self):
+        """reopen the database connection if it has been lost, as when
+        the server restarts.  returns whether the connection works"""
+        self.get_cursor()
+        try:
+            self.conn.conn.ping()
+            return True
+        except:
+            pass
+        try:
+            self.conn.reconnect()
+            self.cursor = self.conn.cursor
+            self.set_autocommit(self.autocommit)
+            self.use(self.dbname)
+        except:
+            return False
+        self.write("reconnected to database %s" % self.dbname)
+        return True
+
     def put_cursor(self):
         " return a cursor to the Connection pool"        
         if self.cursor is not None:
@@ -374,6 +408,22 @@ class SimpleDB:
         return None
 
             
+    def executemany(self,q,args,retries=50):
+        """execute a query for a list of argument tuples, as with
+        cursor.executemany():  for an insert, this is sent as a single
+        multi-row insert.  Retried like execute(), up to retries times.
+        returns None if the query failed."""
+        if self.cursor is None: self.get_cursor()
+        n = 0
+        while n < retries:
+            n = n + 1
+            try:
+                return self.cursor.executemany(q,args)
+            except:
+                time.sleep(0.010)
+        self.write("Query Failed: %s (%i rows)" % (q,len(args)))
+        return None
+
     def _normalize_dict(self, indict):
         """ internal 'normalization' of query outputs,
         converting unicode to str and array data to lists"""
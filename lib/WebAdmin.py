@@ -107,6 +107,18 @@ class WebAdmin(HTMLWriter):
             wr("<p>%s&nbsp;&nbsp;</p>" % self.link(link="%s?pv=%s" % (plotpage,pvname),
                                                    text=pvname))
             self.master.use_master()
+            if self.kw.has_key('acq_policy'):
+                try:
+                    interval = float(self.kw.get('acq_interval','0').strip())
+                except ValueError:
+                    interval = 0
+                self.master.set_acq_policy(pvname, clean_input(self.kw['acq_policy']),
+                                           interval)
+            if self.kw.has_key('monitor_mask'):
+                mask = clean_input(self.kw['monitor_mask'])
+                if mask == 'default':
+                    mask = ''
+                self.master.set_monitor_mask(pvname, mask)
             self.endhtml()
             return self.get_buffer()
 
@@ -154,6 +166,24 @@ class WebAdmin(HTMLWriter):
             radios.append(self.radio(checked=checked, name='graph_type',value=i))
 
         self.addrow("Graph Type",          " ".join(radios))
+
+        self.master.use_master()
+        # the cache table of an older database has no policy columns
+        if 'acq_policy' in self.master.cache.fieldtypes:
+            policy, interval = self.master.get_acq_policy(pvname)
+            radios = []
+            for i in self.master.acq_policies:
+                radios.append(self.radio(checked=(i==policy), name='acq_policy',value=i))
+            self.addrow("Cache Policy",        " ".join(radios))
+            self.addrow("Cache Interval (seconds)",
+                        self.textinput(name='acq_interval',value=interval))
+        if 'monitor_mask' in self.master.cache.fieldtypes:
+            mask = self.master.get_monitor_mask(pvname)
+            radios = []
+            for i in self.master.monitor_masks:
+                radios.append(self.radio(checked=(i==mask), name='monitor_mask',
+                                         value=(i or 'default')))
+            self.addrow("Monitor Mask",        " ".join(radios))
         self.addrow(self.button(text='Update PV Settings'), "")
         self.addrow('<hr>',spans=(2,0))        
         self.endtable()
@@ -93,6 +93,8 @@ program <tt>pvarch</tt>.  Typical usages of this program are:
 <tr><td><tt>pvarch cache restart   </tt></td><td>   restart cache process </td></tr>
 <tr><td><tt>pvarch cache status    </tt></td><td>   show # of PVs cached in past 60 seconds  </td></tr>
 <tr><td><tt>pvarch cache activity  </tt></td><td>   show list of PVs cached in past 60 seconds </td></tr>
+<tr><td><tt>pvarch cache top       </tt></td><td>   show the 20 PVs writing the most data to the cache </td></tr>
+<tr><td><tt>pvarch cache dump      </tt></td><td>   print per-PV cache statistics as JSON </td></tr>
 
 <tr><td colspan=2></td></tr><tr><td colspan=2> <font color='#440099'>Adding and removing PVs</font> </td></tr>
 <tr><td><tt>pvarch add_pv     </tt></td><td>    add a PV to the cache and archive </td></tr>
@@ -4,6 +4,7 @@ import time
 from EpicsArchiver import Instruments, config
 
 from HTMLWriter import HTMLWriter, jscal_get_date
+from CacheSnapshot import CacheSnapshot
 
 from util import normalize_pvname,  clean_input, \
      tformat, time_str2sec, write_saverestore
@@ -17,6 +18,9 @@ pvinfopage = "%s/admin.py/pvinfo" % config.cgi_url
 
 DEBUG = False
 
+# current values written by the cache
+values = CacheSnapshot()
+
 class WebInstruments(HTMLWriter):
     POS_DATE = '__(position_by_date)__'
     html_title = 'Epics Instruments'
@@ -296,7 +300,9 @@ class WebInstruments(HTMLWriter):
         
         for pvname,val in pv_vals:
             curval  = 'Unknown'
-            cacheval =  self.arch.cache.select_one(where="pvname='%s'"%pvname)
+            cacheval =  values.get(pvname)
+            if cacheval is None:
+                cacheval =  self.arch.cache.select_one(where="pvname='%s'"%pvname)
             if cacheval.has_key('value'):  curval = str(cacheval['value'])
             wr("<tr><td width=20%% >%s</td><td width=30%% >%s</td><td width=30%% >%s</td></tr>" % (pvname,str(val),curval))
 
@@ -3,6 +3,7 @@
 import time
 from EpicsArchiver import Cache, config
 from util import normalize_pvname
+from CacheSnapshot import CacheSnapshot
 pagetitle  = config.pagetitle
 footer     = config.footer
 
@@ -13,6 +14,9 @@ alertspage = "%s/admin/list_alerts" % config.cgi_url
 adminpage  = "%s/admin/"             % config.cgi_url
 helppage   = "%s/help/templates"  % config.cgi_url
 
+# current values written by the cache, shared by WebStatus objects
+values = CacheSnapshot()
+
 htmlhead = """<html>
 <head><title>%s</title><meta http-equiv='Pragma'  content='no-cache'><meta http-equiv='Refresh' content=%s>
 %s</head>"""
@@ -48,15 +52,24 @@ class WebStatus:
         self.buffer = []
         return r
 
-    def get_pv(self,pv,format=None,desc=None,outtype=None):
-        """ get cached value for a PV, formatted """
+    def get_cached(self, pv):
+        """ get cache row for a PV: from the values file written by the
+        cache, or if that is not current or does not have the PV, from a
+        copy of the cache table re-read every 10 seconds """
+        if values.available():
+            ret = values.get(pv)
+            if ret is not None:
+                return ret
         if (time.time()-self.dat_time ) > 10.0:
             self.dat_time = time.time()
             self.dat_cached = {}
             for i in self.cache.cache.select():
                 self.dat_cached[i['pvname']] = i
-            
-        ret = self.dat_cached.get(pv,None)
+        return self.dat_cached.get(pv,None)
+
+    def get_pv(self,pv,format=None,desc=None,outtype=None):
+        """ get cached value for a PV, formatted """
+        ret = self.get_cached(pv)
         if ret is None:
             self.pvget(pv,add=True)
             if desc is None: desc = pv
@@ -74,7 +87,7 @@ class WebStatus:
             idot   = pv.find('.')
             if idot == -1: idot = len(pv)
             descpv = "%s.DESC" % pv[:idot]
-            rx = self.dat_cached.get(descpv,None)
+            rx = self.get_cached(descpv)
             if rx is not None:
                 desc = rx['cvalue']
             else:
@@ -23,10 +23,13 @@ from util import string_literal, clean_input, escape_string, timehash, tformat,
 
 from SimpleDB import SimpleDB, SimpleTable,ConnectionPool
 
+from PVRegistry     import PVRegistry
 from MasterDB       import MasterDB
 from Instruments    import Instruments, Alerts
 from ArchiveMaster  import ArchiveMaster
-from Cache          import Cache, add_pvfile
+from Cache          import Cache, add_pvfile, read_stats, stats_report
+from CacheCoordinator import CacheCoordinator
+from CacheSnapshot  import CacheSnapshot
 from Archiver       import Archiver
 from Daemon         import startstop
 from HTMLWriter     import HTMLWriter
@@ -1,6 +1,8 @@
 #!/usr/bin/env python
 #
+import os
 import time
+import zlib
 from MySQLdb import string_literal, escape_string
 
 MAX_EPOCH = 2147483647.0   # =  2**31 - 1.0 (max unix timestamp)
@@ -55,6 +57,15 @@ def get_force_update_time():
     # return (10800 + randint(0,3600))
     # return 2 * (120  + randint(0,720))
 
+def monotonic():
+    """ seconds on a clock that never goes backwards, for timing and
+    scheduling (not related to the time of day)"""
+    try:
+        return time.monotonic()
+    except AttributeError:
+        # elapsed real time from os.times() is monotonic on unix
+        return os.times()[4]
+
 def timehash():
     """ generate a simple, 10 character hash of the timestamp:
     Number of possibilites = 16^11 >~ 10^13
@@ -88,6 +99,11 @@ def time_str2sec(s):
 
     return time.mktime((int(yr),int(mon),int(day),int(hr),int(min), int(sec),0,0,tz))
 
+def pv_shard(pvname, nshards):
+    """ return the shard index (0 to nshards-1) for a PV name.
+    This uses a stable hash, so is the same for all processes."""
+    return (zlib.crc32(pvname) & 0xffffffff) % nshards
+
 def valid_pvname(pvname):
     for c in pvname:
         if c not in valid_pvstr: return False
@@ -11,7 +11,10 @@ create table cache (
     value      tinyblob    default null,
     cvalue     varchar(64) default null,
     ts         double not null default 0,
-    active     enum('yes','no') not null default 'yes');
+    active     enum('yes','no') not null default 'yes',
+    acq_policy enum('monitor','ratelimit','scan') not null default 'monitor',
+    acq_interval double not null default 0,
+    monitor_mask varchar(32) not null default '');
 
 create index pvname_id on cache (pvname);
 
@@ -0,0 +1,92 @@
+#!/usr/bin/env python
+"""cache_engine_bench:  compare the Cache's Channel Access engines
+
+Connects to the PVs listed in a PV file (as used by 'pvarch add_pvfile')
+with epics.PV objects ('pv' engine) and with CAEngine Channel objects
+('ca' engine), monitoring each for some time, and reports for each engine:
+connection time, memory used, and monitor callbacks per second and CPU
+time per callback.
+
+Usage:
+   cache_engine_bench.py PVFILE [SECONDS]
+
+Each engine is run in its own process, so that memory use and Channel
+Access contexts do not mix.
+"""
+import os
+import sys
+import time
+
+def rss_kbytes():
+    "resident memory of this process, in kB"
+    for line in open('/proc/self/status').readlines():
+        if line.startswith('VmRSS:'):
+            return int(line.split()[1])
+    return 0
+
+def read_pvfile(fname):
+    names = []
+    for line in open(fname, 'r').readlines():
+        line = line.strip()
+        if len(line) < 2 or line.startswith('#'): continue
+        for word in line.replace(',', ' ').split():
+            if word not in names:
+                names.append(word)
+    return names
+
+def run_engine(engine, pvnames, seconds, fout):
+    import epics
+    from EpicsArchiver.CAEngine import Channel
+    PV = {'pv': epics.PV, 'ca': Channel}[engine]
+
+    ncalls = [0]
+    def onChanges(pvname=None, value=None, char_value=None, **kw):
+        ncalls[0] += 1
+
+    # start the CA context first, so its memory is not counted
+    epics.ca.initialize_libca()
+    mem0 = rss_kbytes()
+    t0 = time.time()
+    pvs = [PV(name, callback=onChanges) for name in pvnames]
+    while time.time() - t0 < 30.0:
+        epics.poll(evt=1.e-3, iot=0.1)
+        if len([p for p in pvs if p.connected]) == len(pvs):
+            break
+    tconn = time.time() - t0
+    nconn = len([p for p in pvs if p.connected])
+    mem1 = rss_kbytes()
+
+    ncalls[0] = 0
+    cpu0 = sum(os.times()[:2])
+    t0 = time.time()
+    while time.time() - t0 < seconds:
+        epics.poll(evt=1.e-3, iot=0.1)
+    cpu = sum(os.times()[:2]) - cpu0
+    n = max(1, ncalls[0])
+    fout.write("%-6s %6i/%-6i %8.2f %10.1f %10.0f %12.1f\n" %
+               (engine, nconn, len(pvs), tconn, (mem1-mem0)/1024.0,
+                ncalls[0]/float(seconds), 1.e6*cpu/n))
+    fout.flush()
+
+def main():
+    if len(sys.argv) < 2:
+        print __doc__
+        sys.exit(1)
+    pvnames = read_pvfile(sys.argv[1])
+    seconds = 60.0
+    if len(sys.argv) > 2:
+        seconds = float(sys.argv[2])
+
+    print '%i PVs, monitoring for %.0f seconds' % (len(pvnames), seconds)
+    print 'engine  connected  conn(s)  mem (MB)  callbacks/s  us CPU/callback'
+    for engine in ('pv', 'ca'):
+        pid = os.fork()
+        if pid == 0:
+            try:
+                run_engine(engine, pvnames, seconds, sys.stdout)
+            finally:
+                os._exit(0)
+        os.waitpid(pid, 0)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,130 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import testenv
+import ArchiveSpool
+from ArchiveSpool import format_time, _escape, _unescape
+
+class FakeCursor:
+    """a cursor that fails LOAD DATA LOCAL, as a server without
+    local_infile does, and keeps the rows inserted into archive_spool"""
+    def __init__(self):
+        self.rows = []
+        self.queries = []
+        self.result = []
+        # copies into this database fail
+        self.bad_db = None
+        self.connected = True
+    def execute(self, q):
+        if not self.connected:
+            raise IOError('lost connection')
+        self.queries.append(' '.join(q.split()))
+        if self.bad_db is not None and q.startswith('insert into %s.' % self.bad_db):
+            raise IOError('no table')
+        if q.startswith('load data'):
+            raise IOError('LOAD DATA LOCAL not allowed')
+        if q.startswith('truncate'):
+            self.rows = []
+        elif q.startswith('select count'):
+            self.result = [{'n': len(self.rows)}]
+        elif q.startswith('select distinct'):
+            tables = set([r[0] for r in self.rows])
+            self.result = [{'data_table': t} for t in sorted(tables)]
+    def executemany(self, q, rows):
+        self.rows.extend(rows)
+    def fetchone(self):
+        return self.result[0]
+    def fetchall(self):
+        return self.result
+
+class FakeDB:
+    def __init__(self):
+        self.cursor = FakeCursor()
+        self.loaded = []
+    def get_cursor(self):
+        return self.cursor
+    def begin_transaction(self):
+        pass
+    def commit_transaction(self):
+        self.loaded.extend(self.cursor.rows)
+
+class ArchiveSpoolTest(unittest.TestCase):
+    def setUp(self):
+        self.dirname = tempfile.mkdtemp()
+        self.spool = ArchiveSpool.ArchiveSpool('arch_001', dirname=self.dirname)
+
+    def tearDown(self):
+        self.spool.close()
+        shutil.rmtree(self.dirname)
+
+    def test_escape(self):
+        for val in ('1.0', 'a\tb', 'line\nbreak', 'back\\slash\\t', 'nul\0', ''):
+            self.assertEqual(_unescape(_escape(val)), val)
+            self.assertFalse('\t' in _escape(val) or '\n' in _escape(val))
+
+    def test_time_format(self):
+        # times are written as MySQLdb sends a float in an insert
+        ts = 1792344019.1035183
+        self.assertEqual(format_time(ts), '%.15g' % ts)
+        self.assertEqual(float(format_time(ts)), float('%.15g' % ts))
+
+    def test_append(self):
+        ts = 1792344019.1035183
+        self.spool.append([('pvdat001', 12, ts, 'a\tb'),
+                           ('pvdat002', 13, ts + 1, 2.5)])
+        self.assertTrue(self.spool.pending())
+        self.spool.close()
+        fnames = self.spool.files()
+        self.assertEqual(len(fnames), 1)
+        self.assertTrue(os.path.basename(fnames[0]).startswith('arch_001.'))
+        lines = open(fnames[0]).read().split('\n')
+        self.assertEqual(lines[0], 'pvdat001\t12\t%s\ta\\tb' % ('%.15g' % ts))
+        self.assertEqual(lines[1], 'pvdat002\t13\t%s\t2.5' % ('%.15g' % (ts + 1)))
+
+    def test_replay(self):
+        ts = 1792344019.1035183
+        self.spool.append([('pvdat001', 12, ts, 'a\tb'),
+                           ('pvdat002', 13, ts, '2.5'),
+                           ('bad_table', 14, ts, '1')])
+        db = FakeDB()
+        self.assertEqual(self.spool.replay(db), 3)
+        self.assertEqual(self.spool.files(), [])
+        self.assertFalse(self.spool.pending())
+        self.assertEqual(db.loaded[0], ('pvdat001', 12, float('%.15g' % ts), 'a\tb'))
+
+        copies = [q for q in db.cursor.queries if q.startswith('insert into arch_001.')]
+        self.assertEqual(len(copies), 2)
+        self.assertTrue('not exists' in copies[0])
+        self.assertTrue('arch_001.pvdat001' in copies[0])
+
+    def write_files(self):
+        "spool files for arch_001 and arch_002"
+        ts = 1792344019.1035183
+        self.spool.append([('pvdat001', 12, ts, '1.0')])
+        other = ArchiveSpool.ArchiveSpool('arch_002', dirname=self.dirname)
+        other.append([('pvdat001', 12, ts, '2.0'), ('pvdat001', 13, ts, '3.0')])
+        other.close()
+
+    def test_replay_bad_file(self):
+        self.write_files()
+        db = FakeDB()
+        db.cursor.bad_db = 'arch_001'
+        self.assertEqual(self.spool.replay(db), 2)
+        # the bad file is put aside, and does not block the next one
+        self.assertEqual(self.spool.files(), [])
+        bad = os.listdir(self.dirname)
+        self.assertEqual(len(bad), 1)
+        self.assertTrue(bad[0].startswith('arch_001.') and bad[0].endswith('.spool.bad'))
+        self.assertEqual([r[3] for r in db.loaded], ['2.0', '3.0'])
+
+    def test_replay_disconnected(self):
+        self.write_files()
+        db = FakeDB()
+        db.cursor.connected = False
+        self.assertRaises(IOError, self.spool.replay, db)
+        self.assertEqual(len(self.spool.files()), 2)
+
+if __name__ == '__main__':
+    unittest.main()
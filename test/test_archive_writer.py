@@ -0,0 +1,111 @@
+import shutil
+import StringIO
+import tempfile
+import threading
+import unittest
+
+from testenv import has_modules
+
+if has_modules('MySQLdb'):
+    import ArchiveWriter
+    from ArchiveSpool import ArchiveSpool
+
+class FakeConnection:
+    def __init__(self):
+        self.closed = False
+    def close(self):
+        self.closed = True
+
+class FakeDB:
+    "stands in for the writer's SimpleDB, failing inserts while down"
+    def __init__(self, **kw):
+        self.down = False
+        self.rows = []
+        self.nreconnect = 0
+        self.conn = FakeConnection()
+        # if set, inserts wait for it
+        self.hold = None
+    def use(self, dbname):
+        pass
+    def begin_transaction(self):
+        if self.down:
+            raise IOError('lost connection')
+    def commit_transaction(self):
+        pass
+    def executemany(self, q, rows, retries=50):
+        if self.hold is not None:
+            self.hold.wait()
+        if self.down:
+            return None
+        self.rows.extend(rows)
+        return len(rows)
+    def reconnect(self):
+        self.nreconnect = self.nreconnect + 1
+        return not self.down
+    def close(self):
+        raise AssertionError('connection returned to the pool')
+
+def fake_connection(**kw):
+    return None
+
+@unittest.skipUnless(has_modules('MySQLdb'), 'needs MySQLdb')
+class ArchiveWriterTest(unittest.TestCase):
+    def setUp(self):
+        self.saved = ArchiveWriter.SimpleDB, ArchiveWriter.Connection
+        ArchiveWriter.SimpleDB = FakeDB
+        ArchiveWriter.Connection = fake_connection
+        self.dirname = tempfile.mkdtemp()
+        self.spool = ArchiveSpool('arch_001', dirname=self.dirname)
+
+    def tearDown(self):
+        ArchiveWriter.SimpleDB, ArchiveWriter.Connection = self.saved
+        self.spool.close()
+        shutil.rmtree(self.dirname)
+
+    def test_failed_batch_is_spooled(self):
+        writer = ArchiveWriter.ArchiveWriter('arch_001', spool=self.spool)
+        batch = [('pvdat001', 1, 10.0, '1.0'), ('pvdat002', 2, 11.0, '2.0')]
+        writer.db.down = True
+        writer.write_batch(batch)
+        self.assertEqual(writer.nspooled, 2)
+        self.assertEqual(writer.nfailed, 0)
+        self.assertEqual(writer.db.nreconnect, 1)
+        self.assertTrue(self.spool.pending())
+
+        writer.db.down = False
+        writer.write_batch(batch)
+        self.assertEqual(len(writer.db.rows), 2)
+        self.assertEqual(writer.nspooled, 2)
+
+    def test_failed_batch_without_spool(self):
+        writer = ArchiveWriter.ArchiveWriter('arch_001')
+        writer.messenger = StringIO.StringIO()
+        writer.db.down = True
+        writer.write_batch([('pvdat001', 1, 10.0, '1.0')])
+        self.assertEqual(writer.nfailed, 1)
+
+    def test_stop(self):
+        writer = ArchiveWriter.ArchiveWriter('arch_001')
+        writer.start()
+        writer.put('pvdat001', 1, 10.0, '1.0')
+        writer.stop()
+        self.assertFalse(writer.isAlive())
+        self.assertEqual(len(writer.db.rows), 1)
+        self.assertTrue(writer.db.conn.closed)
+
+    def test_stop_while_writing(self):
+        writer = ArchiveWriter.ArchiveWriter('arch_001')
+        writer.messenger = StringIO.StringIO()
+        writer.db.hold = threading.Event()
+        writer.start()
+        writer.put('pvdat001', 1, 10.0, '1.0')
+        writer.stop(timeout=0.2)
+        # the connection stays open for the insert in progress
+        self.assertTrue(writer.isAlive())
+        self.assertFalse(writer.db.conn.closed)
+        writer.db.hold.set()
+        writer.join(5.0)
+        self.assertEqual(len(writer.db.rows), 1)
+
+if __name__ == '__main__':
+    unittest.main()
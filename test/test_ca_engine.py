@@ -0,0 +1,46 @@
+import unittest
+
+from testenv import has_modules
+
+if has_modules('epics'):
+    from epics import dbr
+    import CAEngine
+
+class FakeCA:
+    "the epics.ca functions used when a Channel connects"
+    def __init__(self, ftype):
+        self.ftype = ftype
+    def create_channel(self, pvname, **kw):
+        return 1
+    def field_type(self, chid):
+        return self.ftype
+    def promote_type(self, chid, use_time=False, **kw):
+        return self.ftype + dbr.TIME_STRING
+    def element_count(self, chid):
+        return 1
+
+@unittest.skipUnless(has_modules('epics'), 'needs epics')
+class ChannelTypeTest(unittest.TestCase):
+    def setUp(self):
+        self.ca = CAEngine.ca
+
+    def tearDown(self):
+        CAEngine.ca = self.ca
+
+    def connect(self, ftype):
+        CAEngine.ca = FakeCA(ftype)
+        chan = CAEngine.Channel('XX:m1.VAL', auto_monitor=False)
+        chan._onConnect(pvname='XX:m1.VAL', chid=1, conn=True)
+        return chan
+
+    def test_native_type(self):
+        self.assertEqual(self.connect(dbr.DOUBLE).type, 'double')
+        self.assertEqual(self.connect(dbr.STRING).type, 'string')
+        self.assertEqual(self.connect(dbr.ENUM).type, 'enum')
+
+    def test_not_connected(self):
+        CAEngine.ca = FakeCA(dbr.DOUBLE)
+        self.assertEqual(CAEngine.Channel('XX:m1.VAL', auto_monitor=False).type, None)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,62 @@
+import os
+import unittest
+
+from testenv import has_modules
+
+if has_modules('epics', 'MySQLdb'):
+    import CacheCoordinator
+
+class FakeControl:
+    def __init__(self, commands):
+        self.commands = commands
+    def get_commands(self):
+        out, self.commands = self.commands, []
+        return out
+
+def make_coordinator(nworkers=1):
+    "a coordinator with one worker that has exited, and no database"
+    class TestCoordinator(CacheCoordinator.CacheCoordinator):
+        def __init__(self):
+            self.nworkers = nworkers
+            self.workers = {}
+            self.inflight = {}
+            self.control_id = 0
+            self.control_sent = {}
+            self.requests = []
+            self.deleted = []
+        def sql_exec_fetch(self, sql):
+            return self.requests
+        def delete_requests(self, ids):
+            self.deleted.extend(ids)
+    coord = TestCoordinator()
+    cmd_r, cmd_w = os.pipe()
+    os.close(cmd_r)
+    coord.workers[0] = [0, cmd_w, None, '']
+    return coord
+
+@unittest.skipUnless(has_modules('epics', 'MySQLdb'), 'needs epics and MySQLdb')
+class DeadWorkerTest(unittest.TestCase):
+    def setUp(self):
+        self.coord = make_coordinator()
+
+    def tearDown(self):
+        os.close(self.coord.workers[0][1])
+
+    def test_dispatch_to_dead_worker(self):
+        import time
+        self.coord.requests = [{'id': 5, 'pvname': 'XX:m1.VAL',
+                                'action': 'add', 'ts': time.time()}]
+        self.coord.dispatch_requests()
+        # not sent: left in the requests table, to be sent again
+        self.assertEqual(self.coord.inflight, {})
+        self.assertEqual(self.coord.deleted, [])
+
+    def test_control_to_dead_worker(self):
+        replies = []
+        self.coord.control = FakeControl([('add', 'XX:m1.VAL', replies.append)])
+        self.coord.read_control()
+        self.assertEqual(replies, ['fail'])
+        self.assertEqual(self.coord.control_sent, {})
+
+if __name__ == '__main__':
+    unittest.main()
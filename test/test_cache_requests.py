@@ -0,0 +1,219 @@
+import os
+import signal
+import time
+import threading
+import unittest
+
+from testenv import has_modules
+
+if has_modules('epics', 'MySQLdb'):
+    import Cache
+    from PVRegistry import PVRegistry
+
+class FakePV:
+    "stands in for a PV, without Channel Access"
+    def __init__(self, pvname, **kw):
+        self.pvname = pvname
+        self.connected = False
+        self.disconnected = False
+    def clear_callbacks(self):
+        pass
+    def disconnect(self):
+        self.disconnected = True
+
+class FakeDB:
+    def set_autocommit(self, val):
+        pass
+    def commit_transaction(self):
+        pass
+
+class FakeControl:
+    "stands in for a ControlServer, with a list of commands"
+    def __init__(self, commands):
+        self.commands = commands
+    def get_commands(self):
+        out, self.commands = self.commands, []
+        return out
+
+def make_cache():
+    "a Cache with the state used by handle_request, and no database"
+    class TestCache(Cache.Cache):
+        def __init__(self):
+            self.pvs = {}
+            self.data = {}
+            self.stats = {}
+            self.current = {}
+            self.masks = {}
+            self.suspended = set()
+            self.pending_adds = {}
+            self.registry = PVRegistry()
+            self.conn_tracker = Cache.ConnectionTracker()
+            self.worker_pipe = None
+            self.db = FakeDB()
+            self.sql = []
+        def sql_exec(self, sql):
+            self.sql.append(sql)
+        def reply_requests(self, rids, done):
+            pass
+    return TestCache()
+
+@unittest.skipUnless(has_modules('epics', 'MySQLdb'), 'needs epics and MySQLdb')
+class HandleRequestTest(unittest.TestCase):
+    def setUp(self):
+        self.pvclass = Cache.PV
+        Cache.PV = FakePV
+        self.cache = make_cache()
+
+    def tearDown(self):
+        Cache.PV = self.pvclass
+
+    def test_drop_then_add(self):
+        cache = self.cache
+        cache.registry.add('XX:m1.VAL', 1, 'double')
+        cache.pvs['XX:m1.VAL'] = pv = FakePV('XX:m1.VAL')
+        self.assertTrue(cache.handle_request('XX:m1.VAL', 'drop'))
+        self.assertTrue(pv.disconnected)
+        self.assertFalse('XX:m1.VAL' in cache.pvs)
+        self.assertFalse('XX:m1.VAL' in cache.registry)
+        self.assertFalse('XX:m1.VAL' in cache.suspended)
+
+        # the add waits for a new PV to connect
+        self.assertEqual(cache.handle_request('XX:m1.VAL', 'add', rid=7), None)
+        self.assertTrue('XX:m1.VAL' in cache.pending_adds)
+        self.assertTrue(cache.pvs['XX:m1.VAL'] is not pv)
+
+    def test_drop_pending_add(self):
+        cache = self.cache
+        cache.handle_request('XX:m2.VAL', 'add', rid=3)
+        pv = cache.pvs['XX:m2.VAL']
+        self.assertTrue(cache.handle_request('XX:m2.VAL', 'drop'))
+        self.assertTrue(pv.disconnected)
+        self.assertFalse('XX:m2.VAL' in cache.pending_adds)
+
+    def test_control_add_not_connected(self):
+        cache = self.cache
+        replies = []
+        cache.control = FakeControl([('add', 'XX:m3.VAL', replies.append)])
+        cache.read_control()
+        self.assertEqual(replies, ['ok'])
+        self.assertTrue('XX:m3.VAL' in cache.pending_adds)
+
+        # the PV does not connect in time: the add goes to the requests table
+        cache.pending_adds['XX:m3.VAL']['deadline'] = 0
+        self.assertEqual(cache.add_pending_pvs(), 0)
+        self.assertFalse('XX:m3.VAL' in cache.pvs)
+        inserts = [q for q in cache.sql if q.startswith('insert into requests')]
+        self.assertEqual(len(inserts), 1)
+        self.assertTrue('XX:m3.VAL' in inserts[0])
+
+class ArgsPV:
+    "like an epics.PV, whose value property makes a get()"
+    type = 'double'
+    enum_strs = None
+    def __init__(self, value=None, char_value=None):
+        self._args = {'value': value, 'char_value': char_value}
+    @property
+    def value(self):
+        raise AssertionError('value read with a get()')
+    char_value = value
+
+@unittest.skipUnless(has_modules('epics', 'MySQLdb'), 'needs epics and MySQLdb')
+class ReceivedValueTest(unittest.TestCase):
+    def test_no_value(self):
+        self.assertEqual(Cache.received_value(ArgsPV()), (None, None))
+
+    def test_value(self):
+        self.assertEqual(Cache.received_value(ArgsPV(1.5, '1.500')), (1.5, '1.500'))
+        self.assertEqual(Cache.received_value(ArgsPV(2.0)), (2.0, '2.0'))
+
+    def test_channel(self):
+        pv = FakePV('XX:m1.VAL')
+        pv.value, pv.char_value = 3, '3'
+        self.assertEqual(Cache.received_value(pv), (3, '3'))
+
+@unittest.skipUnless(has_modules('epics', 'MySQLdb'), 'needs epics and MySQLdb')
+class TerminateTest(unittest.TestCase):
+    def test_sigterm(self):
+        cache = make_cache()
+        cache.terminated = False
+        handler = signal.signal(signal.SIGTERM, cache.onTerminate)
+        try:
+            os.kill(os.getpid(), signal.SIGTERM)
+        finally:
+            signal.signal(signal.SIGTERM, handler)
+        self.assertTrue(cache.terminated)
+
+class FakeScheduler:
+    def next_due(self):
+        return 30.0
+
+@unittest.skipUnless(has_modules('epics', 'MySQLdb'), 'needs epics and MySQLdb')
+class IdleTimeTest(unittest.TestCase):
+    def setUp(self):
+        cache = self.cache = make_cache()
+        cache.scheduler = FakeScheduler()
+        cache.last_flush = time.time()
+        cache.policies = {}
+        cache._scan_next = {}
+        cache._held = {}
+        cache._last_accept = {}
+
+    def test_idle(self):
+        self.assertEqual(self.cache.idle_time(), Cache.max_idle)
+
+    def test_scan_due(self):
+        now = time.time()
+        self.cache._scan_next = {'XX:m1.VAL': now + 0.5, 'XX:m2.VAL': now + 0.3}
+        self.assertTrue(0.2 < self.cache.idle_time() <= 0.3)
+        self.cache._scan_next['XX:m3.VAL'] = now - 1.0
+        self.assertEqual(self.cache.idle_time(), 0)
+
+    def test_held_release(self):
+        self.cache.policies['XX:m1.VAL'] = ('ratelimit', 0.5)
+        self.cache._held['XX:m1.VAL'] = (1.0, '1.0', time.time())
+        self.cache._last_accept['XX:m1.VAL'] = time.time()
+        self.assertTrue(0.4 < self.cache.idle_time() <= 0.5)
+
+    def test_pending_adds(self):
+        self.cache.pending_adds['XX:m1.VAL'] = {'deadline': 0, 'rids': []}
+        self.assertEqual(self.cache.idle_time(), Cache.min_interval)
+
+@unittest.skipUnless(has_modules('epics', 'MySQLdb'), 'needs epics and MySQLdb')
+class OnChangesTest(unittest.TestCase):
+    def setUp(self):
+        cache = self.cache = make_cache()
+        cache.wakeup = threading.Event()
+        cache.alert_data = {}
+        cache.policies = {}
+        cache.pv_ids = {}
+        cache._seed_values = {}
+        cache._held = {}
+        cache._last_accept = {}
+
+    def test_wakeup_first_change(self):
+        cache = self.cache
+        cache.onChanges(pvname='XX:m1.VAL', value=1.0, char_value='1.0')
+        self.assertTrue(cache.wakeup.isSet())
+        cache.wakeup.clear()
+        cache.onChanges(pvname='XX:m2.VAL', value=2.0, char_value='2.0')
+        self.assertFalse(cache.wakeup.isSet())
+        self.assertEqual(len(cache.data), 2)
+
+    def test_wakeup_full_buffer(self):
+        cache = self.cache
+        for i in range(Cache.flush_size - 1):
+            cache.data[i] = ('XX:m%i.VAL' % i, 0, '0', 0)
+        cache.onChanges(pvname='XX:m1.VAL', value=1.0, char_value='1.0')
+        self.assertTrue(cache.wakeup.isSet())
+
+    def test_wakeup_held(self):
+        cache = self.cache
+        cache.policies['XX:m1.VAL'] = ('ratelimit', 10.0)
+        cache._last_accept['XX:m1.VAL'] = time.time()
+        cache.onChanges(pvname='XX:m1.VAL', value=1.0, char_value='1.0')
+        self.assertTrue(cache.wakeup.isSet())
+        self.assertTrue('XX:m1.VAL' in cache._held)
+        self.assertEqual(len(cache.data), 0)
+
+if __name__ == '__main__':
+    unittest.main()
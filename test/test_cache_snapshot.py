@@ -0,0 +1,111 @@
+import os
+import time
+import shutil
+import tempfile
+import unittest
+
+from testenv import has_modules
+import CacheSnapshot
+from CacheSnapshot import CacheSnapshot as Snapshot, write_values
+
+class CacheSnapshotTest(unittest.TestCase):
+    def setUp(self):
+        self.dirname = tempfile.mkdtemp()
+        self.fname = os.path.join(self.dirname, 'cache_values.dat')
+
+    def tearDown(self):
+        shutil.rmtree(self.dirname)
+
+    def test_read_values(self):
+        write_values(self.fname, [('XX:m1.VAL', 'double', '1.5', '1.500', 10.0),
+                                  ('XX:s1.VAL', 'string', 'abc', 'abc', 11.0)])
+        values = Snapshot(self.fname)
+        self.assertTrue(values.available())
+        row = values.get('XX:m1.VAL')
+        self.assertEqual(row, {'pvname': 'XX:m1.VAL', 'type': 'double',
+                               'value': '1.5', 'cvalue': '1.500', 'ts': 10.0})
+        self.assertEqual(values.get('XX:s1.VAL')['value'], 'abc')
+        self.assertEqual(values.get('XX:none.VAL'), None)
+        self.assertEqual(sorted(values.names()), ['XX:m1.VAL', 'XX:s1.VAL'])
+
+    def test_long_value(self):
+        # a value as long as the tinyblob value column is not truncated
+        val = 'x' * 255
+        write_values(self.fname, [('XX:w1.VAL', 'char', val, val[:64], 10.0)])
+        row = Snapshot(self.fname).get('XX:w1.VAL')
+        self.assertEqual(row['value'], val)
+        self.assertEqual(row['cvalue'], val[:64])
+
+    def test_slot_layout(self):
+        write_values(self.fname, [('A', 'double', '1', '1', 1.0),
+                                  ('B', 'double', '2', '2', 2.0)], now=5.0)
+        size = os.path.getsize(self.fname)
+        self.assertEqual(size, CacheSnapshot.header_size + len('A\nB') +
+                         2*CacheSnapshot.slot_size)
+
+    def test_old_file_not_used(self):
+        write_values(self.fname, [('XX:m1.VAL', 'double', '1', '1', 1.0)],
+                     now=time.time() - 120)
+        values = Snapshot(self.fname, max_age=60)
+        self.assertFalse(values.available())
+        self.assertEqual(values.get('XX:m1.VAL'), None)
+
+    def test_shard_files(self):
+        write_values(os.path.join(self.dirname, 'cache_values.0.dat'),
+                     [('XX:m1.VAL', 'double', '1', '1', 1.0)])
+        write_values(os.path.join(self.dirname, 'cache_values.1.dat'),
+                     [('XX:m2.VAL', 'double', '2', '2', 2.0)])
+        values = Snapshot(self.fname)
+        self.assertEqual(values.get('XX:m1.VAL')['value'], '1')
+        self.assertEqual(values.get('XX:m2.VAL')['value'], '2')
+
+    def test_new_file_seen(self):
+        write_values(self.fname, [('XX:m1.VAL', 'double', '1', '1', 1.0)])
+        values = Snapshot(self.fname, check_interval=0)
+        self.assertEqual(values.get('XX:m1.VAL')['value'], '1')
+        time.sleep(0.01)
+        write_values(self.fname, [('XX:m1.VAL', 'double', '2', '2', 2.0)])
+        os.utime(self.fname, (time.time() + 1, time.time() + 1))
+        self.assertEqual(values.get('XX:m1.VAL')['value'], '2')
+
+class FakeTable:
+    def __init__(self, rows):
+        self.rows = rows
+    def select(self):
+        return self.rows
+
+class FakeCache:
+    "stands in for the Cache (MasterDB) used by WebStatus"
+    dbconn = None
+    def __init__(self, rows):
+        self.cache = FakeTable(rows)
+    def get_full(self, pv, add=False):
+        return None
+    def null_pv_value(self, pv):
+        return None
+
+@unittest.skipUnless(has_modules('EpicsArchiver'), 'needs EpicsArchiver installed')
+class WebStatusCachedTest(unittest.TestCase):
+    def setUp(self):
+        import WebStatus
+        self.module = WebStatus
+        self.values = WebStatus.values
+        self.dirname = tempfile.mkdtemp()
+        fname = os.path.join(self.dirname, 'cache_values.dat')
+        write_values(fname, [('XX:m1.VAL', 'double', '1', '1', 1.0)])
+        WebStatus.values = Snapshot(fname)
+
+    def tearDown(self):
+        self.module.values = self.values
+        shutil.rmtree(self.dirname)
+
+    def test_fall_back_to_table(self):
+        rows = [{'pvname': 'XX:m2.VAL', 'type': 'double', 'value': '2',
+                 'cvalue': '2', 'ts': 2.0}]
+        status = self.module.WebStatus(cache=FakeCache(rows))
+        self.assertEqual(status.get_cached('XX:m1.VAL')['value'], '1')
+        self.assertEqual(status.get_cached('XX:m2.VAL')['value'], '2')
+        self.assertEqual(status.get_cached('XX:m3.VAL'), None)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,45 @@
+import os
+import time
+import shutil
+import tempfile
+import unittest
+
+import testenv
+from ChangeFeed import ChangeFeedReader, ChangeFeedPublisher
+
+class ChangeFeedTest(unittest.TestCase):
+    def setUp(self):
+        self.dirname = tempfile.mkdtemp()
+        path = os.path.join(self.dirname, 'feed.sock')
+        self.reader = ChangeFeedReader(path)
+        self.publisher = ChangeFeedPublisher(path)
+
+    def tearDown(self):
+        self.publisher.close()
+        self.reader.close()
+        shutil.rmtree(self.dirname)
+
+    def test_wait_times_out(self):
+        t0 = time.time()
+        self.assertFalse(self.reader.wait(0.2))
+        self.assertTrue(time.time() - t0 >= 0.15)
+
+    def test_wait_and_read(self):
+        self.publisher.publish([('XX:m1.VAL', '1.0', '1.0', 10.0, 'double'),
+                                ('XX:m1.VAL', '2.0', '2.0', 11.0, 'double')])
+        self.assertTrue(self.reader.wait(1.0))
+        changes, gap = self.reader.read()
+        self.assertFalse(gap)
+        self.assertEqual(len(changes), 1)
+        self.assertEqual(changes[0]['value'], '2.0')
+        self.assertFalse(self.reader.wait(0))
+
+    def test_gap(self):
+        self.publisher.publish([('XX:m1.VAL', '1.0', '1.0', 10.0, 'double')])
+        self.publisher.seq = self.publisher.seq + 1
+        self.publisher.publish([('XX:m1.VAL', '2.0', '2.0', 11.0, 'double')])
+        changes, gap = self.reader.read()
+        self.assertTrue(gap)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,109 @@
+import unittest
+
+import testenv
+from ChangeFilter import ChangeFilter, HAS_NUMPY
+
+def make_pvinfo():
+    "pvinfo for a double with deadtime 10 s and deadband 0.5, and a string"
+    return {'XX:m1.VAL': {'deadtime': 10.0, 'deadband': 0.5, 'active': 'yes',
+                          'last_ts': 100.0, 'last_value': '1.0'},
+            'XX:s1.VAL': {'deadtime': 10.0, 'deadband': 0.0, 'active': 'yes',
+                          'last_ts': 100.0, 'last_value': 'abc'},
+            'XX:off.VAL': {'deadtime': 0.0, 'deadband': 0.0, 'active': 'no',
+                           'last_ts': 0.0, 'last_value': None}}
+
+def change(name, value, ts, type='double'):
+    return {'pvname': name, 'value': value, 'ts': ts, 'type': type}
+
+class ChangeFilterTest(unittest.TestCase):
+    use_numpy = False
+
+    def setUp(self):
+        self.pvinfo = make_pvinfo()
+        self.filter = ChangeFilter(self.pvinfo, use_numpy=self.use_numpy)
+
+    def archive(self, newvals):
+        "note values as archived, as the Archiver does"
+        for name, (ts, val) in newvals.items():
+            self.pvinfo[name]['last_ts'] = ts
+            self.pvinfo[name]['last_value'] = val
+            self.filter.set_last(name, ts, val)
+
+    def test_outside_deadband(self):
+        out = self.filter.select([change('XX:m1.VAL', '2.0', 121.0)], tnow=121.0)
+        self.assertEqual(out, {'XX:m1.VAL': (121.0, '2.0')})
+        self.assertEqual(self.filter.limbo, {})
+
+    def test_deadtime_and_limbo(self):
+        # inside the deadtime: held in limbo
+        out = self.filter.select([change('XX:m1.VAL', '5.0', 105.0)], tnow=105.0)
+        self.assertEqual(out, {})
+        self.assertEqual(self.filter.limbo, {'XX:m1.VAL': (105.0, '5.0')})
+        out = self.filter.select([], tnow=108.0)
+        self.assertEqual(out, {})
+        # archived once the deadtime has passed
+        out = self.filter.select([], tnow=111.0)
+        self.assertEqual(out, {'XX:m1.VAL': (105.0, '5.0')})
+        self.assertEqual(self.filter.limbo, {})
+
+    def test_newer_value_replaces_limbo(self):
+        self.filter.select([change('XX:m1.VAL', '5.0', 105.0)], tnow=105.0)
+        out = self.filter.select([change('XX:m1.VAL', '7.0', 115.0)], tnow=115.0)
+        self.assertEqual(out, {'XX:m1.VAL': (115.0, '7.0')})
+        self.archive(out)
+        self.assertEqual(self.filter.select([], tnow=130.0), {})
+
+    def test_string_has_no_deadband(self):
+        out = self.filter.select([change('XX:s1.VAL', 'abd', 120.0, 'string')],
+                                 tnow=120.0)
+        self.assertEqual(out, {'XX:s1.VAL': (120.0, 'abd')})
+
+    def test_inactive(self):
+        out = self.filter.select([change('XX:off.VAL', '3.0', 120.0)], tnow=120.0)
+        self.assertEqual(out, {})
+        self.assertEqual(self.filter.limbo, {})
+
+    def test_latest_change(self):
+        out = self.filter.select([change('XX:m1.VAL', '3.0', 121.0),
+                                  change('XX:m1.VAL', '4.0', 122.0)], tnow=122.0)
+        self.assertEqual(out['XX:m1.VAL'][0] in (121.0, 122.0), True)
+
+    def test_settings_change(self):
+        self.pvinfo['XX:m1.VAL']['deadtime'] = 100.0
+        self.filter.set_info('XX:m1.VAL')
+        out = self.filter.select([change('XX:m1.VAL', '3.0', 120.0)], tnow=120.0)
+        self.assertEqual(out, {})
+        self.assertEqual(self.filter.limbo, {'XX:m1.VAL': (120.0, '3.0')})
+
+@unittest.skipUnless(HAS_NUMPY, 'needs numpy')
+class ChangeFilterNumpyTest(ChangeFilterTest):
+    use_numpy = True
+
+    def test_latest_change(self):
+        out = self.filter.select([change('XX:m1.VAL', '3.0', 121.0),
+                                  change('XX:m1.VAL', '4.0', 122.0)], tnow=122.0)
+        self.assertEqual(out, {'XX:m1.VAL': (122.0, '4.0')})
+
+    def test_parity(self):
+        "the same changes give the same values with and without numpy"
+        pvinfo = make_pvinfo()
+        plain = ChangeFilter(pvinfo, use_numpy=False)
+        steps = [([change('XX:m1.VAL', '1.1', 105.0)], 105.0),
+                 ([change('XX:m1.VAL', '3.0', 112.0),
+                   change('XX:s1.VAL', 'x', 112.0, 'string')], 112.0),
+                 ([change('XX:m1.VAL', '3.2', 125.0)], 125.0),
+                 ([change('XX:m1.VAL', '3.3', 136.0)], 137.0),
+                 ([change('XX:m1.VAL', '9.0', 126.0)], 126.0),
+                 ([], 140.0),
+                 ([change('XX:m1.VAL', 'nan', 150.0)], 150.0)]
+        for changes, tnow in steps:
+            out1 = self.filter.select(changes, tnow=tnow)
+            out2 = plain.select(changes, tnow=tnow)
+            self.assertEqual(out1, out2)
+            self.archive(out1)
+            for name, (ts, val) in out2.items():
+                pvinfo[name]['last_ts'] = ts
+                pvinfo[name]['last_value'] = val
+
+if __name__ == '__main__':
+    unittest.main()
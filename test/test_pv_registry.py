@@ -0,0 +1,79 @@
+import unittest
+
+import testenv
+from PVRegistry import PVRegistry
+
+class FakeDB:
+    "stands in for a SimpleDB, answering queries from a list of cache rows"
+    def __init__(self, rows):
+        self.rows = rows
+        self.queries = []
+    def exec_fetch(self, q):
+        self.queries.append(q)
+        if 'count(id)' in q:
+            return [{'n': len(self.rows)}]
+        if 'where id>' in q:
+            min_id = int(q.split('where id>')[1])
+            return [r for r in self.rows if r['id'] > min_id]
+        return list(self.rows)
+
+def row(id, pvname, type='double'):
+    return {'id': id, 'pvname': pvname, 'type': type}
+
+class PVRegistryTest(unittest.TestCase):
+    def setUp(self):
+        self.db = FakeDB([row(1, 'XX:m1.VAL'), row(2, 'XX:m2.VAL', 'enum')])
+        self.registry = PVRegistry()
+
+    def test_sync(self):
+        self.assertTrue(self.registry.sync(self.db))
+        self.assertEqual(len(self.registry), 2)
+        self.assertTrue('XX:m1.VAL' in self.registry)
+        self.assertEqual(self.registry.get_id('XX:m2.VAL'), 2)
+        self.assertEqual(self.registry.get_type('XX:m2.VAL'), 'enum')
+        self.assertEqual(self.registry.get_id('XX:none.VAL'), None)
+
+    def test_incremental_sync(self):
+        self.registry.sync(self.db)
+        self.db.rows.append(row(3, 'XX:m3.VAL'))
+        self.db.queries = []
+        self.registry.sync(self.db)
+        self.assertTrue('XX:m3.VAL' in self.registry)
+        # only new rows are read
+        self.assertEqual(len([q for q in self.db.queries if 'where id>2' in q]), 1)
+        self.assertEqual(len([q for q in self.db.queries if 'where' not in q
+                              and 'count' not in q]), 0)
+
+    def test_deleted_row_rereads(self):
+        self.registry.sync(self.db)
+        self.db.rows.pop(0)
+        self.registry.sync(self.db)
+        self.assertFalse('XX:m1.VAL' in self.registry)
+        self.assertEqual(len(self.registry), 1)
+
+    def test_max_age(self):
+        self.registry.sync(self.db)
+        self.assertFalse(self.registry.sync(self.db, max_age=60))
+
+    def test_add_remove(self):
+        self.registry.sync(self.db)
+        self.registry.add('XX:m3.VAL', 3, 'string')
+        self.db.rows.append(row(3, 'XX:m3.VAL', 'string'))
+        self.assertEqual(self.registry.remove('XX:m1.VAL'), 1)
+        self.db.rows.pop(0)
+        self.assertEqual(self.registry.remove('XX:m1.VAL'), None)
+        self.assertEqual(sorted(self.registry.names()), ['XX:m2.VAL', 'XX:m3.VAL'])
+        # the count matches the table: no full re-read
+        self.db.queries = []
+        self.registry.sync(self.db)
+        self.assertEqual(len(self.db.queries), 2)
+
+    def test_clear_in_place(self):
+        self.registry.sync(self.db)
+        ids = self.registry.ids
+        self.registry.clear()
+        self.assertTrue(ids is self.registry.ids)
+        self.assertEqual(len(ids), 0)
+
+if __name__ == '__main__':
+    unittest.main()
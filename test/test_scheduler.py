@@ -0,0 +1,81 @@
+import unittest
+
+from testenv import has_modules
+
+if has_modules('MySQLdb'):
+    import Scheduler
+
+class Clock:
+    "a monotonic clock that is moved by hand"
+    def __init__(self):
+        self.now = 1000.0
+    def __call__(self):
+        return self.now
+
+@unittest.skipUnless(has_modules('MySQLdb'), 'needs MySQLdb')
+class SchedulerTest(unittest.TestCase):
+    def setUp(self):
+        self.monotonic = Scheduler.monotonic
+        self.clock = Scheduler.monotonic = Clock()
+        self.sched = Scheduler.Scheduler()
+        self.runs = []
+
+    def tearDown(self):
+        Scheduler.monotonic = self.monotonic
+
+    def task(self, name):
+        return lambda: self.runs.append(name)
+
+    def test_order_and_period(self):
+        self.sched.add('fast', self.task('fast'), 1.0)
+        self.sched.add('slow', self.task('slow'), 5.0)
+        self.assertEqual(self.sched.next_due(), 1.0)
+        self.assertEqual(self.sched.run_pending(), 0)
+        self.clock.now += 1.0
+        self.assertEqual(self.sched.run_pending(), 1)
+        self.clock.now += 4.0
+        self.assertEqual(self.sched.run_pending(), 2)
+        self.assertEqual(self.runs, ['fast', 'fast', 'slow'])
+        self.assertEqual(self.sched.next_due(), 1.0)
+
+    def test_delay(self):
+        self.sched.add('now', self.task('now'), 10.0, delay=0)
+        self.assertEqual(self.sched.run_pending(), 1)
+        self.assertEqual(self.sched.next_due(), 10.0)
+
+    def test_late_task_skips_missed_runs(self):
+        self.sched.add('t', self.task('t'), 1.0)
+        self.clock.now += 3.5
+        self.assertEqual(self.sched.run_pending(), 1)
+        task = self.sched.tasks['t']
+        self.assertEqual(task['nrun'], 1)
+        self.assertEqual(task['nskipped'], 2)    # runs due at +2 and +3
+        self.assertEqual(task['maxlate'], 2.5)
+        self.assertEqual(self.sched.next_due(), 1.0)
+
+    def test_set_period(self):
+        self.sched.add('t', self.task('t'), 1.0)
+        self.sched.set_period('t', 4.0)
+        self.clock.now += 1.0
+        self.sched.run_pending()
+        self.assertEqual(self.sched.next_due(), 4.0)
+
+    def test_failing_task_is_rescheduled(self):
+        def fail():
+            raise ValueError('task failed')
+        self.sched.add('t', fail, 1.0)
+        self.clock.now += 1.0
+        self.assertRaises(ValueError, self.sched.run_pending)
+        self.assertEqual(self.sched.next_due(), 1.0)
+
+    def test_report(self):
+        self.sched.add('t', self.task('t'), 1.0)
+        self.clock.now += 1.0
+        self.sched.run_pending()
+        lines = self.sched.report()
+        self.assertEqual(len(lines), 2)
+        self.assertTrue(lines[1].split()[0] == 't')
+        self.assertEqual(self.sched.tasks['t']['nrun'], 0)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,27 @@
+"""
+Set up the path for the tests:  the modules in lib/ are imported as they
+are installed, and config_dist.py is used as the config module if there
+is no config.py.
+"""
+import os
+import sys
+
+topdir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+for d in (topdir, os.path.join(topdir, 'lib')):
+    if d not in sys.path:
+        sys.path.insert(0, d)
+
+try:
+    import config
+except ImportError:
+    import config_dist as config
+    sys.modules['config'] = config
+
+def has_modules(*names):
+    "whether all of the named modules can be imported"
+    for name in names:
+        try:
+            __import__(name)
+        except ImportError:
+            return False
+    return True